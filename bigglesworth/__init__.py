@@ -3,7 +3,6 @@
 
 import sys
 import argparse
-import pickle
 import re
 from os import path, makedirs
 from string import uppercase
@@ -15,6 +14,10 @@ from utils import *
 from classes import *
 from widgets import *
 from dialogs import *
+from codec import decode_sound
+from libfile import LIBRARY_FILE, DEVICE_STATE_FILE, DEVICE_SLOTS, DeviceState
+from emulator import EMULATOR_NAME
+from dump import DumpSession, DumpSender, DumpVerifier, REQUESTING, BULK
 
 from editor import Editor
 from wavetable import WaveTableEditor
@@ -23,6 +26,9 @@ def process_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--sysex', help='Print output SysEx messages to the terminal', action='store_true')
     parser.add_argument('--rtmidi', help='Use rtmidi interface (mandatory for OSX/Windows, not recommended for Linux)', action='store_true')
+    parser.add_argument('--emulator', help='Use an emulated Blofeld instead of MIDI devices (for testing)', action='store_true')
+    parser.add_argument('--emulator-latency', metavar='MS', type=float, default=5, help='Reply latency of the emulated Blofeld')
+    parser.add_argument('--emulator-drop', metavar='RATE', type=float, default=0, help='Ratio of messages dropped by the emulated Blofeld')
     parser.add_argument('-l', '--library-limit', metavar='N', type=int, help=argparse.SUPPRESS)
     parser.add_argument('-w', '--wavetable', metavar='WTFILE', nargs='?', const=True, help='Open Wavetable editor (with optional WTFILE)')
     parser.add_argument('-e', '--editor', metavar='BXXX', nargs='?', const=True, help='Open Sound editor (with INIT sound or optional sound XXX from bank B, eg. A001)')
@@ -34,7 +40,9 @@ def process_args():
     return res
 
 args = process_args()
-if sys.platform in ('win32', 'darwin') or args.rtmidi:
+if args.emulator:
+    from emulator import MidiDevice
+elif sys.platform in ('win32', 'darwin') or args.rtmidi:
     from rt import MidiDevice
 else:
     from alsa import MidiDevice
@@ -45,6 +53,7 @@ class BigglesworthObject(QtCore.QObject):
     device_event = QtCore.pyqtSignal(object)
     parameter_change_received = QtCore.pyqtSignal(int, int, int)
     program_change_received = QtCore.pyqtSignal(int, int)
+    blofeld_id_changed = QtCore.pyqtSignal(int)
     input_conn_state_change = QtCore.pyqtSignal(int)
     output_conn_state_change = QtCore.pyqtSignal(int)
     midi_duplex_state_change = QtCore.pyqtSignal(bool)
@@ -68,10 +77,14 @@ class BigglesworthObject(QtCore.QObject):
         else:
             limit = None
 
-        self.midi = MidiDevice(self)
-        if args.rtmidi or sys.platform in ('win32', 'darwin'):
+        if args.emulator:
+            self.midi = MidiDevice(self, args.emulator_latency / 1000., args.emulator_drop)
+            self.backend = EMULATOR
+        elif args.rtmidi or sys.platform in ('win32', 'darwin'):
+            self.midi = MidiDevice(self)
             self.backend = RTMIDI
         else:
+            self.midi = MidiDevice(self)
             self.backend = ALSA
         self.midi_thread = QtCore.QThread()
         self.midi.moveToThread(self.midi_thread)
@@ -86,8 +99,18 @@ class BigglesworthObject(QtCore.QObject):
         self.connections = [0, 0]
         self.midi_duplex_state = False
         self.midi_thread.start()
+        self.output_thread = OutputThread(self.write_event, self.drain_output if self.backend == ALSA else None)
+        self.output_thread.error.connect(self.output_error)
+        self.output_error_dialog = None
+        self.output_thread.start()
+        self.output_queue = OutputQueue(self)
+        self.output_queue.output.connect(self.output_thread.put)
+        #closing the last window quits without calling quit()
+        self.app.aboutToQuit.connect(self.output_stop)
 
         self.midi.midi_event.connect(self.midi_event_received)
+        if hasattr(self.midi, 'midi_events'):
+            self.midi.midi_events.connect(self.midi_events_received)
 
 
         self.blofeld_current = [None, None]
@@ -130,6 +153,8 @@ class BigglesworthObject(QtCore.QObject):
         self.deviceAction.triggered.connect(self.device_request)
         self.globalsAction = self.librarian.globalsAction
         self.globalsAction.triggered.connect(self.globals_request)
+        self.syncAction = self.librarian.syncAction
+        self.syncAction.triggered.connect(self.sync_preview)
         self.updateCheckAction = self.librarian.updateCheckAction
         self.updateCheckAction.triggered.connect(lambda: self.update_check(silent=False))
 
@@ -152,43 +177,40 @@ class BigglesworthObject(QtCore.QObject):
         self.aboutAction.triggered.connect(self.about_win.show)
 
         #DUMPING
-        self.dump_bulk = False
-        self.dump_bulk_count = 0
-        self.dump_bulk_timer = QtCore.QTimer()
-        self.dump_bulk_timer.setInterval(500)
-        self.dump_bulk_timer.setSingleShot(True)
-
-        self.dump_timer = QtCore.QTimer()
-        self.dump_timer.setInterval(100)
-        self.dump_timer.setSingleShot(True)
-
-        self.dump_active = False
-        self.dump_pause = False
-        self.dump_temp = []
-        self.dump_elapsed = QtCore.QElapsedTimer()
+        self.dump_session = DumpSession(self)
+        self.dump_session.request.connect(self.sound_request)
+        self.dump_session.state_changed.connect(self.dump_state_changed)
+        self.dump_session.progress.connect(self.dump_progress)
+        self.dump_session.finished.connect(self.dump_finished)
+
         self.dump_win = DumpWin(self.librarian)
-        self.dump_bulk_timer.timeout.connect(self.dump_win.accept)
-        self.dump_bulk_timer.timeout.connect(lambda: self.blofeld_library.addSoundBulk(self.dump_temp))
-        self.dump_bulk_timer.timeout.connect(lambda: setattr(self, 'dump_bulk', False))
-        self.dump_bulk_timer.timeout.connect(lambda: setattr(self, 'dump_bulk_count', 0))
-        self.dump_win.resume.connect(lambda: setattr(self, 'dump_pause', False))
-        self.dump_win.resume.connect(self.dump_timer.start)
-        self.dump_win.pause.connect(self.dump_timer.stop)
-        self.dump_win.pause.connect(lambda: setattr(self, 'dump_pause', True))
-        self.dump_win.accepted.connect(lambda: self.blofeld_library.addSoundBulk(self.dump_temp))
-        self.dump_win.accepted.connect(lambda: setattr(self, 'dump_active', False))
-        self.dump_win.rejected.connect(lambda: setattr(self, 'dump_active', False))
-        self.dump_win.rejected.connect(self.dump_timer.stop)
+        self.dump_win.resume.connect(self.dump_session.resume)
+        self.dump_win.pause.connect(self.dump_session.pause)
+        self.dump_win.accepted.connect(self.dump_session.stop)
+        self.dump_win.rejected.connect(self.dump_session.cancel)
+
+        self.device_state = self.load_device_state(self.blofeld_id)
+        self.blofeld_id_changed.connect(self.device_id_changed)
+        self.sync_dialog = SyncDialog(self, self.librarian)
 
         self.dump_send_win = DumpWin(self.librarian)
-        self.dump_send_timer = QtCore.QTimer()
-        self.dump_send_timer.setInterval(200)
-        self.dump_send_win.resume.connect(self.dump_send_timer.start)
-        self.dump_send_win.pause.connect(self.dump_send_timer.stop)
-        self.dump_send_win.accepted.connect(self.dump_send_timer.stop)
-        self.dump_send_win.accepted.connect(self.dump_send_timer.timeout.disconnect)
-        self.dump_send_win.rejected.connect(self.dump_send_timer.stop)
-        self.dump_send_win.rejected.connect(self.dump_send_timer.timeout.disconnect)
+        self.dump_sender = DumpSender(self)
+        self.dump_sender.send.connect(self.dump_bulk_consume)
+        self.dump_sender.progress.connect(self.dump_send_progress)
+        self.dump_sender.finished.connect(self.dump_send_finished)
+        self.dump_verifier = DumpVerifier(self)
+        self.dump_verifier.request.connect(self.sound_request)
+        self.dump_verifier.resend.connect(self.dump_sender.append)
+        self.dump_verifier.progress.connect(lambda verified, total: self.dump_send_win.progress.setValue(verified))
+        self.dump_verifier.finished.connect(self.dump_verify_finished)
+        self.dump_send_win.resume.connect(self.dump_sender.resume)
+        self.dump_send_win.pause.connect(self.dump_sender.pause)
+        self.dump_send_win.accepted.connect(self.dump_sender.cancel)
+        self.dump_send_win.accepted.connect(self.dump_verifier.stop)
+        self.dump_send_win.rejected.connect(self.dump_sender.cancel)
+        self.dump_send_win.rejected.connect(self.dump_verifier.stop)
+        self.dump_send_win.finished.connect(lambda res: self.device_state.save())
+        self.dump_win.finished.connect(lambda res: self.device_state.save())
 
         #EDITOR
         self.editor = Editor(self)
@@ -281,6 +303,9 @@ class BigglesworthObject(QtCore.QObject):
         self.librarian.wavetableAction.triggered.connect(lambda _: self.wavetable_show())
 
         self.midi_connect()
+        if self.backend == EMULATOR and self.midi.load_error:
+            QtGui.QMessageBox.warning(self.librarian, 'Emulator',
+                'The factory sounds could not be loaded, the emulated Blofeld only contains init sounds.\n\n{}'.format(self.midi.load_error))
 
         if args.wavetable:
             if args.wavetable is True:
@@ -409,19 +434,25 @@ class BigglesworthObject(QtCore.QObject):
             self.midi_import.setSource(*res)
 
     def save_library(self):
-        data = []
-        for bank in self.blofeld_library.data:
-            for sound in bank:
-                data.append((sound.bank, sound.prog) + tuple(sound.data))
         data_dir = str(QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation).toUtf8())
-        data_path = path.join(data_dir, 'personal_library')
-        if not path.exists(data_path):
+        data_path = path.join(data_dir, LIBRARY_FILE)
+        if not path.exists(data_dir):
             try:
                 makedirs(data_dir)
             except:
                 pass
-        with open(data_path, 'wb') as of:
-            pickle.dump(tuple(data), of)
+        self.blofeld_library.save(data_path)
+
+    def load_device_state(self, device_id):
+        #a different device id usually means a different Blofeld, each has its own state
+        data_dir = str(QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation).toUtf8())
+        device_state = DeviceState(path.join(data_dir, DEVICE_STATE_FILE.format(device_id)))
+        device_state.load()
+        return device_state
+
+    def device_id_changed(self, device_id):
+        self.device_state.save()
+        self.device_state = self.load_device_state(device_id)
 
     @property
     def blofeld_id(self):
@@ -433,8 +464,12 @@ class BigglesworthObject(QtCore.QObject):
 
     @blofeld_id.setter
     def blofeld_id(self, value):
+        #the settings dialog sets it on every OK, the device state is reloaded only for a new id
+        if value == self.blofeld_id:
+            return
         self.settings.gMIDI.set_Blofeld_ID(value)
         self._blofeld_id = value
+        self.blofeld_id_changed.emit(value)
 
     @property
     def source_library(self):
@@ -490,6 +525,19 @@ class BigglesworthObject(QtCore.QObject):
         self.settings.gMIDI.set_Blofeld_autoconnect(value)
         self._blofeld_autoconnect = value
 
+    @property
+    def dump_verify(self):
+        try:
+            return self._dump_verify
+        except:
+            self._dump_verify = self.settings.gMIDI.get_Dump_verify(False, True)
+            return self._dump_verify
+
+    @dump_verify.setter
+    def dump_verify(self, value):
+        self.settings.gMIDI.set_Dump_verify(value)
+        self._dump_verify = value
+
     @property
     def remember_connections(self):
         try:
@@ -588,9 +636,9 @@ class BigglesworthObject(QtCore.QObject):
 
     def alsa_conn_event(self, conn, state):
         if conn.dest == self.input:
-            conn_list = [c for c in self.input.connections.input if not c.hidden]
-            self.input_conn_state_change.emit(len(conn_list))
-            self.duplex_state_check(INPUT, len(conn_list))
+            conn_count = self.input.connections.visible_input
+            self.input_conn_state_change.emit(conn_count)
+            self.duplex_state_check(INPUT, conn_count)
             if self.remember_connections and not conn.hidden:
                 port_fmt = '{}:{}'.format(conn.src.client.name, conn.src.name)
                 if port_fmt == 'Blofeld:Blofeld MIDI 1': return
@@ -600,9 +648,9 @@ class BigglesworthObject(QtCore.QObject):
                     self.autoconnect[INPUT].discard(port_fmt)
                 self.settings.gMIDI.set_Autoconnect(self.autoconnect)
         elif conn.src == self.output:
-            conn_list = [c for c in self.output.connections.output if not c.hidden]
-            self.output_conn_state_change.emit(len(conn_list))
-            self.duplex_state_check(OUTPUT, len(conn_list))
+            conn_count = self.output.connections.visible_output
+            self.output_conn_state_change.emit(conn_count)
+            self.duplex_state_check(OUTPUT, conn_count)
             if self.remember_connections and not conn.hidden:
                 port_fmt = '{}:{}'.format(conn.dest.client.name, conn.dest.name)
                 if port_fmt == 'Blofeld:Blofeld MIDI 1': return
@@ -623,7 +671,15 @@ class BigglesworthObject(QtCore.QObject):
         if not (self.blofeld_autoconnect or self.remember_connections): return
         for cid, client in self.graph.client_id_dict.items():
             if self.blofeld_autoconnect:
-                if self.backend == RTMIDI:
+                if self.backend == EMULATOR:
+                    if client.name == EMULATOR_NAME:
+                        blofeld_port = self.graph.port_id_dict[cid][0]
+                        if blofeld_port.is_input:
+                            self.output.connect(blofeld_port)
+                        else:
+                            blofeld_port.connect(self.input)
+                        continue
+                elif self.backend == RTMIDI:
                     if sys.platform == 'win32':
                         if client.name.startswith('Waldorf Blofeld '):
                             blofeld_port = self.graph.port_id_dict[cid][0]
@@ -659,32 +715,57 @@ class BigglesworthObject(QtCore.QObject):
         self.output_event(ProgramEvent(1, 0, prog))
 
     def output_event(self, event):
+        self.output_queue.put(event)
+
+    def write_event(self, event):
+        #called from the output thread
         if self.debug_sysex and event.type == SYSEX:
             print event.sysex
         if self.backend == ALSA:
             alsa_event = event.get_event()
             alsa_event.source = self.output.client.id, self.output.id
             self.seq.output_event(alsa_event)
-            self.seq.drain_output()
         else:
             rtmidi_event = event.get_binary()
             for port in self.seq.ports[OUTPUT]:
                 port.send_message(rtmidi_event)
 
+    def drain_output(self):
+        self.seq.drain_output()
+
+    def output_error(self, event, error):
+        #errors usually come in bursts, only the first one is shown until the dialog is closed
+        if self.output_error_dialog is None:
+            self.output_error_dialog = QtGui.QMessageBox(QtGui.QMessageBox.Warning, 'MIDI output error', '', QtGui.QMessageBox.Ok, self.librarian)
+            self.output_error_dialog.setModal(False)
+        elif self.output_error_dialog.isVisible():
+            return
+        if event is None:
+            text = 'Pending MIDI events could not be sent:\n{}'.format(error)
+        else:
+            text = 'A MIDI event could not be sent:\n{}'.format(error)
+        self.output_error_dialog.setText(text)
+        self.output_error_dialog.show()
+
+    def midi_events_received(self, event_list):
+        for event in event_list:
+            self.midi_event_received(event)
+
     def midi_event_received(self, event):
         if event.type == SYSEX:
 #            print 'receiving event: {}'.format(len(event.sysex))
 #            print event.sysex
-            sysex_type = event.sysex[4]
+            sysex = event.sysex
+            sysex_type = sysex[4]
             if sysex_type == SNDD:
-                self.sound_dump_received(Sound(event.sysex[5:390], SRC_BLOFELD))
+                self.sound_dump_received(Sound(decode_sound(sysex[5:], 0), SRC_BLOFELD))
             elif sysex_type == SNDP:
-                self.sysex_parameter(event.sysex[5:])
+                self.sysex_parameter(sysex)
             elif sysex_type == GLBD:
-                self.globals_event.emit(event.sysex)
+                self.globals_event.emit(list(sysex))
 #                self.main.globals.setData(event.sysex)
-            elif len(event.sysex) == 15 and event.sysex[3:5] == [6, 2]:
-                self.device_event.emit(event.sysex)
+            elif len(sysex) == 15 and sysex[3] == 6 and sysex[4] == 2:
+                self.device_event.emit(list(sysex))
         elif event.type == CTRL:
             if event.data1 == 0:
                 self.blofeld_current[0] = event.data2
@@ -696,10 +777,10 @@ class BigglesworthObject(QtCore.QObject):
             self.librarian.blofeld_sounds_table.selectRow(self.librarian.blofeld_model_proxy.mapFromSource(self.blofeld_model.index(self.blofeld_current[0]*128+self.blofeld_current[1], 0)).row())
             self.program_change_received.emit(*self.blofeld_current)
 
-    def sysex_parameter(self, data):
-        location = data[0]
-        index = data[1]*128+data[2]
-        value = data[3]
+    def sysex_parameter(self, sysex):
+        location = sysex[5]
+        index = sysex[6]*128+sysex[7]
+        value = sysex[8]
         self.parameter_change_received.emit(location, index, value)
 
     def ctrl_parameter(self, param_id, value):
@@ -735,135 +816,76 @@ class BigglesworthObject(QtCore.QObject):
                 if editor:
                     self.activate_editor(*library)
             return
-        bank = sound.bank
-        prog = sound.prog
-
-        if self.dump_bulk:
-            self.dump_temp.append(sound)
-            self.dump_bulk_count += 1
-            dump_all = self.dump_bulk_count/128
-            self.dump_bulk_timer.stop()
-            self.dump_bulk_timer.start()
-            self.dump_win.bank_lbl.setText('{}{}'.format(uppercase[bank], ' {}/8'.format(bank+1) if dump_all else ''))
-            self.dump_win.sound_lbl.setText('{:03}/{}'.format(prog+1+(128*bank if dump_all else 0), 1024 if dump_all else 128))
-            dump_time = None
-            if dump_all:
-                self.dump_win.progress.setMaximum(1024)
-                self.dump_win.progress.setValue(prog+1+(128*bank))
-                if not (bank == 0 and prog < 10):
-                    dump_time = self.dump_elapsed.elapsed()/float(prog+1+128*bank)*(1024-prog-128*bank)/1000
-            else:
-                self.dump_win.progress.setValue(prog+1)
-                if prog > 5:
-                    dump_time = self.dump_elapsed.elapsed()/float(prog+1)*(128-prog)/1000
-            if dump_time is not None:
-                self.dump_win.time.setText('{}:{:02}'.format(*divmod(int(dump_time)+1, 60)))
+        self.device_state.update(sound.bank, sound.prog, sound.data)
+        if self.dump_verifier.active and self.dump_verifier.receive(sound):
             return
-        if not self.dump_active:
-            if not self.dump_bulk_timer.isActive():
-                self.dump_bulk_timer.start()
-            else:
-                self.dump_bulk = True
-                self.dump_bulk_count += 1
-                self.dump_temp = []
-                self.dump_bulk_timer.stop()
-                self.dump_bulk_timer.start()
-                self.dump_elapsed.start()
-                self.dump_win.showDisabled()
-            self.blofeld_library.addSound(sound)
-            if self.editor_dump_state == True and (sound.bank, sound.prog) == (self.editor.sound.bank, self.editor.sound.prog):
-                self.editor.setSoundDump(sound)
-#            self.cat_count_update()
-#            self.blofeld_sounds_table.resizeColumnToContents(2)
-#            self.blofeld_sounds_table.resizeColumnToContents(5)
+        if self.dump_session.receive(sound):
             return
-        self.dump_temp.append(sound)
-        dump_all = True if self.dump_mode == DUMP_ALL else False
-        if prog >= 127:
-            if dump_all:
-                bank += 1
-                if bank >= 8:
-                    self.dump_active = False
-                    self.blofeld_library.addSoundBulk(self.dump_temp)
-                    self.dump_win.accept()
-#                    self.cat_count_update()
-#                    self.blofeld_sounds_table.resizeColumnToContents(2)
-#                    self.blofeld_sounds_table.resizeColumnToContents(5)
-                    return
-                prog = -1
-            else:
-                self.dump_active = False
-                self.blofeld_library.addSoundBulk(self.dump_temp)
-                self.dump_win.accept()
-                return
-        self.dump_win.bank_lbl.setText('{}{}'.format(uppercase[bank], ' {}/8'.format(bank+1) if dump_all else ''))
-        self.dump_win.sound_lbl.setText('{:03}/{}'.format(prog+1+(128*bank if dump_all else 0), 1024 if dump_all else 128))
-        dump_time = None
-        if dump_all:
-            if not (bank == 0 and prog < 10):
-                dump_time = self.dump_elapsed.elapsed()/float(prog+1+128*bank)*(1024-prog-128*bank)/1000
-        else:
-            if prog > 5:
-                dump_time = self.dump_elapsed.elapsed()/float(prog+1)*(128-prog)/1000
-        if dump_time is not None:
-            self.dump_win.time.setText('{}:{:02}'.format(*divmod(int(dump_time)+1, 60)))
-        self.dump_win.progress.setValue(prog+1+(128*bank if dump_all else 0))
-        try:
-            self.dump_timer.timeout.disconnect()
-        except:
-            pass
-        self.dump_timer.timeout.connect(lambda: self.sound_request(bank, prog+1))
-        if not self.dump_pause:
-            self.dump_timer.start()
-
+        self.blofeld_library.addSound(sound)
+        if self.editor_dump_state == True and (sound.bank, sound.prog) == (self.editor.sound.bank, self.editor.sound.prog):
+            self.editor.setSoundDump(sound)
+
+    def dump_state_changed(self, state):
+        if state == REQUESTING:
+            if not self.dump_win.isVisible():
+                self.dump_win.show()
+                self.dump_win.paused = False
+        elif state == BULK:
+            self.dump_win.showDisabled()
+
+    def dump_progress(self, progress):
+        dump_all = progress.total > 128
+        self.dump_win.bank_lbl.setText('{}{}'.format(uppercase[progress.bank], ' {}/8'.format(progress.bank+1) if dump_all else ''))
+        self.dump_win.sound_lbl.setText('{:03}/{}'.format(progress.done, progress.total))
+        if progress.eta >= 0:
+            self.dump_win.time.setText('{}:{:02}'.format(*divmod(int(progress.eta)+1, 60)))
+        self.dump_win.progress.setMaximum(progress.total)
+        self.dump_win.progress.setValue(progress.done)
+
+    def dump_finished(self, sounds, failed):
+        self.blofeld_library.addSoundBulk(sounds)
+        if self.dump_win.isVisible():
+            self.dump_win.accept()
+        if failed:
+            QtGui.QMessageBox.warning(self.librarian, 'Dump incomplete',
+                'The Blofeld did not reply for {} sound{}:\n{}'.format(
+                    len(failed), 's' if len(failed) > 1 else '',
+                    ', '.join('{}{:03}'.format(uppercase[bank], prog+1) for bank, prog in sorted(failed))))
 
     def dump_request(self, req):
         if isinstance(req, tuple):
             self.sound_request(*req)
             return
-        self.dump_active = True
-        self.dump_pause = False
-        self.dump_mode = req
-        self.dump_temp = []
-        self.dump_elapsed.start()
-        self.dump_win.show()
-        self.dump_win.paused = False
         if req == DUMP_ALL:
-            bank = 0
-            self.dump_win.progress.setMaximum(1024)
+            banks = range(8)
         else:
-            bank = req
-            self.dump_win.progress.setMaximum(128)
-        self.sound_request(bank, 0)
+            banks = [req]
+        self.dump_session.start([(bank, prog) for bank in banks for prog in range(128)])
 
     def dump_send(self, sound, bank=None, prog=None):
         data = sound.data
         if bank is None:
             bank = sound.bank
             prog = sound.prog
-        self.output_event(SysExEvent(1, [INIT, IDW, IDE, self.blofeld_id, SNDD, bank, prog] + data + [CHK, END]))
+        self.output_event(SoundDumpEvent(1, self.blofeld_id, bank, prog, data))
+        if self.dump_verifier.active:
+            #the slot is known again only when read back (see sound_dump_received)
+            self.device_state.forget(bank, prog)
+        else:
+            self.device_state.update(bank, prog, data)
 
     def wavetable_send(self, sysex):
         self.output_event(SysExEvent(1, sysex))
     
+    def sync_preview(self):
+        sounds = [self.blofeld_library[slot] for slot in range(DEVICE_SLOTS)]
+        total = len(filter(None, sounds))
+        sounds = self.sync_dialog.exec_(self.device_state.diff(sounds), total)
+        if sounds:
+            self.external_dump_bulk_send(sounds)
+
     def dump_bulk_send(self, first, last):
-        def consume():
-            if not dump_bulk_list:
-                self.dump_send_win.accept()
-                return
-            sound = dump_bulk_list.pop(0)
-            self.dump_send(sound)
-            current = tot_sounds-len(dump_bulk_list)
-            self.dump_send_win.bank_lbl.setText('{} {}/{}'.format(uppercase[sound.bank], tot_banks-last[0]+sound.bank, tot_banks))
-            self.dump_send_win.sound_lbl.setText('{:03} {}/{}'.format(sound.prog+1, current, tot_sounds))
-            self.dump_send_win.progress.setValue(current)
-            dump_time = None
-            if (tot_sounds > 100 and current > 10) or (tot_sounds <= 100 and current > 5):
-                dump_time = self.dump_elapsed.elapsed()/float(current)*(len(dump_bulk_list))/1000
-            if dump_time is not None:
-                self.dump_send_win.time.setText('{}:{:02}'.format(*divmod(int(dump_time)+1, 60)))
         bank, prog = first
-        tot_banks = last[0]-bank+1
         _last = (last[0], last[1]+1) if last[1]+1 <= 127 else (last[0]+1, 0)
         dump_bulk_list = []
         while (bank, prog) != _last:
@@ -873,41 +895,48 @@ class BigglesworthObject(QtCore.QObject):
                 bank += 1
                 if bank > self.blofeld_library.banks: break
                 prog = 0
-        tot_sounds = len(dump_bulk_list)
-        self.dump_send_win.progress.setMaximum(tot_sounds)
-        self.dump_send_win.show()
-        self.dump_send_timer.timeout.connect(consume)
-        self.dump_send(dump_bulk_list.pop(0))
-        self.dump_send_timer.start()
-        self.dump_elapsed.start()
+        self.external_dump_bulk_send(dump_bulk_list)
 
     def external_dump_bulk_send(self, sound_list):
-        def consume():
-            if not sound_list:
-                self.dump_send_win.accept()
-                return
-            sound = sound_list.pop(0)
-            self.dump_send(sound)
-            current = tot_sounds-len(sound_list)
-            self.dump_send_win.bank_lbl.setText('{} {}/{}'.format(uppercase[sound.bank], tot_banks-last[0]+sound.bank, tot_banks))
-            self.dump_send_win.sound_lbl.setText('{:03} {}/{}'.format(sound.prog+1, current, tot_sounds))
-            self.dump_send_win.progress.setValue(current)
-            dump_time = None
-            if (tot_sounds > 100 and current > 10) or (tot_sounds <= 100 and current > 5):
-                dump_time = self.dump_elapsed.elapsed()/float(current)*(len(sound_list))/1000
-            if dump_time is not None:
-                self.dump_send_win.time.setText('{}:{:02}'.format(*divmod(int(dump_time)+1, 60)))
-        tot_banks = len(set([s.bank for s in sound_list]))
-        tot_sounds = len(sound_list)
-        self.dump_send_win.progress.setMaximum(tot_sounds)
+        self.dump_send_banks = sorted(set([s.bank for s in sound_list]))
+        self.dump_send_win.progress.setMaximum(len(sound_list))
         self.dump_send_win.show()
-        self.dump_send_timer.timeout.connect(consume)
-        self.dump_send(sound_list.pop(0))
-        self.dump_send_timer.start()
-        self.dump_elapsed.start()
+        if self.dump_verify:
+            self.dump_verifier.start()
+        self.dump_sender.start(sound_list)
+
+    def dump_bulk_consume(self, sound):
+        self.dump_send(sound)
+        self.dump_send_last = sound
+        self.dump_verifier.sent(sound)
+
+    def dump_send_finished(self, completed):
+        if not completed:
+            return
+        if self.dump_verifier.active:
+            self.dump_verifier.sending_done()
+        else:
+            self.dump_send_win.accept()
+
+    def dump_verify_finished(self, failed):
+        self.dump_send_win.accept()
+        if failed:
+            QtGui.QMessageBox.warning(self.librarian, 'Dump not verified',
+                'The following sound{} could not be verified:\n{}'.format(
+                    's' if len(failed) > 1 else '',
+                    ', '.join('{}{:03}'.format(uppercase[bank], prog+1) for bank, prog in failed)))
+
+    def dump_send_progress(self, current, tot_sounds, dump_time):
+        sound = self.dump_send_last
+        tot_banks = len(self.dump_send_banks)
+        self.dump_send_win.bank_lbl.setText('{} {}/{}'.format(uppercase[sound.bank], self.dump_send_banks.index(sound.bank)+1, tot_banks))
+        self.dump_send_win.sound_lbl.setText('{:03} {}/{}'.format(sound.prog+1, current, tot_sounds))
+        if not self.dump_verifier.active:
+            self.dump_send_win.progress.setValue(current)
+        self.dump_send_win.time.setText('{}:{:02}'.format(*divmod(int(dump_time)+1, 60)))
 
     def sound_request(self, bank, sound):
-        self.output_event(SysExEvent(1, [INIT, IDW, IDE, self.blofeld_id, SNDR, bank, sound, CHK, END]))
+        self.output_event(SoundRequestEvent(1, self.blofeld_id, bank, sound))
 
     def device_request(self):
         self.output_event(SysExEvent(1, [INIT, 0x7e, 0x7f, 0x6, 0x1, END]))
@@ -968,8 +997,15 @@ class BigglesworthObject(QtCore.QObject):
 
     def quit(self):
         if not self.closeDetect(): return
+        self.device_state.save()
+        self.output_stop()
         self.app.quit()
 
+    def output_stop(self):
+        #send what is still queued and wait for the output thread
+        self.output_queue.flush(force=True)
+        self.output_thread.stop()
+
 
 class Librarian(QtGui.QMainWindow):
     shown = QtCore.pyqtSignal()
@@ -991,7 +1027,6 @@ class Librarian(QtGui.QMainWindow):
         self.blofeld_model = self.main.blofeld_model
         self.blofeld_library = self.main.blofeld_library
         self.blofeld_current = self.main.blofeld_current
-        self.blofeld_model.itemChanged.connect(self.sound_update)
 
         self.loading_complete = False
         self.edit_mode = False
@@ -1068,7 +1103,7 @@ class Librarian(QtGui.QMainWindow):
         filter =  self.search_filter_chk.isChecked()
         if not text and not filter: return
         if not filter:
-            found = self.blofeld_model.findItems(text, QtCore.Qt.MatchContains, NAME)
+            found = self.blofeld_model.match(self.blofeld_model.index(0, NAME), QtCore.Qt.DisplayRole, text, 1, QtCore.Qt.MatchContains)
             if found:
                 self.blofeld_sounds_table.selectRow(found[0].row())
             return
@@ -1078,7 +1113,7 @@ class Librarian(QtGui.QMainWindow):
         if self.edit_mode: return
         behaviour = self.main.library_doubleclick
         if behaviour == 0: return
-        sound = self.blofeld_model.item(self.blofeld_model_proxy.mapToSource(index).row(), SOUND).data(SoundRole).toPyObject()
+        sound = self.blofeld_model.sound(self.blofeld_model_proxy.mapToSource(index))
         if behaviour == 1:
             self.program_change_request.emit(sound.bank, sound.prog)
         elif behaviour == 2:
@@ -1099,7 +1134,7 @@ class Librarian(QtGui.QMainWindow):
         if event.button() != QtCore.Qt.RightButton: return
         rows = set([self.blofeld_model_proxy.mapToSource(index).row() for index in self.blofeld_sounds_table.selectedIndexes()])
         index = self.blofeld_sounds_table.indexAt(event.pos())
-        sound = self.blofeld_model.item(self.blofeld_model_proxy.mapToSource(index).row(), SOUND).data(SoundRole).toPyObject()
+        sound = self.blofeld_model.sound(self.blofeld_model_proxy.mapToSource(index))
         menu = QtGui.QMenu()
         menu.setSeparatorsCollapsible(False)
         header = QtGui.QAction(sound.name, menu)
@@ -1130,7 +1165,7 @@ class Librarian(QtGui.QMainWindow):
         elif res == edit_item:
             self.activate_editor.emit(sound.bank, sound.prog)
         elif res == summary_item:
-            self.summary_request.emit(sound)
+            self.summary_request.emit(sound.copy())
         elif res == dump_request_item:
             self.dump_request.emit((sound.bank, sound.prog))
         elif res == dump_send_item:
@@ -1141,8 +1176,8 @@ class Librarian(QtGui.QMainWindow):
             if not res == QtGui.QMessageBox.Ok: return
             self.dump_send.emit(sound)
         elif rows > 1 and res == dump_bulk_send_item:
-            first = self.blofeld_model.item(min(rows), SOUND).data(SoundRole).toPyObject()
-            last = self.blofeld_model.item(max(rows), SOUND).data(SoundRole).toPyObject()
+            first = self.blofeld_model.sounds[min(rows)]
+            last = self.blofeld_model.sounds[max(rows)]
             res = QtGui.QMessageBox.question(self, 'Dump selected sounds',
                                              'You are going to send a sound dump to the Blofeld for locations "{}{:03}" through "{}{:03}".\nThis action cannot be undone. Do you want to proceed?'.format(uppercase[first.bank], first.prog+1, uppercase[last.bank], last.prog+1), 
                                              QtGui.QMessageBox.Ok|QtGui.QMessageBox.Cancel
@@ -1156,9 +1191,7 @@ class Librarian(QtGui.QMainWindow):
             last = max(sound_range)
             for row in range(first, last+1):
                 bank, prog = divmod(row, 128)
-                self.blofeld_model.item(row, BANK).setText(uppercase[bank])
-                self.blofeld_model.item(row, PROG).setText('{:03}'.format(prog+1))
-                sound = self.blofeld_model.item(row, SOUND).data(SoundRole).toPyObject()
+                sound = self.blofeld_model.sounds[row]
                 sound.bank = bank
                 sound.prog = prog
         drop_pos = self.blofeld_sounds_table.dropIndicatorPosition()
@@ -1173,8 +1206,7 @@ class Librarian(QtGui.QMainWindow):
                     target = 127 + current_bank * 128
             else:
                 target = self.blofeld_model_proxy.mapToSource(self.blofeld_sounds_table.indexAt(event.pos())).row()
-            items = self.blofeld_model.takeRow(source)
-            self.blofeld_model.insertRow(target, items)
+            if not self.blofeld_model.moveRows(source, source, target): return
             rename((source, target))
             self.blofeld_library.swap((source, ), target)
         else:
@@ -1187,11 +1219,7 @@ class Librarian(QtGui.QMainWindow):
             else:
                 target = self.blofeld_model_proxy.mapToSource(self.blofeld_sounds_table.indexAt(event.pos())).row()
                 if target in rows: return
-            first = min(rows)
-            before = True if target < first else False
-            for d in range(max(rows)+1-first):
-                items = self.blofeld_model.takeRow(first if not before else first+d)
-                self.blofeld_model.insertRow(target if not before else target+d, items)
+            if not self.blofeld_model.moveRows(min(rows), max(rows), target): return
             rename((target, )+tuple(rows))
             self.blofeld_library.swap(rows, target)
 
@@ -1199,15 +1227,6 @@ class Librarian(QtGui.QMainWindow):
 #        self.blofeld_model.sort(1)
 
 
-    def sound_update(self, item, _=None):
-        if item.column() == STATUS:
-            status = item.data(EditedRole).toPyObject()
-            item.setText(get_status(status))
-            setBold(item, True if status!=STORED else False)
-#        elif item.column() == NAME:
-#            sound = self.blofeld_model.item(item.row(), SOUND).data(SoundRole).toPyObject()
-#            sound.name = item.text()
-
     def dump_request_create(self):
         bank = self.bank_dump_combo.currentIndex()
         sound = self.sound_dump_combo.currentIndex()
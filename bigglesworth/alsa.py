@@ -1,8 +1,14 @@
+import select
 from PyQt4 import QtCore
 from pyalsa import alsaseq
 
 from const import ALSA
 from midiutils import *
+from codec import WAVE_MSG_SIZE
+
+#poll timeout (ms), it only limits how long stopping the device takes
+POLL_TIMEOUT = 100
+MAX_EVENTS = 256
 
 
 class MidiDevice(QtCore.QObject):
@@ -14,13 +20,16 @@ class MidiDevice(QtCore.QObject):
     graph_changed = QtCore.pyqtSignal()
     stopped = QtCore.pyqtSignal()
     midi_event = QtCore.pyqtSignal(object)
+    midi_events = QtCore.pyqtSignal(object)
 
     def __init__(self, main):
         QtCore.QObject.__init__(self)
         self.main = main
         self.type = ALSA
         self.active = False
-        self.sysex_buffer = []
+        #reassembly buffer for split sysex messages, sized for the largest one (WTBD)
+        self.sysex_buffer = bytearray(WAVE_MSG_SIZE)
+        self.sysex_size = 0
         self.seq = alsaseq.Sequencer(clientname='Bigglesworth')
         self.keep_going = True
         input_id = self.seq.create_simple_port(
@@ -50,60 +59,74 @@ class MidiDevice(QtCore.QObject):
 
     def run(self):
         self.active = True
+        poller = select.poll()
+        self.seq.registerpoll(poller, input=True)
         while self.keep_going:
+            #drain everything pending, received events are sent with a single signal
+            batch = []
             try:
-                event_list = self.seq.receive_events(timeout=1024, maxevents=1)
-                for event in event_list:
-                    data = event.get_data()
-                    if event.type == alsaseq.SEQ_EVENT_CLIENT_START:
-                        self.graph.client_created(data)
-                    elif event.type == alsaseq.SEQ_EVENT_CLIENT_EXIT:
-                        self.graph.client_destroyed(data)
-                    elif event.type == alsaseq.SEQ_EVENT_PORT_START:
-                        self.graph.port_created(data)
-                    elif event.type == alsaseq.SEQ_EVENT_PORT_EXIT:
-                        self.graph.port_destroyed(data)
-                    elif event.type == alsaseq.SEQ_EVENT_PORT_SUBSCRIBED:
-                        self.graph.conn_created(data)
-                    elif event.type == alsaseq.SEQ_EVENT_PORT_UNSUBSCRIBED:
-                        self.graph.conn_destroyed(data)
-                    elif event.type in [alsaseq.SEQ_EVENT_NOTEON, alsaseq.SEQ_EVENT_NOTEOFF, 
-                                        alsaseq.SEQ_EVENT_CONTROLLER, alsaseq.SEQ_EVENT_PGMCHANGE,
-                                        ]:
-                        try:
-                            newev = MidiEvent.from_alsa(event)
-                            self.midi_event.emit(newev)
-#                            print newev
-                        except Exception as e:
-                            print 'event {} unrecognized'.format(event)
-                            print e
-                    elif event.type in [alsaseq.SEQ_EVENT_CLOCK, alsaseq.SEQ_EVENT_SENSING]:
-                        pass
-                    elif event.type == alsaseq.SEQ_EVENT_SYSEX:
-                        self.check(event)
+                if not poller.poll(POLL_TIMEOUT):
+                    continue
+                while True:
+                    event_list = self.seq.receive_events(timeout=0, maxevents=MAX_EVENTS)
+                    for event in event_list:
+                        self.process(event, batch)
+                    if len(event_list) < MAX_EVENTS:
+                        break
             except Exception as e:
                 print e
                 print 'something is wrong'
+            if batch:
+                self.midi_events.emit(batch)
 #        print 'stopped'
         print 'exit'
         del self.seq
         self.stopped.emit()
 
+    def process(self, event, batch):
+        if event.type == alsaseq.SEQ_EVENT_CLIENT_START:
+            self.graph.client_created(event.get_data())
+        elif event.type == alsaseq.SEQ_EVENT_CLIENT_EXIT:
+            self.graph.client_destroyed(event.get_data())
+        elif event.type == alsaseq.SEQ_EVENT_PORT_START:
+            self.graph.port_created(event.get_data())
+        elif event.type == alsaseq.SEQ_EVENT_PORT_EXIT:
+            self.graph.port_destroyed(event.get_data())
+        elif event.type == alsaseq.SEQ_EVENT_PORT_SUBSCRIBED:
+            self.graph.conn_created(event.get_data())
+        elif event.type == alsaseq.SEQ_EVENT_PORT_UNSUBSCRIBED:
+            self.graph.conn_destroyed(event.get_data())
+        elif event.type in [alsaseq.SEQ_EVENT_NOTEON, alsaseq.SEQ_EVENT_NOTEOFF, 
+                            alsaseq.SEQ_EVENT_CONTROLLER, alsaseq.SEQ_EVENT_PGMCHANGE,
+                            ]:
+            try:
+                batch.append(MidiEvent.from_alsa(event))
+            except Exception as e:
+                print 'event {} unrecognized'.format(event)
+                print e
+        elif event.type in [alsaseq.SEQ_EVENT_CLOCK, alsaseq.SEQ_EVENT_SENSING]:
+            pass
+        elif event.type == alsaseq.SEQ_EVENT_SYSEX:
+            sysex = self.check(event)
+            if sysex is not None:
+                batch.append(sysex)
+
     def check(self, event):
         data = event.get_data()['ext']
         try:
             if data[0] == 0xf0:
-                self.buffer = data
-            else:
-                self.buffer.extend(data)
-#            print 'sysex message length: {}'.format(len(self.buffer))
+                self.sysex_size = 0
+            start = self.sysex_size
+            self.sysex_size += len(data)
+            #longer messages just grow the buffer
+            self.sysex_buffer[start:self.sysex_size] = data
+#            print 'sysex message length: {}'.format(self.sysex_size)
             if data[-1] != 0xf7:
                 return
-            else:
-                sysex = MidiEvent.from_alsa(event)
-                sysex.sysex = self.buffer
-                self.midi_event.emit(sysex)
-                self.buffer = []
+            #the message gets its own copy, the buffer is overwritten by the next one
+            sysex = SysExMessage(buffer(self.sysex_buffer, 0, self.sysex_size))
+            self.sysex_size = 0
+            return MidiEvent(SYSEX, port=int(event.dest[1]), sysex=sysex, source=tuple(map(int, event.source)), backend='alsa')
         except Exception as Err:
-            print len(self.buffer)
+            print self.sysex_size
             print Err
@@ -8,6 +8,8 @@ import simplejson
 from uuid import uuid4
 from os import path, makedirs
 from itertools import chain
+from bisect import bisect_left, bisect_right
+from array import array
 from shutil import copy
 from string import uppercase, ascii_letters
 from PyQt4 import QtCore, QtGui
@@ -15,10 +17,11 @@ from PyQt4 import QtCore, QtGui
 from bigglesworth.libs import midifile
 from bigglesworth.libs import markdown2
 from bigglesworth.const import *
+from bigglesworth.utils import get_status
+from bigglesworth.codec import SOUND_DATA_SIZE, decode_sound, decode_wavetable, encode_wavetable
+from bigglesworth.libfile import LIBRARY_FILE, LibraryFile, LibraryRecord, PresetCache, parse_preset
 from bigglesworth.version import *
 
-pow21 = 2**21
-
 class VersionRequest(QtCore.QObject):
     release_url = 'https://api.github.com/repos/MaurizioB/Bigglesworth/releases'
     res = QtCore.pyqtSignal(object)
@@ -144,16 +147,7 @@ class VersionRequest(QtCore.QObject):
 class Wavetable(QtCore.QObject):
     def __init__(self, data):
         QtCore.QObject.__init__(self)
-        self.splitted_values = []
-        for w in xrange(64):
-            data_iter = iter(data[w * 410 + 8:w * 410 + 392])
-            values = []
-            for s in xrange(128):
-                value = (data_iter.next() << 14) + (data_iter.next() << 7) + data_iter.next()
-                if value >= 1048576:
-                    value -= 2097152
-                values.append(value)
-            self.splitted_values.append(values)
+        self.splitted_values = decode_wavetable(data)
         self.slot = data[5]
         self.name = ''.join([str(unichr(l)) if l!=127 else '°' for l in data[392:406]])
 
@@ -213,8 +207,15 @@ class Sound(QtCore.QObject):
             self.source = SRC_LIBRARY
             self._state = EMPTY
 
+        self._store = None
+        self._slot = None
         self._done = True
 
+    def bind(self, store, slot):
+        #writes to a bound sound are reflected to its SoundBank record
+        self._store = store
+        self._slot = slot
+
     def checkout(self):
         invalid = []
         for i, (param, value) in enumerate(zip(Params, self._data)):
@@ -261,6 +262,8 @@ class Sound(QtCore.QObject):
                 if 363 <= index <= 378:
                     self.name_reload()
                 self._state = self._state|EDITED
+                if self._store is not None:
+                    self._store.update(self._slot, index, value)
                 self.edited.emit(self._state)
             except Exception as Err:
 #                print Err
@@ -279,6 +282,8 @@ class Sound(QtCore.QObject):
     def state(self, state):
 #        print 'old state: {}\nnew state: {}'.format(self.state, state)
         self._state = self._state|state
+        if self._store is not None:
+            self._store.setState(self._slot, state)
         self.edited.emit(self._state)
 
     @property
@@ -290,6 +295,8 @@ class Sound(QtCore.QObject):
         self._bank = bank
         self.bankChanged.emit(bank)
         self.indexChanged.emit(self.index)
+        if self._store is not None:
+            self._store.move(self._slot, self._bank, self._prog)
         self.state = MOVED
 
     @property
@@ -301,6 +308,8 @@ class Sound(QtCore.QObject):
         self._prog = prog
         self.progChanged.emit(prog)
         self.indexChanged.emit(self.index)
+        if self._store is not None:
+            self._store.move(self._slot, self._bank, self._prog)
         self.state = MOVED
 
     @property
@@ -318,7 +327,13 @@ class Sound(QtCore.QObject):
         if len(name) > 16:
             name = name[:16]
         else:
-            name.ljust(16, ' ')
+            name = name.ljust(16, ' ')
+        if self._store is not None:
+            #the store updates the name and state of this sound too
+            self._store.setName(self._slot, name)
+            self.nameChanged.emit(self._name)
+            self.edited.emit(self._state)
+            return
         self._name = name
         self.data[363:379] = [ord(l) for l in name]
         self.nameChanged.emit(name)
@@ -338,6 +353,8 @@ class Sound(QtCore.QObject):
     @cat.setter
     def cat(self, cat):
         self._cat = cat
+        if self._store is not None:
+            self._store.update(self._slot, 379, cat)
         self.catChanged.emit(cat)
         self.state = EDITED
 
@@ -350,27 +367,325 @@ class Sound(QtCore.QObject):
         self._data = data
 
 
+class SoundView(object):
+    '''A lightweight read/write accessor to a SoundBank record.'''
+    __slots__ = ('store', 'slot')
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    def __getattr__(self, attr):
+        try:
+            return self.store.value(self.slot, Params.index_from_attr(attr))
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def index(self):
+        return self.store.locations[self.slot]
+
+    @property
+    def bank(self):
+        return self.store.locations[self.slot] >> 7
+
+    @bank.setter
+    def bank(self, bank):
+        self.store.move(self.slot, bank, self.prog)
+
+    @property
+    def prog(self):
+        return self.store.locations[self.slot] & 127
+
+    @prog.setter
+    def prog(self, prog):
+        self.store.move(self.slot, self.bank, prog)
+
+    @property
+    def name(self):
+        return self.store.name(self.slot)
+
+    @name.setter
+    def name(self, name):
+        name = name.replace('\xc2\xb0', '\x7f')[:16].ljust(16, ' ')
+        if name == self.name: return
+        self.store.setName(self.slot, name)
+
+    @property
+    def cat(self):
+        return self.store.cat(self.slot)
+
+    @cat.setter
+    def cat(self, cat):
+        self.store.update(self.slot, 379, cat)
+
+    @property
+    def state(self):
+        return self.store.states[self.slot]
+
+    @state.setter
+    def state(self, state):
+        self.store.setState(self.slot, state)
+
+    @property
+    def source(self):
+        return self.store.sources[self.slot]
+
+    @property
+    def data(self):
+        return list(self.store.record(self.slot))
+
+    @property
+    def sound(self):
+        return self.store.sound(self.slot)
+
+    def copy(self):
+        return Sound([self.bank, self.prog] + self.data, self.source)
+
+
+class SoundBank(QtCore.QObject):
+    '''Contiguous storage for the sound parameters of a whole library.
+
+    Each slot is a 383 bytes record in a single bytearray; location (bank * 128 + prog),
+    state and source are kept in parallel arrays, so that a slot is not bound to its
+    current location. QObject Sound wrappers are only created on request (i.e. while
+    a sound is edited) and write their changes back to the store.
+    Slots whose data (EDITED) or location (MOVED) changed since the last save are
+    collected in the dirty and moved sets.'''
+    nameChanged = QtCore.pyqtSignal(int, str)
+    catChanged = QtCore.pyqtSignal(int, int)
+    locationChanged = QtCore.pyqtSignal(int, int)
+    edited = QtCore.pyqtSignal(int, int)
+
+    record_size = SOUND_DATA_SIZE
+
+    def __init__(self, slots=1024, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.clear(slots)
+
+    def clear(self, slots=None):
+        if slots is not None:
+            self.slots = slots
+        self.count = 0
+        self.data = bytearray(self.slots * self.record_size)
+        self.states = bytearray(self.slots)
+        self.sources = bytearray(self.slots)
+        self.locations = array('H', [0]) * self.slots
+        self.sounds = {}
+        self.dirty = set()
+        self.moved = set()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for slot in xrange(self.count):
+            yield SoundView(self, slot)
+
+    def __getitem__(self, slot):
+        if not 0 <= slot < self.count:
+            raise IndexError('Slot {} does not exist'.format(slot))
+        return SoundView(self, slot)
+
+    def _grow(self):
+        grow = self.slots
+        self.data.extend(bytearray(grow * self.record_size))
+        self.states.extend(bytearray(grow))
+        self.sources.extend(bytearray(grow))
+        self.locations.extend(array('H', [0]) * grow)
+        self.slots += grow
+
+    def allocate(self, data, bank, prog, state=STORED, source=SRC_LIBRARY):
+        if self.count == self.slots:
+            self._grow()
+        slot = self.count
+        self.count += 1
+        self.locations[slot] = bank * 128 + prog
+        self.write(slot, data, state, source)
+        return SoundView(self, slot)
+
+    def write(self, slot, data, state=STORED, source=SRC_LIBRARY):
+        pos = slot * self.record_size
+        record = bytearray(data)
+        if len(record) != self.record_size:
+            raise ValueError('Sound data has to be {} bytes long'.format(self.record_size))
+        self.data[pos:pos + self.record_size] = record
+        self.states[slot] = state
+        self.sources[slot] = source
+        self.dirty.add(slot)
+        sound = self.sounds.get(slot)
+        if sound is not None:
+            sound._data[:] = record
+            sound._state = state
+            sound._cat = self.cat(slot)
+            sound.name_reload()
+
+    def record(self, slot):
+        pos = slot * self.record_size
+        return self.data[pos:pos + self.record_size]
+
+    def value(self, slot, index):
+        return self.data[slot * self.record_size + index]
+
+    def name(self, slot):
+        pos = slot * self.record_size + 363
+        return ''.join([str(unichr(l)) if l != 127 else u'°' for l in self.data[pos:pos + 16]])
+
+    def cat(self, slot):
+        cat = self.data[slot * self.record_size + 379]
+        return cat if cat < len(categories) else len(categories) - 1
+
+    def update(self, slot, index, value):
+        self.data[slot * self.record_size + index] = value
+        sound = self.sounds.get(slot)
+        if sound is not None and sound._data[index] != value:
+            sound._data[index] = value
+            if 363 <= index <= 378:
+                sound.name_reload()
+            elif index == 379:
+                sound._cat = self.cat(slot)
+        if 363 <= index <= 378:
+            self.nameChanged.emit(slot, self.name(slot))
+        elif index == 379:
+            self.catChanged.emit(slot, self.cat(slot))
+        self.setState(slot, EDITED)
+
+    def setName(self, slot, name):
+        pos = slot * self.record_size + 363
+        self.data[pos:pos + 16] = bytearray([ord(l) for l in name])
+        sound = self.sounds.get(slot)
+        if sound is not None:
+            sound._data[363:379] = self.data[pos:pos + 16]
+            sound.name_reload()
+        self.nameChanged.emit(slot, self.name(slot))
+        self.setState(slot, EDITED)
+
+    def setState(self, slot, state):
+        if state & EDITED:
+            self.dirty.add(slot)
+        if state & MOVED:
+            self.moved.add(slot)
+        self.states[slot] |= state
+        sound = self.sounds.get(slot)
+        if sound is not None:
+            sound._state |= state
+        self.edited.emit(slot, self.states[slot])
+
+    def move(self, slot, bank, prog):
+        index = bank * 128 + prog
+        if self.locations[slot] == index: return
+        self.locations[slot] = index
+        sound = self.sounds.get(slot)
+        if sound is not None:
+            sound._bank, sound._prog = bank, prog
+        self.locationChanged.emit(slot, index)
+        self.setState(slot, MOVED)
+
+    def copy(self, source, target):
+        size = self.record_size
+        self.write(target, self.data[source * size:(source + 1) * size], self.states[source], self.sources[source])
+
+    def compare(self, first, second):
+        size = self.record_size
+        return self.data[first * size:(first + 1) * size] == self.data[second * size:(second + 1) * size]
+
+    def clean(self):
+        #called after saving, changed slots lose their EDITED/MOVED flags but keep their source
+        for slot in self.dirty | self.moved:
+            state = self.states[slot] & ~(EDITED|MOVED) | STORED
+            if self.states[slot] == state: continue
+            self.states[slot] = state
+            sound = self.sounds.get(slot)
+            if sound is not None:
+                sound._state = state
+            self.edited.emit(slot, state)
+        self.dirty.clear()
+        self.moved.clear()
+
+    def sound(self, slot):
+        sound = self.sounds.get(slot)
+        if sound is None:
+            index = self.locations[slot]
+            sound = Sound([index >> 7, index & 127] + list(self.record(slot)), self.sources[slot])
+            sound._state = self.states[slot]
+            sound.bind(self, slot)
+            self.sounds[slot] = sound
+        return sound
+
+    def release(self, slot=None):
+        if slot is None:
+            self.sounds = {}
+        else:
+            self.sounds.pop(slot, None)
+
+
 class SortedLibrary(object):
+    '''Library sounds sorted by category (location order) and by name; lists are kept
+    sorted with bisect, along with a parallel list of sort keys.'''
     def __init__(self, library):
-        self.by_bank = library.data
+        self.library = library
+        self.clear()
+
+    @property
+    def by_bank(self):
+        return self.library.data
+
+    def clear(self):
         self.by_cat = {i: [] for i in range(len(categories))}
         self.by_alpha = {l: [] for l in ['0..9']+list(uppercase)}
+        self.cat_keys = {i: [] for i in range(len(categories))}
+        self.alpha_keys = {l: [] for l in ['0..9']+list(uppercase)}
+        self.keys = {}
+
+    def _entry(self, sound):
+        name = sound.name
+        alpha = name[0].upper() if name[0] in ascii_letters else '0..9'
+        return sound.cat, (sound.index, sound.slot), alpha, (name.lower(), sound.slot)
 
     def reload(self):
+        self.clear()
         by_cat = {i: [] for i in range(len(categories))}
         by_alpha = {l: [] for l in ['0..9']+list(uppercase)}
-        for b, progs in enumerate(self.by_bank):
-            for p in progs:
-                if p is None: continue
-                if p.name[0] in ascii_letters:
-                    by_alpha[p.name[0].upper()].append(p)
-                else:
-                    by_alpha['0..9'].append(p)
-                by_cat[p.cat].append(p)
-        self.by_cat = by_cat
-        self.by_alpha = {}
+        for progs in self.by_bank:
+            for sound in progs:
+                if sound is None: continue
+                entry = self._entry(sound)
+                self.keys[sound.slot] = entry
+                by_cat[entry[0]].append((entry[1], sound))
+                by_alpha[entry[2]].append((entry[3], sound))
+        for cat, sound_list in by_cat.items():
+            sound_list.sort(key=lambda item: item[0])
+            self.cat_keys[cat] = [key for key, sound in sound_list]
+            self.by_cat[cat] = [sound for key, sound in sound_list]
         for letter, sound_list in by_alpha.items():
-            self.by_alpha[letter] = sorted(sound_list, key=lambda s: s.name.lower())
+            sound_list.sort(key=lambda item: item[0])
+            self.alpha_keys[letter] = [key for key, sound in sound_list]
+            self.by_alpha[letter] = [sound for key, sound in sound_list]
+
+    def add(self, sound):
+        entry = cat, cat_key, alpha, alpha_key = self._entry(sound)
+        self.keys[sound.slot] = entry
+        pos = bisect_right(self.cat_keys[cat], cat_key)
+        self.cat_keys[cat].insert(pos, cat_key)
+        self.by_cat[cat].insert(pos, sound)
+        pos = bisect_right(self.alpha_keys[alpha], alpha_key)
+        self.alpha_keys[alpha].insert(pos, alpha_key)
+        self.by_alpha[alpha].insert(pos, sound)
+        return entry
+
+    def remove(self, slot):
+        entry = self.keys.pop(slot, None)
+        if entry is None:
+            return None
+        cat, cat_key, alpha, alpha_key = entry
+        pos = bisect_left(self.cat_keys[cat], cat_key)
+        del self.cat_keys[cat][pos], self.by_cat[cat][pos]
+        pos = bisect_left(self.alpha_keys[alpha], alpha_key)
+        del self.alpha_keys[alpha][pos], self.by_alpha[alpha][pos]
+        return entry
 
 
 class WavetableLibrary(QtCore.QObject):
@@ -466,17 +781,8 @@ class WavetableLibrary(QtCore.QObject):
             uid_item = self.model.findItems(uid, QtCore.Qt.MatchExactly, 4)[0]
             wavetable_path = self.model.item(uid_item.row(), 3).data().toPyObject().absoluteFilePath()
             with open(str(wavetable_path.toUtf8()), 'rb') as sf:
-                sysex_list = list(ord(i) for i in sf.read())
-            wavetable_values = []
-            for w in xrange(64):
-                data = iter(sysex_list[w * 410 + 8:w * 410 + 392])
-                values = []
-                for s in xrange(128):
-                    value = (data.next() << 14) + (data.next() << 7) + data.next()
-                    if value >= 1048576:
-                        value -= 2097152
-                    values.append(value)
-                wavetable_values.append(values)
+                sysex_list = bytearray(sf.read())
+            wavetable_values = decode_wavetable(sysex_list)
             slot = sysex_list[5]
             name = ''.join([str(unichr(l)) for l in sysex_list[392:406]])
             self.wavetable_data[uid] = wavetable_values, slot, name
@@ -506,24 +812,8 @@ class WavetableLibrary(QtCore.QObject):
 
         name = str(name.toUtf8())
         name_data = tuple(ord(l) if l != '°' else 127 for l in name.replace('\xc2\xb0', '\x7f').ljust(14, ' '))
-        sysex_data = []
-        values_iter = iter(wavetable_values)
-        wavetable_data_list = []
-        for n in xrange(64):
-            sysex_data.extend([INIT, IDW, IDE, self.main.blofeld_id, WTBD, slot, n, 0])
-            values = []
-            for i in xrange(128):
-                value = values_iter.next()
-                values.append(value)
-                if value < 0:
-                    value = pow21 + value
-                sysex_data.extend((value >> 14, (value >> 7) & 127,  value & 127))
-            wavetable_data_list.append(values)
-            sysex_data.extend(name_data)
-            sysex_data.extend((0, 0, CHK))
-            sysex_data.append(END)
-
-        self.wavetable_data[uid] = wavetable_data_list, slot, name
+        sysex_data = encode_wavetable(wavetable_values, slot, name_data, self.main.blofeld_id)
+        self.wavetable_data[uid] = decode_wavetable(sysex_data), slot, name
 
         file_name = self.sanitize(name)
 #        for char in set(file_name) & set('<>:"/\|?*'):
@@ -531,7 +821,7 @@ class WavetableLibrary(QtCore.QObject):
         old_file = file_item.data().toPyObject()
         wavetable_filepath = '{}/{}.syx'.format(old_file.absolutePath().toUtf8(), file_name.ljust(14, '_'))
         with open(wavetable_filepath, 'wb') as sf:
-            sf.write(bytearray(sysex_data))
+            sf.write(sysex_data)
         if original_name is not None and original_name != name:
             QtCore.QDir().remove(old_file.absoluteFilePath())
         file_info = QtCore.QFileInfo(wavetable_filepath)
@@ -546,71 +836,91 @@ class Library(QtCore.QObject):
 #        self.data = [[Sound(b, p) for p in range(128)] for b in range(banks)]
         self.model = model
         self.banks = banks
+        self.store = SoundBank(parent=self)
+        self.model.setStore(self.store)
+        self.store.nameChanged.connect(lambda slot, name: self.soundChanged(slot))
+        self.store.catChanged.connect(lambda slot, cat: self.soundChanged(slot))
+        self.store.locationChanged.connect(lambda slot, index: self.soundChanged(slot))
         self.model.cleared.connect(self.clear)
-        self.clear()
+        self.file = None
         self.sorted = SortedLibrary(self)
         self.menu = None
+        self.menu_dirty = set()
+        self.clear()
 #        self.create_menu()
 
     def clear(self):
         self.data = [[None for p in range(128)] for b in range(self.banks)]
 #        self.sound_index = {}
         self.cat_count = [{c: 0 for c in categories} for b in range(self.banks)]
+        self.store.clear()
+        self.sorted.clear()
+        self.menu = None
+        #store slots are no longer bound to the file records
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
     def sound(self, bank, prog):
         return self.data[bank][prog]
 
+    def edit(self, req):
+        sound = self[req]
+        if sound is None:
+            return None
+        #only the sound currently edited keeps its QObject wrapper
+        self.store.release()
+        return sound.sound
+
     def _addSound(self, sound):
+        #returns the new library sound, or None if an existing sound has been replaced
         bank = sound.bank
         prog = sound.prog
+        previous = self.data[bank][prog]
+        if previous is not None:
+            self.store.locations[previous.slot] = bank * 128 + prog
+            self.store.write(previous.slot, sound.data, sound.state, sound.source)
+            self.model.updateSound(previous.slot)
+            self.soundChanged(previous.slot)
+            return
+        sound = self.store.allocate(sound.data, bank, prog, sound.state, sound.source)
         self.data[bank][prog] = sound
 #        self.sound_index[sound] = bank, prog
-
-        index_item = QtGui.QStandardItem('{}{:03}'.format(uppercase[bank], prog+1))
-        index_item.setData(bank*128+prog, IndexRole)
-        index_item.setEditable(False)
-        bank_item = QtGui.QStandardItem(uppercase[bank])
-#        bank_item.setData(bank, UserRole)
-        bank_item.setData(bank, BankRole)
-        bank_item.setTextAlignment(QtCore.Qt.AlignRight|QtCore.Qt.AlignCenter)
-        bank_item.setEditable(False)
-        prog_item = QtGui.QStandardItem('{:03}'.format(prog+1))
-#        prog_item.setData(prog, UserRole)
-        prog_item.setData(prog, ProgRole)
-        prog_item.setEditable(False)
-        name_item = QtGui.QStandardItem(sound.name)
-#        name_item.setData(sound.Osc_1_Shape, QtCore.Qt.ToolTipRole)
-#        name_item.setData(sound.name, QtCore.Qt.ToolTipRole)
-        cat_item = QtGui.QStandardItem(categories[sound.cat])
-#        cat_item.setData(sound.cat, UserRole)
-        cat_item.setData(sound.cat, CatRole)
-#        status_item = QtGui.QStandardItem('Dumped' if sound.state == DUMPED else 'Stored')
-        status_item = QtGui.QStandardItem(status_dict[sound.state])
-        status_item.setData(sound.state, EditedRole)
-        status_item.setEditable(False)
-        sound_item = QtGui.QStandardItem()
-        sound_item.setData(sound, SoundRole)
-        sound.bankChanged.connect(lambda bank, item=bank_item: item.setData(bank, BankRole))
-        sound.progChanged.connect(lambda prog, item=prog_item: item.setData(prog, ProgRole))
-        sound.indexChanged.connect(lambda index, item=index_item: item.setData(index, IndexRole))
-        sound.nameChanged.connect(lambda name, item=name_item: item.setText(name))
-        sound.catChanged.connect(lambda cat, bank=bank, item=cat_item: self.soundSetCategory(item, bank, cat))
-        sound.edited.connect(lambda state, item=status_item: item.setData(state, EditedRole))
-
-        found = self.model.findItems('{}{:03}'.format(uppercase[bank], prog+1), QtCore.Qt.MatchFixedString, 0)
-        if found:
-            self.model.takeRow(found[0].row())
-
-        self.model.appendRow([index_item, bank_item, prog_item, name_item, cat_item, status_item, sound_item])
+        return sound
+
+    def save(self, file_path):
+        #library slots are saved in store order, so that each slot matches its file record
+        if self.file is None or self.file.path != file_path or not self.file.isOpen or \
+                self.store.count > self.file.capacity:
+            if self.file is not None:
+                self.file.close()
+            self.file = LibraryFile(file_path)
+            self.file.create(self.store)
+        else:
+            store = self.store
+            new = xrange(len(self.file), store.count)
+            for slot in sorted(store.dirty.union(new)):
+                self.file.write(slot, store.locations[slot] >> 7, store.locations[slot] & 127, store.record(slot))
+            for slot in store.moved.difference(store.dirty, new):
+                self.file.move(slot, store.locations[slot] >> 7, store.locations[slot] & 127)
+            self.file.flush()
+        self.store.clean()
 
     def addSound(self, sound):
-        self._addSound(sound)
-        self.sort()
-        self.create_menu()
+        sound = self._addSound(sound)
+        if sound:
+            self.model.addSound(sound)
+            self.setMenuDirty(self.sorted.add(sound))
+        if self.menu is None:
+            self.create_menu()
 
     def addSoundBulk(self, sound_list):
+        sounds = []
         for sound in sound_list:
-            self._addSound(sound)
+            sound = self._addSound(sound)
+            if sound:
+                sounds.append(sound)
+        self.model.addSounds(sounds)
         self.sort()
         if self.menu:
             self.create_menu()
@@ -623,8 +933,6 @@ class Library(QtCore.QObject):
         for empty in reversed(delete_list):
             self.data.pop(empty)
         self.banks = len(self.data)
-        self.model.sort(PROG)
-        self.model.sort(BANK)
         self.sorted.reload()
 
     def swap(self, source, target):
@@ -650,9 +958,19 @@ class Library(QtCore.QObject):
             for b in range(len(self.data)):
                 delta = b*128
                 self.data[b] = full[delta:delta+128]
-        self.sorted.reload()
+
+    def soundChanged(self, slot):
+        old = self.sorted.remove(slot)
+        if old is None: return
+        self.setMenuDirty(old, self.sorted.add(self.store[slot]))
+
+    def setMenuDirty(self, *entries):
+        #entries are SortedLibrary keys: cat, (index, slot), alpha, (name, slot)
+        for cat, (index, slot), alpha, name in entries:
+            self.menu_dirty.update((('bank', index >> 7), ('cat', cat), ('alpha', alpha)))
 
     def create_menu(self):
+        #submenus are only filled when shown, and again only if their sounds changed
         del self.menu
         menu = QtGui.QMenu()
         by_bank = QtGui.QMenu('By bank', menu)
@@ -661,43 +979,53 @@ class Library(QtCore.QObject):
             if not any(bank): continue
             bank_menu = QtGui.QMenu(uppercase[id], by_bank)
             by_bank.addMenu(bank_menu)
-            for sound in bank:
-                if sound is None: continue
-                item = QtGui.QAction('{:03} {}'.format(sound.prog+1, sound.name), bank_menu)
-                item.setData((sound.bank, sound.prog))
-                bank_menu.addAction(item)
+            bank_menu.aboutToShow.connect(lambda bank_menu=bank_menu, id=id: self.fill_menu(bank_menu, ('bank', id)))
+            self.menu_dirty.add(('bank', id))
         by_cat = QtGui.QMenu('By category', menu)
         menu.addMenu(by_cat)
         for cid, cat in enumerate(categories):
             cat_menu = QtGui.QMenu(by_cat)
             by_cat.addMenu(cat_menu)
-            cat_len = 0
-            for sound in self.sorted.by_cat[cid]:
-                cat_len += 1
-                item = QtGui.QAction(sound.name, cat_menu)
-                item.setData((sound.bank, sound.prog))
-                cat_menu.addAction(item)
-            if not len(cat_menu.actions()):
-                cat_menu.setEnabled(False)
-            cat_menu.setTitle('{} ({})'.format(cat, cat_len))
+            cat_menu.aboutToShow.connect(lambda cat_menu=cat_menu, cid=cid: self.fill_menu(cat_menu, ('cat', cid)))
+            self.menu_dirty.add(('cat', cid))
+        cat_keys = list(enumerate(categories))
+        by_cat.aboutToShow.connect(lambda: self.update_menu_titles(by_cat, cat_keys, self.sorted.by_cat))
+        self.update_menu_titles(by_cat, cat_keys, self.sorted.by_cat)
         by_alpha = QtGui.QMenu('Alphabetical', menu)
         menu.addMenu(by_alpha)
-        for alpha in sorted(self.sorted.by_alpha.keys()):
+        alpha_list = sorted(self.sorted.by_alpha.keys())
+        for alpha in alpha_list:
             alpha_menu = QtGui.QMenu(by_alpha)
             by_alpha.addMenu(alpha_menu)
-            alpha_len = 0
-            for sound in self.sorted.by_alpha[alpha]:
-                alpha_len += 1
-                item = QtGui.QAction(sound.name, alpha_menu)
-                item.setData((sound.bank, sound.prog))
-                alpha_menu.addAction(item)
-            if not len(alpha_menu.actions()):
-                alpha_menu.setEnabled(False)
-            alpha_menu.setTitle('{} ({})'.format(alpha, alpha_len))
+            alpha_menu.aboutToShow.connect(lambda alpha_menu=alpha_menu, alpha=alpha: self.fill_menu(alpha_menu, ('alpha', alpha)))
+            self.menu_dirty.add(('alpha', alpha))
+        alpha_keys = zip(alpha_list, alpha_list)
+        by_alpha.aboutToShow.connect(lambda: self.update_menu_titles(by_alpha, alpha_keys, self.sorted.by_alpha))
+        self.update_menu_titles(by_alpha, alpha_keys, self.sorted.by_alpha)
         self.menu = menu
 
-    def soundSetCategory(self, cat_item, bank, cat):
-        cat_item.setData(cat, CatRole)
+    def update_menu_titles(self, menu, keys, sound_dict):
+        for action, (key, label) in zip(menu.actions(), keys):
+            sound_len = len(sound_dict[key])
+            action.menu().setTitle('{} ({})'.format(label, sound_len))
+            action.menu().setEnabled(True if sound_len else False)
+
+    def fill_menu(self, menu, key):
+        if key not in self.menu_dirty: return
+        self.menu_dirty.discard(key)
+        menu.clear()
+        group, id = key
+        if group == 'bank':
+            for sound in self.data[id]:
+                if sound is None: continue
+                item = QtGui.QAction('{:03} {}'.format(sound.prog+1, sound.name), menu)
+                item.setData((sound.bank, sound.prog))
+                menu.addAction(item)
+            return
+        for sound in self.sorted.by_cat[id] if group == 'cat' else self.sorted.by_alpha[id]:
+            item = QtGui.QAction(sound.name, menu)
+            item.setData((sound.bank, sound.prog))
+            menu.addAction(item)
 
     def __getitem__(self, req):
         if req is None:
@@ -710,20 +1038,254 @@ class Library(QtCore.QObject):
             return None
 
 
-class LibraryModel(QtGui.QStandardItemModel):
+class LibraryIndex(object):
+    '''Search index of the library sounds.
+
+    Sets of sounds are python ints with a bit for each store slot; names are indexed
+    by all their 1 to 3 characters grams, so that a filter is just a sequence of
+    bitwise ands, checked against the lowercase names only for longer texts.'''
+    gram_size = 3
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.all = 0
+        self.names = {}
+        self.grams = {}
+        self.values = {}
+        self.columns = {BANK: {}, CATEGORY: {}}
+        self.version = 0
+
+    def _grams(self, name):
+        grams = set()
+        for size in xrange(1, self.gram_size + 1):
+            for pos in xrange(len(name) - size + 1):
+                grams.add(name[pos:pos + size])
+        return grams
+
+    def add(self, slot, name, bank, cat):
+        self.all |= 1 << slot
+        self.setName(slot, name)
+        self.setValue(slot, BANK, bank)
+        self.setValue(slot, CATEGORY, cat)
+
+    def setName(self, slot, name):
+        bit = 1 << slot
+        name = unicode(name).lower()
+        old = self.names.get(slot)
+        if old == name: return
+        if old is not None:
+            for gram in self._grams(old):
+                self.grams[gram] &= ~bit
+        self.names[slot] = name
+        for gram in self._grams(name):
+            self.grams[gram] = self.grams.get(gram, 0) | bit
+        self.version += 1
+
+    def setValue(self, slot, column, value):
+        bit = 1 << slot
+        sets = self.columns[column]
+        old = self.values.get((slot, column))
+        if old == value: return
+        if old is not None:
+            sets[old] &= ~bit
+        self.values[slot, column] = value
+        sets[value] = sets.get(value, 0) | bit
+        self.version += 1
+
+    def match(self, column, value):
+        return self.columns[column].get(value, 0)
+
+    def search(self, text):
+        text = unicode(text).lower()
+        if len(text) <= self.gram_size:
+            return self.grams.get(text, 0) if text else self.all
+        found = self.all
+        for pos in xrange(len(text) - self.gram_size + 1):
+            found &= self.grams.get(text[pos:pos + self.gram_size], 0)
+            if not found:
+                return 0
+        candidates = found
+        while candidates:
+            bit = candidates & -candidates
+            candidates ^= bit
+            if text not in self.names[bit.bit_length() - 1]:
+                found ^= bit
+        return found
+
+
+class LibraryModel(QtCore.QAbstractTableModel):
+    '''Table model reading sounds straight from the library SoundBank.
+
+    Rows are kept in location order; store changes are notified as dataChanged
+    of the related cells only.'''
     cleared = QtCore.pyqtSignal()
 
     def __init__(self, parent=None):
-        QtGui.QStandardItemModel.__init__(self, 0, 7, parent)
-        self.setHorizontalHeaderLabels(sound_headers)
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.store = None
+        self.sounds = []
+        self.rows = {}
+        self.search_index = LibraryIndex()
+        self.bold_font = QtGui.QFont()
+        self.bold_font.setBold(True)
+
+    def setStore(self, store):
+        self.store = store
+        store.nameChanged.connect(self.nameChanged)
+        store.catChanged.connect(self.catChanged)
+        store.locationChanged.connect(self.locationChanged)
+        store.edited.connect(lambda slot, state: self.slotChanged(slot, STATUS))
+
+    #the search index is updated before dataChanged, as proxies filter again changed rows
+    def nameChanged(self, slot, name):
+        self.search_index.setName(slot, name)
+        self.slotChanged(slot, NAME)
+
+    def catChanged(self, slot, cat):
+        self.search_index.setValue(slot, CATEGORY, cat)
+        self.slotChanged(slot, CATEGORY)
+
+    def locationChanged(self, slot, index):
+        self.search_index.setValue(slot, BANK, index >> 7)
+        self.slotChanged(slot, INDEX, PROG)
+
+    def slotChanged(self, slot, first, last=None):
+        row = self.rows.get(slot)
+        if row is None: return
+        self.dataChanged.emit(self.index(row, first), self.index(row, first if last is None else last))
+
+    def updateSound(self, slot):
+        #slots replaced during addSoundBulk are not in the model yet
+        row = self.rows.get(slot)
+        if row is None: return
+        sound = self.sounds[row]
+        self.search_index.add(slot, sound.name, sound.bank, sound.cat)
+        self.slotChanged(slot, INDEX, SOUND)
+
+    def _reindex(self, first=0, last=None):
+        if last is None:
+            last = len(self.sounds) - 1
+        for row in xrange(first, last + 1):
+            self.rows[self.sounds[row].slot] = row
 
     def clear(self):
-        QtGui.QStandardItemModel.clear(self)
-        self.setHorizontalHeaderLabels(sound_headers)
+        self.beginResetModel()
+        self.sounds = []
+        self.rows = {}
+        self.search_index.clear()
+        self.endResetModel()
         self.cleared.emit()
 
+    def addSound(self, sound):
+        index = sound.index
+        row = len(self.sounds)
+        while row > 0 and self.sounds[row - 1].index > index:
+            row -= 1
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.sounds.insert(row, sound)
+        self._reindex(row)
+        self.search_index.add(sound.slot, sound.name, sound.bank, sound.cat)
+        self.endInsertRows()
+
+    def addSounds(self, sounds):
+        #views and proxies are updated once on reset
+        self.beginResetModel()
+        self.sounds = sorted(self.sounds + sounds, key=lambda sound: sound.index)
+        self.rows = {}
+        self._reindex()
+        for sound in sounds:
+            self.search_index.add(sound.slot, sound.name, sound.bank, sound.cat)
+        self.endResetModel()
+
+    def moveRows(self, first, last, target):
+        #same behaviour of takeRow/insertRow: the moved block starts or ends at target
+        dest = target if target < first else target + 1
+        if first <= dest <= last + 1:
+            return False
+        self.beginMoveRows(QtCore.QModelIndex(), first, last, QtCore.QModelIndex(), dest)
+        block = self.sounds[first:last + 1]
+        del self.sounds[first:last + 1]
+        pos = dest if dest < first else dest - len(block)
+        self.sounds[pos:pos] = block
+        self._reindex(min(first, pos), max(last, pos + len(block) - 1))
+        self.endMoveRows()
+        return True
+
     def sound(self, index):
-        return self.item(index.row(), SOUND).data(SoundRole).toPyObject()
+        return self.sounds[index.row()]
+
+    def field(self, row, column):
+        sound = self.sounds[row]
+        if column == INDEX:
+            return sound.index
+        elif column == BANK:
+            return sound.bank
+        elif column == PROG:
+            return sound.prog
+        elif column == NAME:
+            return sound.name
+        elif column == CATEGORY:
+            return sound.cat
+        elif column == STATUS:
+            return sound.state
+        return sound
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.sounds)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(sound_headers) + 1
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole and section < len(sound_headers):
+            return QtCore.QVariant(sound_headers[section])
+        return QtCore.QAbstractTableModel.headerData(self, section, orientation, role)
+
+    def flags(self, index):
+        flags = QtCore.Qt.ItemIsSelectable|QtCore.Qt.ItemIsEnabled|QtCore.Qt.ItemIsDragEnabled|QtCore.Qt.ItemIsDropEnabled
+        if index.column() in (NAME, CATEGORY):
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def supportedDropActions(self):
+        return QtCore.Qt.CopyAction|QtCore.Qt.MoveAction
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return QtCore.QVariant()
+        row = index.row()
+        column = index.column()
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            sound = self.sounds[row]
+            if column == INDEX:
+                return QtCore.QVariant('{}{:03}'.format(uppercase[sound.bank], sound.prog+1))
+            elif column == BANK:
+                return QtCore.QVariant(uppercase[sound.bank])
+            elif column == PROG:
+                return QtCore.QVariant('{:03}'.format(sound.prog+1))
+            elif column == NAME:
+                return QtCore.QVariant(sound.name)
+            elif column == CATEGORY:
+                return QtCore.QVariant(categories[sound.cat])
+            elif column == STATUS:
+                return QtCore.QVariant(get_status(sound.state))
+        elif role == SoundRole:
+            return QtCore.QVariant(self.sounds[row])
+        elif role == EditedRole:
+            return QtCore.QVariant(self.sounds[row].state)
+        elif role == roles_dict.get(column):
+            return QtCore.QVariant(self.field(row, column))
+        elif role == QtCore.Qt.FontRole and column == STATUS and self.sounds[row].state != STORED:
+            return QtCore.QVariant(self.bold_font)
+        elif role == QtCore.Qt.TextAlignmentRole and column == BANK:
+            return QtCore.QVariant(QtCore.Qt.AlignRight|QtCore.Qt.AlignCenter)
+        return QtCore.QVariant()
 
 
 class LibraryProxy(QtGui.QSortFilterProxyModel):
@@ -732,12 +1294,15 @@ class LibraryProxy(QtGui.QSortFilterProxyModel):
         self.setDynamicSortFilter(True)
         self.filter_columns = {}
         self.text_filter = None
+        self.accepted = None
+        self.version = None
 
     def setTextFilter(self, text):
         if not text:
             self.text_filter = None
         else:
-            self.text_filter = text.toLower()
+            self.text_filter = unicode(text).lower()
+        self.accepted = None
         self.invalidateFilter()
 
     def setMultiFilter(self, column, index):
@@ -745,22 +1310,27 @@ class LibraryProxy(QtGui.QSortFilterProxyModel):
             self.filter_columns.pop(column)
         else:
             self.filter_columns[column] = index-1
+        self.accepted = None
         if not len(self.filter_columns) and not self.text_filter:
             self.reset()
             return
         self.invalidateFilter()
 
+    def updateAccepted(self):
+        search_index = self.sourceModel().search_index
+        accepted = search_index.search(self.text_filter) if self.text_filter else search_index.all
+        for column, index in self.filter_columns.items():
+            accepted &= search_index.match(column, index)
+        self.accepted = accepted
+        self.version = search_index.version
+
     def filterAcceptsRow(self, row, parent):
         if not len(self.filter_columns) and not self.text_filter:
             return True
         model = self.sourceModel()
-        if len(self.filter_columns) and any([True for column, index in self.filter_columns.items() if model.item(row, column).data(roles_dict[column]) != index]):
-            return False
-        if not self.text_filter:
-            return True
-        if self.text_filter in model.item(row, NAME).text().toLower():
-            return True
-        return False
+        if self.accepted is None or self.version != model.search_index.version:
+            self.updateAccepted()
+        return bool(self.accepted >> model.sounds[row].slot & 1)
 
 
 class LoadingThread(QtCore.QObject):
@@ -776,7 +1346,7 @@ class LoadingThread(QtCore.QObject):
             #should do pass
 #            self.source = local_path('presets/blofeld_fact_200802.mid')
             self.source = source
-        elif source in ['200801', '200802', '201200']:
+        elif source in factory_presets:
             self.source = local_path('presets/blofeld_fact_{}.mid'.format(source))
         else:
             self.source = source
@@ -793,6 +1363,9 @@ class LoadingThread(QtCore.QObject):
         else:
             sound_list = self.load_midi(self.source)
         self.library.addSoundBulk(sound_list)
+        if self.library.file is not None:
+            #sounds have just been read from the file
+            self.library.store.clean()
 
         #wavetable library load
         path_txt = QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation) + '/wavetables/'
@@ -805,24 +1378,51 @@ class LoadingThread(QtCore.QObject):
 
         self.loaded.emit()
 
-    def load_midi(self, path):
-#        print 'opening "{}"'.format(path)
-        pattern = midifile.read_midifile(path)
-        track = pattern[0]
-        i = 0
-        sound_list = []
-        for event in track:
-            if isinstance(event, midifile.SysexEvent):
-                sound_list.append(Sound(event.data[6:391]))
-                i += 1
-                if i == self.limit:
-                    break
+    def load_midi(self, file_path):
+#        print 'opening "{}"'.format(file_path)
+        data_dir = str(QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation).toUtf8())
+        cache_dir = path.join(data_dir, 'presets')
+        if not path.exists(cache_dir):
+            try:
+                makedirs(cache_dir)
+            except:
+                pass
+        cache = PresetCache(cache_dir)
+        sound_list = cache.load(file_path)
+        if sound_list is None:
+            factory_list = [local_path('presets/blofeld_fact_{}.mid'.format(f)) for f in factory_presets]
+            if file_path in factory_list:
+                #cache all factory sets now, switching between them will only read the cache
+                cache.preload(factory_list)
+            else:
+                cache.save(file_path, parse_preset(file_path))
+            sound_list = cache.load(file_path)
+            if sound_list is None:
+                #cache not writable
+                sound_list = [LibraryRecord(ord(record[0]), ord(record[1]), record[2:]) for record in parse_preset(file_path)]
 #        print 'done: {}'.format(len(sound_list))
-        return sound_list
+        return sound_list[:self.limit]
 
     def load_library(self):
-        sound_list = []
         data_dir = str(QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation).toUtf8())
+        library_file = LibraryFile(path.join(data_dir, LIBRARY_FILE))
+        if not library_file.exists():
+            #convert the old pickled library, if any
+            sound_list = self.load_pickle(data_dir)
+            library_file.create(sound_list)
+        library_file.open()
+        #records sharing a location would be merged into a single slot, shifting the following ones
+        library_file.deduplicate()
+        self.library.file = library_file
+        sound_list = []
+        for i, record in enumerate(library_file):
+            if i == self.limit:
+                break
+            sound_list.append(record)
+        return sound_list
+
+    def load_pickle(self, data_dir):
+        sound_list = []
         data_path = path.join(data_dir, 'personal_library')
         if not path.exists(data_path):
             try:
@@ -834,14 +1434,10 @@ class LoadingThread(QtCore.QObject):
                 print 'moving old library'
                 copy(old_path, data_path)
             else:
-                raise
+                raise IOError('Personal library not found')
         with open(data_path, 'rb') as of:
-            i = 0
             for data in pickle.load(of):
-                sound_list.append(Sound(list(data)))
-                i += 1
-                if i == self.limit:
-                    break
+                sound_list.append(LibraryRecord(data[0], data[1], data[2:]))
         return sound_list
 
 
@@ -0,0 +1,167 @@
+#!/usr/bin/env python2.7
+# *-* coding: utf-8 *-*
+
+try:
+    import numpy
+    NUMPY = True
+except:
+    NUMPY = False
+
+from bigglesworth.const import INIT, END, CHK, IDW, IDE, SNDD, WTBD
+
+WAVE_COUNT = 64
+WAVE_SAMPLES = 128
+WAVE_DATA_SIZE = WAVE_SAMPLES * 3
+WAVE_MSG_SIZE = 410
+WAVETABLE_SIZE = WAVE_COUNT * WAVE_MSG_SIZE
+SOUND_DATA_SIZE = 383
+SOUND_MSG_SIZE = 392
+
+pow20 = 2**20
+pow21 = 2**21
+mask21 = pow21 - 1
+
+#offsets inside a single WTBD message: header (8), samples (384), name (14), reserved and checksum
+_wave_data_start = 8
+_wave_data_end = _wave_data_start + WAVE_DATA_SIZE
+_wave_name_end = _wave_data_end + 14
+
+
+def _buffer(data):
+    if isinstance(data, bytearray):
+        return data
+    if NUMPY and isinstance(data, numpy.ndarray):
+        return bytearray(data.astype(numpy.uint8).tostring())
+    return bytearray(data)
+
+def _numpy_buffer(data):
+    if isinstance(data, (str, bytearray, buffer, memoryview)):
+        return numpy.frombuffer(data, dtype=numpy.uint8)
+    return numpy.asarray(data, dtype=numpy.uint8)
+
+
+def _wave_chunks(data, count):
+    #concatenate all the sample blocks of a full dump, skipping headers and names
+    buf = _buffer(data)
+    samples = bytearray()
+    for w in xrange(count):
+        pos = w * WAVE_MSG_SIZE
+        samples += buf[pos + _wave_data_start:pos + _wave_data_end]
+    return samples
+
+def _decode_samples(samples):
+    values = [(h << 14) | (m << 7) | l for h, m, l in zip(samples[0::3], samples[1::3], samples[2::3])]
+    return [v - pow21 if v >= pow20 else v for v in values]
+
+def decode_wave(data):
+    '''Decode the 384 sample bytes of a single wave into 128 signed 21bit values.'''
+    if NUMPY:
+        raw = _numpy_buffer(data)[:WAVE_DATA_SIZE].astype(numpy.int32).reshape(WAVE_SAMPLES, 3)
+        values = (raw[:, 0] << 14) | (raw[:, 1] << 7) | raw[:, 2]
+        values[values >= pow20] -= pow21
+        return values.tolist()
+    return _decode_samples(_buffer(data)[:WAVE_DATA_SIZE])
+
+def decode_wavetable(data):
+    '''Decode a full 26240 bytes wavetable dump (64 WTBD messages) in a single pass,
+    returns a list of 64 lists of 128 signed values.'''
+    if NUMPY:
+        raw = _numpy_buffer(data)[:WAVETABLE_SIZE].reshape(WAVE_COUNT, WAVE_MSG_SIZE)
+        raw = raw[:, _wave_data_start:_wave_data_end].astype(numpy.int32).reshape(WAVE_COUNT, WAVE_SAMPLES, 3)
+        values = (raw[..., 0] << 14) | (raw[..., 1] << 7) | raw[..., 2]
+        values[values >= pow20] -= pow21
+        return values.tolist()
+    values = _decode_samples(_wave_chunks(data, WAVE_COUNT))
+    return [values[w:w + WAVE_SAMPLES] for w in xrange(0, WAVE_COUNT * WAVE_SAMPLES, WAVE_SAMPLES)]
+
+def encode_wave(values):
+    '''Encode 128 signed values into the 384 sample bytes of a wave.'''
+    if NUMPY:
+        values = numpy.asarray(values, dtype=numpy.int32).reshape(WAVE_SAMPLES) & mask21
+        raw = numpy.empty((WAVE_SAMPLES, 3), dtype=numpy.uint8)
+        raw[:, 0] = values >> 14
+        raw[:, 1] = (values >> 7) & 127
+        raw[:, 2] = values & 127
+        return bytearray(raw.tostring())
+    values = [v & mask21 for v in values]
+    samples = bytearray(len(values) * 3)
+    samples[0::3] = bytearray([v >> 14 for v in values])
+    samples[1::3] = bytearray([(v >> 7) & 127 for v in values])
+    samples[2::3] = bytearray([v & 127 for v in values])
+    return samples
+
+def encode_wavetable(values, slot, name, device_id=0x7f):
+    '''Encode 64*128 values (either flat or grouped by wave) into a full wavetable
+    dump; name has to be an already converted sequence of 14 values.'''
+    name = bytearray(name)
+    if NUMPY:
+        values = numpy.fromiter(_flatten(values), dtype=numpy.int32, count=WAVE_COUNT * WAVE_SAMPLES)
+        values = values.reshape(WAVE_COUNT, WAVE_SAMPLES) & mask21
+        dump = numpy.empty((WAVE_COUNT, WAVE_MSG_SIZE), dtype=numpy.uint8)
+        dump[:, :_wave_data_start] = (INIT, IDW, IDE, device_id, WTBD, slot, 0, 0)
+        dump[:, 6] = numpy.arange(WAVE_COUNT)
+        samples = dump[:, _wave_data_start:_wave_data_end].reshape(WAVE_COUNT, WAVE_SAMPLES, 3)
+        samples[..., 0] = values >> 14
+        samples[..., 1] = (values >> 7) & 127
+        samples[..., 2] = values & 127
+        dump[:, _wave_data_end:_wave_name_end] = numpy.frombuffer(name, dtype=numpy.uint8)
+        dump[:, _wave_name_end:] = (0, 0, CHK, END)
+        return bytearray(dump.tostring())
+    values = list(_flatten(values))
+    samples = encode_wave(values)
+    dump = bytearray()
+    tail = name + bytearray((0, 0, CHK, END))
+    for w in xrange(WAVE_COUNT):
+        dump += bytearray((INIT, IDW, IDE, device_id, WTBD, slot, w, 0))
+        dump += samples[w * WAVE_DATA_SIZE:(w + 1) * WAVE_DATA_SIZE]
+        dump += tail
+    return dump
+
+def _flatten(values):
+    for item in values:
+        if isinstance(item, (int, long)):
+            yield item
+        else:
+            for value in item:
+                yield value
+
+def split_messages(dump, size=WAVE_MSG_SIZE):
+    '''Split a bulk dump into a list of sysex lists, ready for SysExEvent.'''
+    dump = _buffer(dump)
+    return [list(dump[pos:pos + size]) for pos in xrange(0, len(dump), size)]
+
+def decode_sound(data, start=5):
+    '''Return [bank, prog] + 383 sound parameters from a 392 bytes SNDD message;
+    start is the bank offset (6 for SysexEvents read from MIDI files).'''
+    return list(_buffer(data)[start:start + 2 + SOUND_DATA_SIZE])
+
+def encode_sound(bank, prog, data, device_id=0x7f):
+    '''Build a SNDD message for the given location.'''
+    dump = bytearray((INIT, IDW, IDE, device_id, SNDD, bank, prog))
+    dump += _buffer(data)
+    dump += bytearray((CHK, END))
+    return dump
+
+
+def benchmark(count=5000):
+    from time import time
+    from random import randint
+    print 'Decoding {} wavetable dumps (numpy: {})'.format(count, NUMPY)
+    values = [randint(-pow20, pow20 - 1) for i in xrange(WAVE_COUNT * WAVE_SAMPLES)]
+    dump = str(encode_wavetable(values, 80, [32] * 14))
+    if decode_wavetable(dump) != [values[w:w + WAVE_SAMPLES] for w in xrange(0, len(values), WAVE_SAMPLES)]:
+        raise ValueError('Wavetable round trip failed')
+    start = time()
+    for i in xrange(count):
+        decode_wavetable(dump)
+    elapsed = time() - start
+    print 'decode: {:.3f}s total, {:.3f}ms per wavetable'.format(elapsed, elapsed * 1000. / count)
+    start = time()
+    for i in xrange(count):
+        encode_wavetable(values, 80, [32] * 14)
+    elapsed = time() - start
+    print 'encode: {:.3f}s total, {:.3f}ms per wavetable'.format(elapsed, elapsed * 1000. / count)
+
+if __name__ == '__main__':
+    import sys
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -21,7 +21,7 @@ def local_path(name):
 
 VERSION = version.VERSION
 
-ALSA, RTMIDI = 0, 1
+ALSA, RTMIDI, EMULATOR = 0, 1, 2
 
 MIDFILE, SYXFILE = 1, 2
 
@@ -37,6 +37,7 @@ PGMRECEIVE, MIDIRECEIVE, PGMSEND, MIDISEND = range(4)
 MOVEUP, MOVEDOWN, MOVELEFT, MOVERIGHT, MOVE = range(5)
 
 DUMP_ALL = -1
+factory_presets = ['200801', '200802', '201200']
 SMEB = 0x7f, 0x00
 MIEB = True
 
@@ -7,6 +7,7 @@ from bigglesworth.dialogs.globals import *
 from bigglesworth.dialogs.settings import *
 from bigglesworth.dialogs.about import *
 from bigglesworth.dialogs.sounddump import *
+from bigglesworth.dialogs.sync import *
 from bigglesworth.dialogs.loading import *
 from bigglesworth.dialogs.summary import *
 from bigglesworth.dialogs.midi_import import *
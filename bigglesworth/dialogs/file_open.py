@@ -4,6 +4,7 @@ from PyQt4 import QtCore, QtGui
 
 from bigglesworth.classes import Sound, Wavetable
 from bigglesworth.const import *
+from bigglesworth.codec import decode_sound
 from bigglesworth.libs import midifile
 
 
@@ -82,11 +83,9 @@ class FileOpen(QtGui.QFileDialog):
         if self.mode & MIDFILE:
             sound_list = []
             try:
-                pattern = midifile.read_midifile(str(path.toUtf8()))
-                for track in pattern:
-                    for event in track:
-                        if isinstance(event, midifile.SysexEvent) and len(event.data) == 392:
-                            sound_list.append(Sound(event.data[6:391]))
+                for data in midifile.iter_sysex(str(path.toUtf8())):
+                    if len(data) == 392:
+                        sound_list.append(Sound(decode_sound(data, 6)))
                 if sound_list:
                     self.res = sound_list, path
                     return QtGui.QFileDialog.accept(self)
@@ -100,9 +99,9 @@ class FileOpen(QtGui.QFileDialog):
         if self.mode & SYXFILE:
             try:
                 with open(str(path.toUtf8()), 'rb') as sf:
-                    sysex = list(ord(i) for i in sf.read())
+                    sysex = list(bytearray(sf.read()))
                 if len(sysex) == 392:
-                    self.res = Sound(sysex[5:-2]), path
+                    self.res = Sound(decode_sound(sysex)), path
                     return QtGui.QFileDialog.accept(self)
                 elif len(sysex) == 26240 and (sysex[1:3] == [IDW, IDE] and sysex[4] == WTBD and sysex[7] == 0):
                     self.res = Wavetable(sysex), 
@@ -166,8 +166,8 @@ class Globals(QtGui.QDialog):
         self.conn_check()
 
     def conn_check(self, *args):
-        input = any((True for conn in self.input.connections if not conn.hidden))
-        output = any((True for conn in self.output.connections if not conn.hidden))
+        input = self.input.connections.visible > 0
+        output = self.output.connections.visible > 0
         self.resetBtn.setEnabled(True if all((input, output)) else False)
         self.applyBtn.setEnabled(True if output else False)
         self.okBtn.setEnabled(True if output else False)
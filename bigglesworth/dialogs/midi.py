@@ -60,8 +60,8 @@ class MidiWidget(QtGui.QWidget):
         actions = []
         if item.isEnabled():
             port = self._get_port_from_item_data(model, index)
-            if (sender == self.input_listview and self.input in [conn.dest for conn in port.connections.output]) or\
-                (sender == self.output_listview and self.output in [conn.src for conn in port.connections.input]):
+            if (sender == self.input_listview and (port.addr, self.input.addr) in port.connections) or\
+                (sender == self.output_listview and (self.output.addr, port.addr) in port.connections):
                 disconnect_action = QtGui.QAction('Disconnect', self)
                 disconnect_action.triggered.connect(lambda: self.port_connect_toggle(index, sender))
                 actions.append(disconnect_action)
@@ -88,18 +88,22 @@ class MidiWidget(QtGui.QWidget):
             sender = self.sender()
         if sender == self.input_listview:
             port = self._get_port_from_item_data(self.input_model, index)
-            if self.input in [conn.dest for conn in port.connections.output]:
+            if (port.addr, self.input.addr) in port.connections:
                 port.disconnect(self.input)
             else:
                 port.connect(self.input)
         elif sender == self.output_listview:
             port = self._get_port_from_item_data(self.output_model, index)
-            if self.output in [conn.src for conn in port.connections.input]:
+            if (self.output.addr, port.addr) in port.connections:
                 self.output.disconnect(port)
             else:
                 self.output.connect(port)
 
     def refresh_all(self):
+        #rtmidi connections can be closed without notice
+        if self.graph.prune_connections():
+            #already refreshed by graph_changed
+            return
         self.input_model = QtGui.QStandardItemModel()
         self.input_listview.setModel(self.input_model)
         self.output_model = QtGui.QStandardItemModel()
@@ -131,7 +135,7 @@ class MidiWidget(QtGui.QWidget):
                     in_item.setData(QtCore.QVariant(client.id), ClientRole)
                     in_item.setData(QtCore.QVariant(port.id), PortRole)
                     self.input_model.appendRow(in_item)
-                    if any([conn for conn in port.connections.output if conn.dest == self.input]):
+                    if (port.addr, self.input.addr) in port.connections:
                         in_item.setData(QtGui.QBrush(QtCore.Qt.blue), QtCore.Qt.ForegroundRole)
                         setBold(in_item)
                     else:
@@ -154,7 +158,7 @@ class MidiWidget(QtGui.QWidget):
                     out_item.setData(QtCore.QVariant(client.id), ClientRole)
                     out_item.setData(QtCore.QVariant(port.id), PortRole)
                     self.output_model.appendRow(out_item)
-                    if any([conn for conn in port.connections.input if conn.src == self.output]):
+                    if (self.output.addr, port.addr) in port.connections:
                         out_item.setData(QtGui.QBrush(QtCore.Qt.blue), QtCore.Qt.ForegroundRole)
                         setBold(out_item)
                     else:
@@ -162,11 +166,10 @@ class MidiWidget(QtGui.QWidget):
                         setBold(out_item, False)
 
         cx_text = [
-                   (self.input.connections.input, self.input_lbl, 'INPUT'), 
-                   (self.output.connections.output, self.output_lbl, 'OUTPUT'), 
+                   (self.input.connections.visible_input, self.input_lbl, 'INPUT'), 
+                   (self.output.connections.visible_output, self.output_lbl, 'OUTPUT'), 
                    ]
-        for cx, lbl, ptxt in cx_text:
-            n_conn = len([conn for conn in cx if not conn.hidden])
+        for n_conn, lbl, ptxt in cx_text:
             cx_txt = ptxt
             if not n_conn:
                 cx_txt += ' (not connected)'
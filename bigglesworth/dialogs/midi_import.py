@@ -7,6 +7,7 @@ from PyQt4 import QtCore, QtGui
 from bigglesworth.utils import load_ui, setBold
 from bigglesworth.const import sound_headers, categories, Params, BANK, NAME, PROG, CATEGORY, STORED, ValuesRole, EditedRole
 from bigglesworth.classes import Sound
+from bigglesworth.codec import decode_sound
 from bigglesworth.libs import midifile
 
 _UNCHANGED, _MINIMUM, _MAXIMUM = None, 0, -1
@@ -502,13 +503,11 @@ class MidiImportDialog(QtGui.QDialog):
             path = str(path.toUtf8())
         sound_list = []
         try:
-            pattern = midifile.read_midifile(path)
+            for data in midifile.iter_sysex(path):
+                if len(data) == 392:
+                    sound_list.append(Sound(decode_sound(data, 6)))
         except:
             return False
-        for track in pattern:
-            for event in track:
-                if isinstance(event, midifile.SysexEvent) and len(event.data) == 392:
-                    sound_list.append(Sound(event.data[6:391]))
         return sound_list
 
     def build(self, sound_list):
@@ -129,6 +129,7 @@ class SettingsDialog(QtGui.QDialog):
 
         self.blofeld_autoconnect_chk.setChecked(self.main.blofeld_autoconnect)
         self.remember_connections_chk.setChecked(self.main.remember_connections)
+        self.dump_verify_chk.setChecked(self.main.dump_verify)
 
         #General
         self.startup_version_chk.setChecked(self.main.startup_version_check)
@@ -170,6 +171,7 @@ class SettingsDialog(QtGui.QDialog):
         self.main.blofeld_id = self.deviceID_spin.value()
         self.main.blofeld_autoconnect = self.blofeld_autoconnect_chk.isChecked()
         self.main.remember_connections = self.remember_connections_chk.isChecked()
+        self.main.dump_verify = self.dump_verify_chk.isChecked()
 
         self.main.startup_version_check = self.startup_version_chk.isChecked()
 
@@ -0,0 +1,60 @@
+# *-* coding: utf-8 *-*
+
+from string import uppercase
+from PyQt4 import QtCore, QtGui
+
+class SyncDialog(QtGui.QDialog):
+    def __init__(self, main, parent):
+        QtGui.QDialog.__init__(self, parent)
+        self.main = main
+        self.setModal(True)
+        self.setWindowTitle('Sync with Blofeld')
+        self.setMinimumSize(360, 320)
+        grid = QtGui.QGridLayout(self)
+        self.info_lbl = QtGui.QLabel()
+        self.info_lbl.setWordWrap(True)
+        grid.addWidget(self.info_lbl, 0, 0, 1, 1)
+
+        self.sound_tree = QtGui.QTreeWidget()
+        self.sound_tree.setRootIsDecorated(False)
+        self.sound_tree.setHeaderLabels(['Location', 'Name', 'Blofeld'])
+        self.sound_tree.itemChanged.connect(self.update_count)
+        grid.addWidget(self.sound_tree, 1, 0, 1, 1)
+
+        self.buttonBox = QtGui.QDialogButtonBox(QtGui.QDialogButtonBox.Ok|QtGui.QDialogButtonBox.Cancel)
+        self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setText('Send')
+        self.buttonBox.accepted.connect(self.accept)
+        self.buttonBox.rejected.connect(self.reject)
+        grid.addWidget(self.buttonBox, 2, 0, 1, 1)
+
+    def update_count(self, *args):
+        count = len(self.selected())
+        self.buttonBox.button(QtGui.QDialogButtonBox.Ok).setEnabled(count > 0)
+        self.info_lbl.setText('{} of {} sounds differ from the Blofeld, {} selected.'.format(
+            self.sound_tree.topLevelItemCount(), self.total, count))
+
+    def selected(self):
+        return [self.sounds[i] for i in range(self.sound_tree.topLevelItemCount())
+            if self.sound_tree.topLevelItem(i).checkState(0) == QtCore.Qt.Checked]
+
+    def exec_(self, sounds, total):
+        '''Return the list of sounds to be sent.'''
+        self.sounds = sounds
+        self.total = total
+        self.sound_tree.blockSignals(True)
+        self.sound_tree.clear()
+        for sound in sounds:
+            known = self.main.device_state.known(sound.bank, sound.prog)
+            item = QtGui.QTreeWidgetItem(['{}{:03}'.format(uppercase[sound.bank], sound.prog+1), sound.name,
+                'changed' if known else 'unknown'])
+            item.setCheckState(0, QtCore.Qt.Checked)
+            self.sound_tree.addTopLevelItem(item)
+        self.sound_tree.blockSignals(False)
+        self.sound_tree.resizeColumnToContents(0)
+        self.update_count()
+        if not sounds:
+            QtGui.QMessageBox.information(self.parent(), 'Sync with Blofeld', 'All sounds are already on the Blofeld.')
+            return []
+        res = QtGui.QDialog.exec_(self)
+        if not res: return []
+        return self.selected()
@@ -0,0 +1,541 @@
+#!/usr/bin/env python2.7
+# *-* coding: utf-8 *-*
+
+from collections import deque, OrderedDict, namedtuple
+from math import ceil
+from time import time
+
+from PyQt4 import QtCore
+
+from codec import SOUND_MSG_SIZE
+from midiutils import MIDI_BYTE_RATE
+from libfile import sound_hash
+
+#time needed to transfer a single sound at MIDI speed
+SOUND_TIME = SOUND_MSG_SIZE / float(MIDI_BYTE_RATE)
+DUMP_WINDOW = 8
+DUMP_TIMEOUT = 1.
+DUMP_RETRIES = 3
+#the request timeout is doubled on each expiry, up to this factor
+DUMP_MAX_BACKOFF = 16
+#extra time given to the Blofeld to store each received message
+DUMP_SEND_MARGIN = .02
+#wavetables are written to flash, the interval used before bandwidth pacing is kept
+WAVE_SEND_INTERVAL = .2
+#read back delay after a sound has been sent, and first resend delay
+DUMP_VERIFY_DELAY = .1
+DUMP_BACKOFF = .5
+
+WAIT, REQUESTED, BACKOFF = range(3)
+
+#a sound received within this time from the previous one starts a bulk dump
+BULK_TIMEOUT = .5
+PROGRESS_RATE = 30
+
+IDLE, REQUESTING, PAUSED, BULK = range(4)
+
+DumpProgress = namedtuple('DumpProgress', 'bank prog done total eta')
+
+
+class DumpReceiver(QtCore.QObject):
+    '''Requests sounds from the Blofeld keeping up to `window` SNDR requests in
+    flight; responses are matched by location, missing ones are requested again
+    after a timeout.
+
+    The window grows while responses arrive in time, up to what the measured
+    turnaround needs to keep the link busy, and it is halved on timeouts.
+    Replies to requests sent again are not timed, as they could answer any of
+    the attempts: the timeout is doubled on each expiry instead, until a reply
+    to a first request gives a new measure.'''
+    request = QtCore.pyqtSignal(int, int)
+    received = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(int, int, float)
+    finished = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent=None, window=DUMP_WINDOW, timeout=DUMP_TIMEOUT, retries=DUMP_RETRIES):
+        QtCore.QObject.__init__(self, parent)
+        self.max_window = window
+        self.base_timeout = timeout
+        self.retries = retries
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(50)
+        self.timer.timeout.connect(self.check_timeouts)
+        self.active = False
+        self.paused = False
+        self.reset([])
+
+    def reset(self, locations):
+        self.queue = deque(locations)
+        self.total = len(locations)
+        #location: (request time, attempts)
+        self.pending = OrderedDict()
+        self.sounds = {}
+        self.failed = []
+        self.window = 1.
+        self.turnaround = None
+        self.backoff = 1
+        self.started = time()
+
+    @property
+    def timeout(self):
+        if self.turnaround is None:
+            return self.base_timeout * self.backoff
+        return max(self.base_timeout, self.turnaround * 4) * self.backoff
+
+    @property
+    def current_window(self):
+        limit = self.max_window
+        if self.turnaround is not None:
+            #enough requests to cover the turnaround, plus one
+            limit = min(limit, int(ceil(self.turnaround / SOUND_TIME)) + 1)
+        return max(1, min(limit, int(self.window)))
+
+    def start(self, locations):
+        self.reset(locations)
+        self.active = True
+        self.paused = False
+        self.timer.start()
+        self.fill()
+
+    def stop(self):
+        self.active = False
+        self.timer.stop()
+        self.queue.clear()
+        self.pending.clear()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        #requests sent before pausing are not waited for
+        for location in self.pending.keys():
+            self.pending[location] = time(), self.pending[location][1]
+        self.fill()
+
+    def send(self, location, attempts=0):
+        self.pending[location] = time(), attempts + 1
+        self.request.emit(*location)
+
+    def fill(self):
+        if not self.active or self.paused:
+            return
+        while self.queue and len(self.pending) < self.current_window:
+            self.send(self.queue.popleft())
+
+    def receive(self, sound):
+        '''Returns False if the sound is not part of the dump; sounds that have
+        already been received (late replies to requests sent again) are ignored.'''
+        location = sound.bank, sound.prog
+        if not self.active:
+            return False
+        if location in self.sounds:
+            return True
+        if location in self.pending:
+            sent, attempts = self.pending.pop(location)
+            if attempts == 1:
+                elapsed = time() - sent
+                if self.turnaround is None:
+                    self.turnaround = elapsed
+                else:
+                    self.turnaround = self.turnaround * .8 + elapsed * .2
+                self.backoff = 1
+            self.window = min(self.max_window, self.window + 1. / self.window)
+        elif location in self.queue:
+            #sent by the device before being requested
+            self.queue.remove(location)
+        elif location in self.failed:
+            self.failed.remove(location)
+        else:
+            return False
+        self.sounds[location] = sound
+        self.received.emit(sound)
+        done = len(self.sounds)
+        self.progress.emit(done, self.total, self.eta())
+        self.fill()
+        self.check_finished()
+        return True
+
+    def eta(self):
+        done = len(self.sounds)
+        if done < 5:
+            return -1.
+        return (time() - self.started) / done * (self.total - done)
+
+    def check_timeouts(self):
+        if not self.active or self.paused:
+            return
+        now = time()
+        timeout = self.timeout
+        expired = [location for location, (sent, attempts) in self.pending.items() if now - sent > timeout]
+        if not expired:
+            return
+        self.window = max(1., self.window / 2)
+        self.backoff = min(self.backoff * 2, DUMP_MAX_BACKOFF)
+        for location in expired:
+            sent, attempts = self.pending.pop(location)
+            if attempts > self.retries:
+                self.failed.append(location)
+            else:
+                self.send(location, attempts)
+        self.fill()
+        self.check_finished()
+
+    def check_finished(self):
+        if self.queue or self.pending:
+            return
+        self.active = False
+        self.timer.stop()
+        self.finished.emit([self.sounds[location] for location in sorted(self.sounds)])
+
+
+class DumpSender(QtCore.QObject):
+    '''Emits `send` for each queued item, paced at the MIDI byte rate plus a
+    device margin for each message, and never faster than `interval`. Pacing is
+    computed on the expected end of the previous message, so timer jitter does
+    not add up.'''
+    send = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(int, int, float)
+    finished = QtCore.pyqtSignal(bool)
+
+    def __init__(self, parent=None, byte_rate=MIDI_BYTE_RATE, margin=DUMP_SEND_MARGIN, interval=0):
+        QtCore.QObject.__init__(self, parent)
+        self.byte_rate = float(byte_rate)
+        self.margin = margin
+        self.interval = interval
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.next)
+        self.active = False
+        self.paused = False
+        self.queue = deque()
+        self.total = self.done = 0
+        self.bytes_total = self.bytes_done = 0
+        self.next_time = 0
+
+    def duration(self, size):
+        return max(size / self.byte_rate + self.margin, self.interval)
+
+    def start(self, items, size=SOUND_MSG_SIZE):
+        '''Size is either the size of every message or a function returning it.'''
+        if not callable(size):
+            size = lambda item, size=size: size
+        self.queue = deque((item, size(item)) for item in items)
+        self.total = len(self.queue)
+        self.done = 0
+        self.bytes_total = sum(item_size for item, item_size in self.queue)
+        self.bytes_done = 0
+        self.active = True
+        self.paused = False
+        self.next_time = time()
+        self.next()
+
+    def next(self):
+        if not self.active or self.paused:
+            return
+        if not self.queue:
+            self.active = False
+            self.finished.emit(True)
+            return
+        item, size = self.queue.popleft()
+        self.send.emit(item)
+        self.done += 1
+        self.bytes_done += size
+        now = time()
+        self.next_time = max(now, self.next_time) + self.duration(size)
+        self.progress.emit(self.done, self.total, self.eta())
+        self.timer.start(max(0, int(ceil((self.next_time - now) * 1000))))
+
+    def eta(self):
+        remaining = max((self.bytes_total - self.bytes_done) / self.byte_rate + len(self.queue) * self.margin,
+            len(self.queue) * self.interval)
+        return remaining + max(0, self.next_time - time())
+
+    def pause(self):
+        self.paused = True
+        self.timer.stop()
+
+    def resume(self):
+        if not self.active or not self.paused:
+            return
+        self.paused = False
+        #the last message might still be on its way
+        self.timer.start(max(0, int(ceil((self.next_time - time()) * 1000))))
+
+    def append(self, item, size=SOUND_MSG_SIZE):
+        '''Queue another item, restarting if the queue was already consumed.'''
+        self.queue.append((item, size))
+        self.total += 1
+        self.bytes_total += size
+        if not self.active:
+            self.active = True
+            self.paused = False
+            self.timer.start(max(0, int(ceil((self.next_time - time()) * 1000))))
+
+    def cancel(self):
+        if not self.active:
+            return
+        self.active = False
+        self.timer.stop()
+        self.queue.clear()
+        self.finished.emit(False)
+
+
+class DumpVerifier(QtCore.QObject):
+    '''Reads back every sent sound and compares it with what was sent.
+    Sounds that do not match or do not come back are sent again, waiting twice
+    as much before each new attempt; read back requests are sent as soon as each
+    sound has been stored, while the following ones are still being sent.'''
+    request = QtCore.pyqtSignal(int, int)
+    resend = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent=None, delay=DUMP_VERIFY_DELAY, timeout=DUMP_TIMEOUT, backoff=DUMP_BACKOFF, retries=DUMP_RETRIES):
+        QtCore.QObject.__init__(self, parent)
+        self.delay = delay
+        self.timeout = timeout
+        self.backoff = backoff
+        self.retries = retries
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(50)
+        self.timer.timeout.connect(self.check)
+        self.active = False
+        self.reset()
+
+    def reset(self):
+        #location: (hash, sound)
+        self.expected = {}
+        #location: [state, due time, failed attempts]
+        self.pending = {}
+        self.resending = {}
+        self.verified = set()
+        self.failed = []
+        self.sending = False
+
+    def start(self):
+        self.reset()
+        self.active = True
+        self.sending = True
+        self.timer.start()
+
+    def stop(self):
+        self.active = False
+        self.timer.stop()
+        self.pending.clear()
+        self.resending.clear()
+
+    def sent(self, sound):
+        if not self.active:
+            return
+        location = sound.bank, sound.prog
+        if location not in self.expected:
+            self.expected[location] = sound_hash(sound.data), sound
+        attempts = self.resending.pop(location, 0)
+        self.pending[location] = [WAIT, time() + self.delay, attempts]
+
+    def sending_done(self):
+        self.sending = False
+        self.check_finished()
+
+    def receive(self, sound):
+        '''Returns False if the sound was not read back by the verifier.'''
+        location = sound.bank, sound.prog
+        if not self.active or self.pending.get(location, (None, ))[0] != REQUESTED:
+            return False
+        if sound_hash(sound.data) == self.expected[location][0]:
+            self.pending.pop(location)
+            self.verified.add(location)
+            self.progress.emit(len(self.verified), len(self.expected))
+            self.check_finished()
+        else:
+            self.retry(location)
+        return True
+
+    def retry(self, location):
+        state = self.pending[location]
+        state[2] += 1
+        if state[2] > self.retries:
+            self.pending.pop(location)
+            self.failed.append(location)
+            self.check_finished()
+            return
+        state[0] = BACKOFF
+        state[1] = time() + self.backoff * 2 ** (state[2] - 1)
+
+    def check(self):
+        if not self.active:
+            return
+        now = time()
+        for location, state in self.pending.items():
+            if state[1] > now:
+                continue
+            if state[0] == WAIT:
+                state[0] = REQUESTED
+                state[1] = now + self.timeout
+                self.request.emit(*location)
+            elif state[0] == REQUESTED:
+                self.retry(location)
+            else:
+                #sent() will add it again to pending
+                self.resending[location] = self.pending.pop(location)[2]
+                self.resend.emit(self.expected[location][1])
+
+    def check_finished(self):
+        if not self.active or self.sending or self.pending or self.resending:
+            return
+        self.active = False
+        self.timer.stop()
+        self.finished.emit(sorted(self.failed))
+
+
+class DumpSession(QtCore.QObject):
+    '''Sound dumps received from the Blofeld, either requested (through a
+    DumpReceiver) or sent from the device itself (bulk dumps).
+
+    States are IDLE, REQUESTING, PAUSED and BULK; progress is emitted at most
+    PROGRESS_RATE times per second, the last one is always emitted before
+    `finished`. While a dump is active every received sound is part of it,
+    and sounds are merged by location; late replies to a finished requested
+    dump are ignored.'''
+    request = QtCore.pyqtSignal(int, int)
+    state_changed = QtCore.pyqtSignal(int)
+    progress = QtCore.pyqtSignal(object)
+    finished = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, parent=None, receiver=None):
+        QtCore.QObject.__init__(self, parent)
+        self.receiver = receiver if receiver is not None else DumpReceiver(self)
+        self.receiver.request.connect(self.request)
+        self.receiver.received.connect(self.received)
+        self.receiver.finished.connect(self.receiver_finished)
+        self.bulk_timer = QtCore.QTimer(self)
+        self.bulk_timer.setInterval(int(BULK_TIMEOUT * 1000))
+        self.bulk_timer.setSingleShot(True)
+        self.bulk_timer.timeout.connect(self.bulk_finished)
+        self.progress_timer = QtCore.QTimer(self)
+        self.progress_timer.setInterval(1000 // PROGRESS_RATE)
+        self.progress_timer.setSingleShot(True)
+        self.progress_timer.timeout.connect(self.flush_progress)
+        self.pending_progress = None
+        self.state = IDLE
+        #location: sound
+        self.sounds = {}
+        self.late = set()
+        self.late_until = 0
+        self.started = time()
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.state_changed.emit(state)
+
+    def start(self, locations):
+        self.bulk_timer.stop()
+        self.sounds = {}
+        self.late = set()
+        self.started = time()
+        self.set_state(REQUESTING)
+        self.receiver.start(locations)
+
+    def pause(self):
+        if self.state == REQUESTING:
+            self.receiver.pause()
+            self.set_state(PAUSED)
+
+    def resume(self):
+        if self.state == PAUSED:
+            self.set_state(REQUESTING)
+            self.receiver.resume()
+
+    def stop(self):
+        '''Stop the current dump, keeping the sounds received so far.'''
+        if self.state == IDLE:
+            return
+        failed = self.receiver.failed if self.state != BULK else []
+        self.receiver.stop()
+        self.bulk_timer.stop()
+        self.finish(failed)
+
+    def cancel(self):
+        self.receiver.stop()
+        self.bulk_timer.stop()
+        self.progress_timer.stop()
+        self.pending_progress = None
+        self.sounds = {}
+        self.set_state(IDLE)
+
+    def receive(self, sound):
+        '''Returns False if the sound is not part of a dump, and should be
+        handled as a single sound.'''
+        location = sound.bank, sound.prog
+        if self.state in (REQUESTING, PAUSED):
+            if not self.receiver.receive(sound):
+                #not requested, it is merged with the dumped sounds
+                self.sounds.setdefault(location, sound)
+            return True
+        if self.state == BULK:
+            self.bulk_timer.start()
+            self.received(sound)
+            return True
+        #IDLE
+        if location in self.late:
+            if time() < self.late_until:
+                return True
+            self.late = set()
+        if not self.bulk_timer.isActive():
+            self.bulk_timer.start()
+            return False
+        #the first sound has already been handled on its own
+        self.sounds = {}
+        self.started = time()
+        self.set_state(BULK)
+        self.bulk_timer.start()
+        self.received(sound)
+        return True
+
+    def received(self, sound):
+        self.sounds[sound.bank, sound.prog] = sound
+        if self.state == BULK:
+            done = len(self.sounds)
+            total = 128 if done <= 128 else 1024
+            eta = (time() - self.started) / done * (total - done) if done > 5 else -1.
+        else:
+            done = len(self.receiver.sounds)
+            total = self.receiver.total
+            eta = self.receiver.eta()
+        self.set_progress(DumpProgress(sound.bank, sound.prog, done, total, eta))
+
+    def set_progress(self, progress):
+        if self.progress_timer.isActive():
+            self.pending_progress = progress
+            return
+        self.pending_progress = None
+        self.progress.emit(progress)
+        self.progress_timer.start()
+
+    def flush_progress(self):
+        self.progress_timer.stop()
+        if self.pending_progress is not None:
+            progress = self.pending_progress
+            self.pending_progress = None
+            self.progress.emit(progress)
+
+    def receiver_finished(self, sounds):
+        if self.state in (REQUESTING, PAUSED):
+            self.finish(self.receiver.failed)
+
+    def bulk_finished(self):
+        if self.state == BULK:
+            self.finish([])
+
+    def finish(self, failed):
+        self.flush_progress()
+        sounds = [self.sounds[location] for location in sorted(self.sounds)]
+        if self.state != BULK:
+            #replies to requests sent again might still come
+            self.late = set(self.sounds)
+            self.late_until = time() + self.receiver.timeout
+        self.sounds = {}
+        self.set_state(IDLE)
+        self.finished.emit(sounds, list(failed))
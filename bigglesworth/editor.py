@@ -2003,6 +2003,7 @@ class BlofeldDisplay(QtGui.QGraphicsView):
         self.main.setSound(bank, prog, pgm_send=True)
 
     def show_midi_menu(self, pos, input=True, output=True):
+        self.main.midi.graph.prune_connections()
         menu = QtGui.QMenu()
 
         in_menu = QtGui.QMenu()
@@ -2044,7 +2045,7 @@ class BlofeldDisplay(QtGui.QGraphicsView):
                     port_item = QtGui.QAction(port.name, in_menu)
                     port_item.setData(port)
                     port_item.setCheckable(True)
-                    if any([True for conn in port.connections.output if conn.dest == self.main.midi.input]):
+                    if (port.addr, self.main.midi.input.addr) in port.connections:
                         port_item.setChecked(True)
                         setBold(client_menu.menuAction())
                         in_menu_connections += 1
@@ -2066,7 +2067,7 @@ class BlofeldDisplay(QtGui.QGraphicsView):
                     port_item = QtGui.QAction(port.name, out_menu)
                     port_item.setData(port)
                     port_item.setCheckable(True)
-                    if any([True for conn in port.connections.input if conn.src == self.main.midi.output]):
+                    if (self.main.midi.output.addr, port.addr) in port.connections:
                         port_item.setChecked(True)
                         setBold(client_menu.menuAction())
                         out_menu_connections += 1
@@ -2112,11 +2113,11 @@ class BlofeldDisplay(QtGui.QGraphicsView):
 
         if not res: return
         if res == in_disconnect:
-            for conn in self.main.input.connections:
+            for conn in list(self.main.input.connections):
                 if conn.hidden: continue
                 conn.delete()
         elif res == out_disconnect:
-            for conn in self.main.output.connections:
+            for conn in list(self.main.output.connections):
                 if conn.hidden: continue
                 conn.delete()
         elif res.parent() == in_menu:
@@ -2270,6 +2271,8 @@ class Editor(QtGui.QMainWindow):
         self.setPalette(pal)
 
         self.main = main
+        self.sndp_templates = SoundParameterTemplates(self.main.blofeld_id)
+        self.main.blofeld_id_changed.connect(self.sndp_templates.build)
         self.blofeld_library = self.main.blofeld_library
         self.midi = self.main.midi
         self.input = self.midi.input
@@ -2776,12 +2779,7 @@ class Editor(QtGui.QMainWindow):
         self.display.midi_btn.midi_in()
 
     def send_value(self, attr, value):
-        location = 0
-        par_id = Params.index_from_attr(attr)
-        par_high, par_low = divmod(par_id, 128)
-#        print par_high, par_low, value
-
-        self.midi_event.emit(SysExEvent(1, [INIT, IDW, IDE, self.main.blofeld_id, SNDP, location, par_high, par_low, value, END]))
+        self.midi_event.emit(self.sndp_templates.event(1, attr, value))
         self.display.midi_btn.midi_out()
 
     def send_ctrl(self, param, value):
@@ -2842,7 +2840,7 @@ class Editor(QtGui.QMainWindow):
         self.display.edited_widget.setOpacity(0)
 
     def setSound(self, bank, prog, pgm_send=False):
-        sound = self.blofeld_library[bank, prog]
+        sound = self.blofeld_library.edit((bank, prog))
         if sound is None: return
         self.sound = sound
         self._setSound()
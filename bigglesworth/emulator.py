@@ -0,0 +1,319 @@
+#!/usr/bin/env python2.7
+# *-* coding: utf-8 *-*
+
+import heapq
+from random import Random
+from threading import Lock
+from time import time, sleep
+
+from PyQt4 import QtCore
+
+from const import *
+from midiutils import *
+from codec import SOUND_DATA_SIZE, SOUND_MSG_SIZE, WAVE_DATA_SIZE, WAVE_MSG_SIZE, WAVE_COUNT, \
+    decode_sound, encode_sound
+from libs import midifile
+
+EMULATOR_NAME = 'Blofeld emulator'
+EMULATOR_LATENCY = .005
+EMULATOR_DROP = 0.
+#poll interval of the device thread
+EMULATOR_POLL = .002
+
+BLOFELD_SLOTS = 1024
+EDIT_BUFFER = 0x7f
+GLOBALS_SIZE = 72
+#default global parameters: device id, tune (440Hz), transpose, contrast, volume
+_globals_defaults = {37: BROADCAST, 40: 64, 41: 64, 39: 64, 55: 127}
+IDENTITY_REQUEST = [INIT, 0x7e, 0x7f, 0x6, 0x1, END]
+FIRMWARE = '1.25'
+
+
+def _checksum(data):
+    return sum(data) & 0x7f
+
+
+class BlofeldEmulator(object):
+    '''Blofeld sysex protocol, without any timing; `process` returns the list of
+    replies (as bytearrays) for a received message.
+
+    Sounds are stored in 1024 slots plus the edit buffer, wavetables by slot
+    with their 64 waves (sample data and name).'''
+    def __init__(self, device_id=BROADCAST, sounds=None):
+        self.device_id = device_id
+        init_data = bytearray(init_sound_data[2:])
+        self.sounds = [init_data[:] for slot in xrange(BLOFELD_SLOTS)]
+        self.edit_buffer = init_data[:]
+        self.globals = bytearray(GLOBALS_SIZE)
+        for index, value in _globals_defaults.items():
+            self.globals[index] = value
+        self.globals[37] = device_id
+        self.wavetables = {}
+        self.handlers = {
+                         SNDR: self.sound_request,
+                         SNDD: self.sound_dump,
+                         SNDP: self.sound_parameter,
+                         GLBR: self.globals_request,
+                         GLBD: self.globals_dump,
+                         WTBD: self.wave_dump,
+                         }
+        if sounds:
+            self.load(sounds)
+
+    def load(self, sounds):
+        '''Fill the slots from a sequence of objects with bank, prog and data.'''
+        for sound in sounds:
+            slot = sound.bank * 128 + sound.prog
+            if 0 <= slot < BLOFELD_SLOTS:
+                self.sounds[slot] = bytearray(sound.data)
+
+    def load_midi(self, file_path):
+        for data in midifile.iter_sysex(file_path):
+            if len(data) != SOUND_MSG_SIZE:
+                continue
+            sound = decode_sound(data, 6)
+            if sound[0] * 128 + sound[1] < BLOFELD_SLOTS:
+                self.sounds[sound[0] * 128 + sound[1]] = bytearray(sound[2:])
+
+    def sound(self, bank, prog):
+        if bank == EDIT_BUFFER:
+            return self.edit_buffer
+        return self.sounds[bank * 128 + prog]
+
+    def process(self, message):
+        message = bytearray(message)
+        if len(message) < 6 or message[0] != INIT or message[-1] != END:
+            return []
+        if list(message) == IDENTITY_REQUEST:
+            return [self.identity()]
+        if message[1:3] != bytearray((IDW, IDE)):
+            return []
+        if message[3] not in (self.device_id, BROADCAST) and self.device_id != BROADCAST:
+            return []
+        handler = self.handlers.get(message[4])
+        if handler is None:
+            return []
+        return handler(message) or []
+
+    def identity(self):
+        return bytearray([INIT, 0x7e, self.device_id, 0x6, 0x2, IDW, IDE, 0, 0, 0]) + \
+            bytearray(FIRMWARE.ljust(4)) + bytearray((END, ))
+
+    def sound_request(self, message):
+        bank, prog = message[5:7]
+        if bank != EDIT_BUFFER and bank * 128 + prog >= BLOFELD_SLOTS:
+            return
+        reply = encode_sound(bank, prog, self.sound(bank, prog), self.device_id)
+        reply[-2] = _checksum(reply[5:-2])
+        return [reply]
+
+    def sound_dump(self, message):
+        if len(message) != SOUND_MSG_SIZE:
+            return
+        bank, prog = message[5:7]
+        if bank != EDIT_BUFFER and bank * 128 + prog >= BLOFELD_SLOTS:
+            return
+        self.sound(bank, prog)[:] = message[7:7 + SOUND_DATA_SIZE]
+
+    def sound_parameter(self, message):
+        if len(message) != 10:
+            return
+        #only the sound mode edit buffer (location 0) is emulated
+        if message[5] != 0:
+            return
+        index = message[6] * 128 + message[7]
+        if index < SOUND_DATA_SIZE:
+            self.edit_buffer[index] = message[8]
+
+    def globals_request(self, message):
+        reply = bytearray([INIT, IDW, IDE, self.device_id, GLBD]) + self.globals
+        reply += bytearray((_checksum(self.globals), END))
+        return [reply]
+
+    def globals_dump(self, message):
+        data = message[5:-2]
+        if len(data) != GLOBALS_SIZE:
+            return
+        self.globals[:] = data
+        self.device_id = self.globals[37]
+
+    def wave_dump(self, message):
+        if len(message) != WAVE_MSG_SIZE:
+            return
+        slot, wave = message[5:7]
+        if wave >= WAVE_COUNT:
+            return
+        wavetable = self.wavetables.setdefault(slot, [None] * WAVE_COUNT)
+        wavetable[wave] = message[8:8 + WAVE_DATA_SIZE], message[8 + WAVE_DATA_SIZE:8 + WAVE_DATA_SIZE + 14]
+
+
+class EmulatorPort(object):
+    '''Output port object used by write_event, in place of rtmidi.MidiOut.'''
+    def __init__(self, seq):
+        self.seq = seq
+
+    def send_message(self, message):
+        if self.seq.connected(OUTPUT):
+            self.seq.receive(message)
+
+
+class EmulatorSequencer(QtCore.QObject):
+    ''' A fake sequencer object that emulates ALSA sequencer, with the
+    Bigglesworth input and output ports and the emulated Blofeld ports, as
+    single port clients (see RtMidiSequencer).
+
+    Received messages are processed by a BlofeldEmulator; replies are queued
+    after `latency` and the time needed to transfer them at MIDI speed, and
+    incoming messages are dropped with a `drop` probability; the seed
+    makes drops reproducible.'''
+    conn_created = QtCore.pyqtSignal(object)
+    conn_destroyed = QtCore.pyqtSignal(object)
+    client_created = QtCore.pyqtSignal(object)
+    client_destroyed = QtCore.pyqtSignal(object)
+    port_created = QtCore.pyqtSignal(object)
+    port_destroyed = QtCore.pyqtSignal(object)
+    graph_updated = QtCore.pyqtSignal()
+
+    def __init__(self, clientname, latency=EMULATOR_LATENCY, drop=EMULATOR_DROP, byte_rate=MIDI_BYTE_RATE, seed=0):
+        QtCore.QObject.__init__(self)
+        self.clientname = clientname
+        self.device = BlofeldEmulator()
+        self.latency = latency
+        self.drop = drop
+        self.byte_rate = float(byte_rate) if byte_rate else None
+        self.random = Random(seed)
+        self.default_in_caps = 66
+        self.default_out_caps = 33
+        self.default_type = 1048578
+        #client ids: our input and output, the Blofeld output and input
+        self.client_dict = {
+                            0: clientname + ':input',
+                            1: clientname + ':output',
+                            2: EMULATOR_NAME,
+                            3: EMULATOR_NAME,
+                            }
+        self.in_clients = set([0, 3])
+        self.connections = set()
+        self.ports = {OUTPUT: [EmulatorPort(self)]}
+        self.lock = Lock()
+        self.replies = []
+        self.busy = 0
+        self.received = self.dropped = 0
+
+    def connected(self, direction):
+        return ((1, 3) if direction == OUTPUT else (2, 0)) in self.connections
+
+    def receive(self, message):
+        #called from the output thread
+        with self.lock:
+            self.received += 1
+            if self.drop and self.random.random() < self.drop:
+                self.dropped += 1
+                return
+            replies = self.device.process(message)
+            now = time()
+            for reply in replies:
+                due = max(now + self.latency, self.busy)
+                if self.byte_rate:
+                    due += len(reply) / self.byte_rate
+                self.busy = due
+                heapq.heappush(self.replies, (due, reply))
+
+    def pending_replies(self):
+        '''Return the replies that are due, if the Blofeld output is connected.'''
+        now = time()
+        replies = []
+        with self.lock:
+            while self.replies and self.replies[0][0] <= now:
+                replies.append(heapq.heappop(self.replies)[1])
+        if not self.connected(INPUT):
+            return []
+        return replies
+
+    def update_graph(self):
+        return False
+
+    def connection_list(self):
+        return [(name, client_id, [(name, 0, ([], []))]) for client_id, name in self.client_dict.items()]
+
+    def get_client_info(self, client_id):
+        if not client_id in self.client_dict:
+            raise BaseException
+        return {
+                'name': self.client_dict[client_id],
+                'id': client_id,
+                'broadcast_filter': 0,
+                'error_bounce': 0,
+                'event_filter': '',
+                'event_lost': 0,
+                'num_ports': 1,
+                'type': 2
+                }
+
+    def get_port_info(self, port_id, client_id):
+        return {
+                'capability': self.default_in_caps if client_id in self.in_clients else self.default_out_caps,
+                'name': self.client_dict[client_id],
+                'type': self.default_type,
+                }
+
+    def _conn_info(self, source, dest):
+        return {'connect.sender.client': source, 'connect.sender.port': 0, 'connect.dest.client': dest, 'connect.dest.port': 0}
+
+    def connect_ports(self, source, dest, *args):
+        conn = source[0], dest[0]
+        if conn not in ((1, 3), (2, 0)) or conn in self.connections:
+            return
+        self.connections.add(conn)
+        self.conn_created.emit(self._conn_info(*conn))
+
+    def disconnect_ports(self, source, dest):
+        conn = source[0], dest[0]
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+        self.conn_destroyed.emit(self._conn_info(*conn))
+
+    def get_connect_info(self, source, dest):
+        if (source[0], dest[0]) not in self.connections:
+            raise KeyError('Connection does not exist')
+        return {'exclusive': 0, 'queue': 0, 'time_real': 0, 'time_update': 0}
+
+
+class MidiDevice(QtCore.QObject):
+    stopped = QtCore.pyqtSignal()
+    midi_event = QtCore.pyqtSignal(object)
+    midi_events = QtCore.pyqtSignal(object)
+
+    def __init__(self, main, latency=EMULATOR_LATENCY, drop=EMULATOR_DROP):
+        QtCore.QObject.__init__(self)
+        self.main = main
+        self.type = EMULATOR
+        self.active = False
+        self.seq = EmulatorSequencer(clientname='Bigglesworth', latency=latency, drop=drop)
+        #reported by the main object once the librarian exists
+        self.load_error = None
+        try:
+            self.seq.device.load_midi(local_path('presets/blofeld_fact_201200.mid'))
+        except Exception as e:
+            self.load_error = e
+        self.keep_going = True
+        self.graph = self.main.graph = Graph(self.seq)
+        self.seq.client_created.connect(self.graph.client_created)
+        self.seq.client_destroyed.connect(self.graph.client_destroyed)
+        self.seq.port_created.connect(self.graph.port_created)
+        self.seq.port_destroyed.connect(self.graph.port_destroyed)
+        self.seq.conn_created.connect(self.graph.conn_created)
+        self.seq.conn_destroyed.connect(self.graph.conn_destroyed)
+        self.input = self.graph.port_id_dict[0][0]
+        self.output = self.graph.port_id_dict[1][0]
+
+    def run(self):
+        self.active = True
+        while self.keep_going:
+            replies = self.seq.pending_replies()
+            if replies:
+                self.midi_events.emit([MidiEvent(SYSEX, port=0, sysex=reply, backend='emulator') for reply in replies])
+            else:
+                sleep(EMULATOR_POLL)
+        self.stopped.emit()
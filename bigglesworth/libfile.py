@@ -0,0 +1,384 @@
+#!/usr/bin/env python2.7
+# *-* coding: utf-8 *-*
+
+import mmap
+import struct
+import hashlib
+from collections import OrderedDict
+from os import path, rename, remove, stat
+
+from bigglesworth.const import STORED, SRC_LIBRARY
+from bigglesworth.codec import SOUND_DATA_SIZE, decode_sound
+from bigglesworth.libs import midifile
+
+LIBRARY_FILE = 'personal_library.bwl'
+LIBRARY_MAGIC = 'BWLIBRY\x00'
+LIBRARY_VERSION = 1
+
+#header: magic, version, header size, record size, index entry size, count, capacity, records offset
+_header = struct.Struct('<8sHHHHIII')
+HEADER_SIZE = 32
+#index entry: bank, prog, category, reserved, name (16)
+_index = struct.Struct('<BBBB16s')
+INDEX_SIZE = _index.size
+#record: bank, prog, sound data
+RECORD_SIZE = SOUND_DATA_SIZE + 2
+DEFAULT_CAPACITY = 1024
+#journal entry: record, bank, prog
+_journal = struct.Struct('<HBB')
+JOURNAL_LIMIT = 4096
+
+PRESET_MAGIC = 'BWPRSET\x00'
+#preset cache header: magic, source mtime, source size, source sha1, count
+_preset = struct.Struct('<8sdQ20sI')
+
+#one state file for each device id
+DEVICE_STATE_FILE = 'blofeld_state_{:02x}.bws'
+DEVICE_SLOTS = 1024
+HASH_SIZE = 20
+
+
+def _align(size, page=mmap.PAGESIZE):
+    return (size + page - 1) // page * page
+
+
+class LibraryRecord(object):
+    '''A sound read from the library file, with the attributes used by Library.addSoundBulk.'''
+    __slots__ = ('bank', 'prog', 'data', 'state', 'source')
+
+    def __init__(self, bank, prog, data):
+        self.bank = bank
+        self.prog = prog
+        self.data = data
+        self.state = STORED
+        self.source = SRC_LIBRARY
+
+
+class LibraryFile(object):
+    '''Fixed record personal library file, accessed through mmap.
+
+    The header is followed by the name/category index and by the sound records;
+    the records section is page aligned, so that single records can be rewritten
+    in place.
+    Location changes are appended to a journal file, which is applied when the
+    file is opened and merged into the records when it grows over JOURNAL_LIMIT.'''
+    def __init__(self, file_path):
+        self.path = file_path
+        self.journal_path = file_path + '.journal'
+        self.file = None
+        self.map = None
+        self.journal = None
+        self.journal_count = 0
+        self.moves = {}
+        self.count = 0
+        self.capacity = 0
+        self.records_offset = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError('Record {} does not exist'.format(i))
+        pos = self.records_offset + i * RECORD_SIZE
+        record = self.map[pos:pos + RECORD_SIZE]
+        bank, prog = self.moves.get(i, (ord(record[0]), ord(record[1])))
+        return LibraryRecord(bank, prog, record[2:])
+
+    @property
+    def isOpen(self):
+        return self.map is not None
+
+    def exists(self):
+        return path.exists(self.path)
+
+    def open(self):
+        self.close()
+        self.file = open(self.path, 'r+b')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            magic, version, header_size, record_size, index_size, count, capacity, records_offset = \
+                _header.unpack_from(self.map, 0)
+            if magic != LIBRARY_MAGIC:
+                raise ValueError('{} is not a library file'.format(self.path))
+            if version > LIBRARY_VERSION or record_size != RECORD_SIZE or index_size != INDEX_SIZE:
+                raise ValueError('Unsupported library file version {}'.format(version))
+            if records_offset + capacity * RECORD_SIZE > len(self.map):
+                raise ValueError('Library file {} is truncated'.format(self.path))
+        except:
+            self.close()
+            raise
+        self.count = count
+        self.capacity = capacity
+        self.records_offset = records_offset
+        self._replay()
+
+    def _replay(self):
+        self.moves = {}
+        self.journal_count = 0
+        if not path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as jf:
+            journal = jf.read()
+        #a truncated last entry is ignored
+        for pos in xrange(0, len(journal) - _journal.size + 1, _journal.size):
+            i, bank, prog = _journal.unpack_from(journal, pos)
+            if i < self.count:
+                self.moves[i] = bank, prog
+            self.journal_count += 1
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def create(self, sounds, capacity=None):
+        '''Write a new file from any sequence of objects with bank, prog and data attributes.'''
+        sounds = list(sounds)
+        count = len(sounds)
+        if capacity is None:
+            capacity = max(DEFAULT_CAPACITY, _align(count, DEFAULT_CAPACITY))
+        records_offset = _align(HEADER_SIZE + capacity * INDEX_SIZE)
+        index = bytearray(capacity * INDEX_SIZE)
+        records = bytearray(capacity * RECORD_SIZE)
+        for i, sound in enumerate(sounds):
+            data = bytearray(sound.data)
+            _index.pack_into(index, i * INDEX_SIZE, sound.bank, sound.prog, data[379], 0, str(data[363:379]))
+            pos = i * RECORD_SIZE
+            records[pos:pos + RECORD_SIZE] = bytearray((sound.bank, sound.prog)) + data
+        header = bytearray(HEADER_SIZE)
+        _header.pack_into(header, 0, LIBRARY_MAGIC, LIBRARY_VERSION, HEADER_SIZE, RECORD_SIZE, INDEX_SIZE,
+            count, capacity, records_offset)
+
+        self.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as of:
+            of.write(header)
+            of.write(index)
+            of.write(bytearray(records_offset - HEADER_SIZE - len(index)))
+            of.write(records)
+        if path.exists(self.path):
+            remove(self.path)
+        rename(temp_path, self.path)
+        if path.exists(self.journal_path):
+            remove(self.journal_path)
+        self.open()
+
+    def deduplicate(self):
+        '''Rewrite the file if more records share the same location.
+
+        Library slots are bound to records by position, and a sound added at a used
+        location replaces the existing one: each location keeps the position of its
+        first record and the data of the last one, as the library would.
+        Returns True if the file has been rewritten.'''
+        records = OrderedDict()
+        for record in self:
+            records[record.bank, record.prog] = record
+        if len(records) == self.count:
+            return False
+        self.create(records.values(), self.capacity)
+        return True
+
+    def write(self, i, bank, prog, data):
+        '''Rewrite a single record in place, returns False if the file has no room for it.'''
+        if self.map is None or i >= self.capacity:
+            return False
+        data = bytearray(data)
+        if i in self.moves:
+            #older journal entries would override the new location on replay
+            self.move(i, bank, prog)
+        _index.pack_into(self.map, HEADER_SIZE + i * INDEX_SIZE, bank, prog, data[379], 0, str(data[363:379]))
+        pos = self.records_offset + i * RECORD_SIZE
+        self.map[pos:pos + RECORD_SIZE] = str(bytearray((bank, prog)) + data)
+        if i >= self.count:
+            self.count = i + 1
+            _header.pack_into(self.map, 0, LIBRARY_MAGIC, LIBRARY_VERSION, HEADER_SIZE, RECORD_SIZE, INDEX_SIZE,
+                self.count, self.capacity, self.records_offset)
+        return True
+
+    def move(self, i, bank, prog):
+        '''Journal the new location of an existing record.'''
+        if self.map is None or i >= self.count:
+            return False
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'ab')
+        self.journal.write(_journal.pack(i, bank, prog))
+        self.moves[i] = bank, prog
+        self.journal_count += 1
+        if self.journal_count > JOURNAL_LIMIT:
+            self.compact()
+        return True
+
+    def compact(self):
+        '''Merge the journal into the records and truncate it.'''
+        if self.map is None:
+            return
+        for i, (bank, prog) in self.moves.items():
+            self.map[HEADER_SIZE + i * INDEX_SIZE:HEADER_SIZE + i * INDEX_SIZE + 2] = chr(bank) + chr(prog)
+            pos = self.records_offset + i * RECORD_SIZE
+            self.map[pos:pos + 2] = chr(bank) + chr(prog)
+        self.map.flush()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if path.exists(self.journal_path):
+            remove(self.journal_path)
+        self.moves = {}
+        self.journal_count = 0
+
+    def flush(self):
+        if self.journal is not None:
+            self.journal.flush()
+        if self.map is not None:
+            self.map.flush()
+
+
+
+def parse_preset(file_path):
+    '''Return the sounds of a midi file as 385 bytes strings (bank, prog, sound data).'''
+    sounds = []
+    for data in midifile.iter_sysex(file_path):
+        sounds.append(str(bytearray(decode_sound(data, 6))))
+    return sounds
+
+def sound_hash(data):
+    return hashlib.sha1(bytearray(data)).digest()
+
+def _file_hash(file_path):
+    with open(file_path, 'rb') as sf:
+        return hashlib.sha1(sf.read()).digest()
+
+
+class PresetCache(object):
+    '''Parsed sound sets, stored as plain records along with the mtime, size and
+    hash of their source file; a changed mtime only invalidates the cache if the
+    file contents have changed too.'''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def cache_path(self, source_path):
+        source_path = path.abspath(source_path)
+        name = path.splitext(path.basename(source_path))[0]
+        return path.join(self.cache_dir, '{}-{}.bwc'.format(name, hashlib.sha1(source_path).hexdigest()[:12]))
+
+    def load(self, source_path):
+        cache_path = self.cache_path(source_path)
+        if not path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, 'rb') as cf:
+                cache = cf.read()
+            magic, mtime, size, digest, count = _preset.unpack_from(cache, 0)
+            if magic != PRESET_MAGIC or len(cache) != _preset.size + count * RECORD_SIZE:
+                return None
+            source_stat = stat(source_path)
+            if source_stat.st_size != size:
+                return None
+            if source_stat.st_mtime != mtime:
+                if _file_hash(source_path) != digest:
+                    return None
+                self.save(source_path, cache[_preset.size:])
+        except (IOError, OSError, struct.error):
+            return None
+        sound_list = []
+        for pos in xrange(_preset.size, len(cache), RECORD_SIZE):
+            sound_list.append(LibraryRecord(ord(cache[pos]), ord(cache[pos + 1]), cache[pos + 2:pos + RECORD_SIZE]))
+        return sound_list
+
+    def save(self, source_path, sounds):
+        '''Sounds are either a sequence of records (see parse_preset) or their concatenation.'''
+        records = ''.join(sounds)
+        source_stat = stat(source_path)
+        header = _preset.pack(PRESET_MAGIC, source_stat.st_mtime, source_stat.st_size, _file_hash(source_path),
+            len(records) // RECORD_SIZE)
+        cache_path = self.cache_path(source_path)
+        temp_path = cache_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as cf:
+                cf.write(header)
+                cf.write(records)
+            if path.exists(cache_path):
+                remove(cache_path)
+            rename(temp_path, cache_path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def preload(self, source_list):
+        '''Parse and cache all the missing sound sets.'''
+        for source_path in source_list:
+            if not path.exists(self.cache_path(source_path)):
+                self.save(source_path, parse_preset(source_path))
+
+
+class DeviceState(object):
+    '''Hashes of the sounds last read from or written to each Blofeld slot,
+    stored as a plain sequence of sha1 digests (all zeros for unknown slots).'''
+    def __init__(self, file_path):
+        self.path = file_path
+        self.hashes = [None] * DEVICE_SLOTS
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as sf:
+                state = sf.read()
+        except (IOError, OSError):
+            return
+        if len(state) != DEVICE_SLOTS * HASH_SIZE:
+            return
+        for slot in xrange(DEVICE_SLOTS):
+            digest = state[slot * HASH_SIZE:(slot + 1) * HASH_SIZE]
+            self.hashes[slot] = digest if digest.strip('\x00') else None
+        self.dirty = False
+
+    def save(self):
+        if not self.dirty:
+            return True
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as sf:
+                sf.write(''.join(digest or '\x00' * HASH_SIZE for digest in self.hashes))
+            if path.exists(self.path):
+                remove(self.path)
+            rename(temp_path, self.path)
+        except (IOError, OSError):
+            return False
+        self.dirty = False
+        return True
+
+    def update(self, bank, prog, data):
+        slot = bank * 128 + prog
+        if not 0 <= slot < DEVICE_SLOTS:
+            return
+        digest = sound_hash(data)
+        if self.hashes[slot] != digest:
+            self.hashes[slot] = digest
+            self.dirty = True
+
+    def forget(self, bank, prog):
+        slot = bank * 128 + prog
+        if 0 <= slot < DEVICE_SLOTS and self.hashes[slot] is not None:
+            self.hashes[slot] = None
+            self.dirty = True
+
+    def known(self, bank, prog):
+        return self.hashes[bank * 128 + prog] is not None
+
+    def differs(self, sound):
+        return self.hashes[sound.bank * 128 + sound.prog] != sound_hash(sound.data)
+
+    def diff(self, sounds):
+        '''Return the sounds that are not known to be on the device.'''
+        return [sound for sound in sounds if sound is not None and sound.bank * 128 + sound.prog < DEVICE_SLOTS
+            and self.differs(sound)]
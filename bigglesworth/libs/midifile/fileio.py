@@ -2,7 +2,7 @@ from warnings import *
 
 from containers import *
 from events import *
-from struct import unpack, pack
+from struct import unpack, unpack_from, pack
 from constants import *
 from util import *
 
@@ -99,6 +99,108 @@ class FileReader(object):
                 return cls(tick=tick, channel=channel, data=data)
         raise Warning, "Unknown MIDI Event: " + `stsmsg`
 
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        datum = data[pos]
+        pos += 1
+        value = (value << 7) | (datum & 0x7F)
+        if not datum & 0x80:
+            return value, pos
+
+class FastFileReader(FileReader):
+    # Parses the whole file from memory by offset instead of iterating over
+    # single bytes; sysex data is returned as memoryview slices of the file
+    # contents (same bytes as FileReader, varlen length included).
+    def read(self, midifile):
+        self.load(midifile)
+        pattern, pos = self.parse_buffer_header()
+        for track in pattern:
+            start, pos = self.parse_buffer_track_header(pos)
+            track.extend(self.parse_events(start, pos))
+        return pattern
+
+    def iter_sysex(self, midifile):
+        self.load(midifile)
+        pattern, pos = self.parse_buffer_header()
+        for track in pattern:
+            start, pos = self.parse_buffer_track_header(pos)
+            for data in self.parse_events(start, pos, sysex_only=True):
+                yield data
+
+    def load(self, midifile):
+        self.buffer = midifile.read()
+        self.bytes = bytearray(self.buffer)
+        self.view = memoryview(self.buffer)
+
+    def parse_buffer_header(self):
+        if self.buffer[:4] != 'MThd':
+            raise TypeError, "Bad header in MIDI file."
+        hdrsz, format, tracks, resolution = unpack_from(">LHHH", self.buffer, 4)
+        tracks = [Track() for x in range(tracks)]
+        return Pattern(tracks=tracks, resolution=resolution, format=format), 8 + hdrsz
+
+    def parse_buffer_track_header(self, pos):
+        magic = self.buffer[pos:pos + 4]
+        if magic != 'MTrk':
+            raise TypeError, "Bad track header in MIDI file: " + magic
+        trksz = unpack_from(">L", self.buffer, pos + 4)[0]
+        start = pos + 8
+        # a truncated track is parsed up to the end of the file, as FileReader does
+        return start, min(start + trksz, len(self.buffer))
+
+    def parse_events(self, pos, end, sysex_only=False):
+        buffer = self.buffer
+        data = self.bytes
+        view = self.view
+        running = None
+        # incomplete events at the end of a track are ignored, as in FileReader
+        try:
+            while pos < end:
+                tick, pos = _read_varlen(data, pos)
+                if pos >= end:
+                    return
+                stsmsg = data[pos]
+                pos += 1
+                if stsmsg == 0xFF:
+                    cmd = data[pos]
+                    datalen, pos = _read_varlen(data, pos + 1)
+                    if pos + datalen > end:
+                        return
+                    if not sysex_only:
+                        if cmd not in EventRegistry.MetaEvents:
+                            warn("Unknown Meta MIDI Event: " + `cmd`, Warning)
+                            cls = UnknownMetaEvent
+                        else:
+                            cls = EventRegistry.MetaEvents[cmd]
+                        yield cls(tick=tick, data=list(data[pos:pos + datalen]), metacommand=cmd)
+                    pos += datalen
+                elif stsmsg == 0xF0:
+                    stop = buffer.find('\xf7', pos, end)
+                    if stop < 0:
+                        return
+                    if sysex_only:
+                        yield view[pos:stop]
+                    else:
+                        yield SysexEvent(tick=tick, data=view[pos:stop])
+                    pos = stop + 1
+                else:
+                    key = stsmsg & 0xF0
+                    if key not in EventRegistry.Events:
+                        assert running, "Bad byte value"
+                        cls = EventRegistry.Events[running & 0xF0]
+                        pos -= 1
+                    else:
+                        running = stsmsg
+                        cls = EventRegistry.Events[key]
+                    if pos + cls.length > end:
+                        return
+                    if not sysex_only:
+                        yield cls(tick=tick, channel=running & 0x0F, data=list(data[pos:pos + cls.length]))
+                    pos += cls.length
+        except IndexError:
+            return
+
 class FileWriter(object):
     def write(self, midifile, pattern):
         self.write_file_header(midifile, pattern)
@@ -114,44 +216,61 @@ class FileWriter(object):
         midifile.write('MThd%s' % packdata)
             
     def write_track(self, midifile, track):
-        buf = ''
+        # every event takes at most 11 bytes more than its data (4 for the
+        # tick, status, meta command, 4 for the length and the sysex end),
+        # so the whole track is encoded in a single preallocated buffer
         self.RunningStatus = None
+        buf = bytearray(8 + sum(len(event.data) + 11 for event in track))
+        pos = 8
         for event in track:
-            buf += self.encode_midi_event(event)
-        buf = self.encode_track_header(len(buf)) + buf
+            pos = self.encode_midi_event_into(buf, pos, event)
+        del buf[pos:]
+        buf[:8] = self.encode_track_header(pos - 8)
         midifile.write(buf)
 
     def encode_track_header(self, trklen):
         return 'MTrk%s' % pack(">L", trklen)
 
     def encode_midi_event(self, event):
-        ret = ''
-        ret += write_varlen(event.tick)
+        buf = bytearray(len(event.data) + 11)
+        pos = self.encode_midi_event_into(buf, 0, event)
+        return str(buf[:pos])
+
+    def encode_midi_event_into(self, buf, pos, event):
+        pos = write_varlen_into(buf, pos, event.tick)
+        datalen = len(event.data)
         # is the event a MetaEvent?
         if isinstance(event, MetaEvent):
-            ret += chr(event.statusmsg) + chr(event.metacommand)
-            ret += write_varlen(len(event.data))
-            ret += str.join('', map(chr, event.data))
+            buf[pos] = event.statusmsg
+            buf[pos + 1] = event.metacommand
+            pos = write_varlen_into(buf, pos + 2, datalen)
+            buf[pos:pos + datalen] = event.data
+            pos += datalen
         # is this event a Sysex Event?
         elif isinstance(event, SysexEvent):
-            ret += chr(0xF0)
-            ret += str.join('', map(chr, event.data))
-            ret += chr(0xF7)
+            buf[pos] = 0xF0
+            buf[pos + 1:pos + 1 + datalen] = event.data
+            pos += 1 + datalen
+            buf[pos] = 0xF7
+            pos += 1
         # not a Meta MIDI event or a Sysex event, must be a general message
         elif isinstance(event, Event):
             if not self.RunningStatus or \
                 self.RunningStatus.statusmsg != event.statusmsg or \
                 self.RunningStatus.channel != event.channel:
                     self.RunningStatus = event
-                    ret += chr(event.statusmsg | event.channel)
-            ret += str.join('', map(chr, event.data))
+                    buf[pos] = event.statusmsg | event.channel
+                    pos += 1
+            buf[pos:pos + datalen] = event.data
+            pos += datalen
         else:
             raise ValueError, "Unknown MIDI Event: " + str(event)
-        return ret
+        return pos
 
 def write_midifile(midifile, pattern):
     if type(midifile) in (str, unicode):
-        midifile = open(midifile, 'wb')
+        with open(midifile, 'wb') as midifile:
+            return FileWriter().write(midifile, pattern)
     writer = FileWriter()
     return writer.write(midifile, pattern)
 
@@ -160,3 +279,13 @@ def read_midifile(midifile):
         midifile = open(midifile, 'rb')
     reader = FileReader()
     return reader.read(midifile)
+
+def iter_sysex(midifile):
+    '''Yield the data of all the sysex events of a file, as memoryview slices.'''
+    if type(midifile) in (str, unicode):
+        with open(midifile, 'rb') as midifile:
+            for data in FastFileReader().iter_sysex(midifile):
+                yield data
+    else:
+        for data in FastFileReader().iter_sysex(midifile):
+            yield data
@@ -36,3 +36,17 @@ def write_varlen(value):
         res = chr1
     return res
 
+
+def write_varlen_into(buf, pos, value):
+    # same encoding as write_varlen, written in place; returns the new position
+    if value >> 21:
+        buf[pos] = ((value >> 21) & 0x7F) | 0x80
+        pos += 1
+    if value >> 14:
+        buf[pos] = ((value >> 14) & 0x7F) | 0x80
+        pos += 1
+    if value >> 7:
+        buf[pos] = ((value >> 7) & 0x7F) | 0x80
+        pos += 1
+    buf[pos] = value & 0x7F
+    return pos + 1
@@ -3,7 +3,10 @@
 
 import struct
 from threading import Lock
+from collections import OrderedDict
+from Queue import PriorityQueue, Empty
 from const import *
+from codec import encode_sound
 try:
     from pyalsa import alsaseq
     ALSA = True
@@ -301,11 +304,77 @@ def _make_property(type, data, name=None):
     def setter(self, value):
         self._check_type_attribute(type, name)
         setattr(self, data, value)
+        self._event = self._binary = None
     return property(getter, setter)
 
+def _check_sysex(sysex):
+    if sysex is None or isinstance(sysex, SysExMessage):
+        return sysex
+    try:
+        if isinstance(sysex, str):
+            sysex = [int(byte, 16) for byte in sysex.split()]
+        for byte in sysex:
+            if not 0 <= byte <= 0xff:
+                raise ValueError
+        return sysex
+    except:
+        raise ValueError('String {} is not a valid SysEx string'.format(sysex))
+
+class SysExMessage(object):
+    '''Immutable sysex message: indexing returns integer values, slices are
+    memoryviews of the message data.
+
+    The data is copied once into a str on creation (the ALSA reassembly buffer is
+    reused for the next message), then slicing and decoding do not copy it again.'''
+    __slots__ = ('data', 'view')
+
+    def __init__(self, data):
+        if not isinstance(data, str):
+            data = str(data)
+        object.__setattr__(self, 'data', data)
+        object.__setattr__(self, 'view', memoryview(data))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SysExMessage is immutable')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view[index]
+        return ord(self.data[index])
+
+    def __iter__(self):
+        return iter(bytearray(self.data))
+
+    def __eq__(self, other):
+        if isinstance(other, SysExMessage):
+            return self.data == other.data
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def tolist(self):
+        return list(bytearray(self.data))
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
 class MidiEvent(object):
+    '''MIDI event value; sysex data is validated on creation and the ALSA and
+    rtmidi encodings are computed only once.'''
+    __slots__ = ('backend', '_type', 'port', 'channel', 'data1', 'data2', '_sysex', 'source', 'dest', 'queue',
+        '_event', '_binary')
+
     def __init__(self, event_type=None, port=0, channel=0, data1=0, data2=0, sysex=None, event=None, source=None, dest=None, backend=None):
         self.backend = backend
+        self._binary = None
         if event:
             self._event = event
             self.source = tuple(map(int, event.source))
@@ -358,10 +427,24 @@ class MidiEvent(object):
             self.channel = channel
             self.data1 = data1
             self.data2 = data2
-            self._sysex = sysex
+            self._sysex = _check_sysex(sysex)
             self.queue = 0
             self._event = None
 
+    @classmethod
+    def _sysex_event(cls, port, sysex):
+        #trusted sysex data, skips validation
+        event = object.__new__(MidiEvent)
+        event.backend = None
+        event._type = SYSEX
+        event.port = port
+        event.channel = event.data1 = event.data2 = None
+        event._sysex = sysex
+        event.source = event.dest = None
+        event.queue = 0
+        event._event = event._binary = None
+        return event
+
     def _check_type_attribute(self, type, name):
         if not self.type & type:
             message = ('MidiEvent type \'{ev}\' has no attribute \'{t}\''.format(ev=self.type, t=name))
@@ -433,24 +516,12 @@ class MidiEvent(object):
 
     @property
     def sysex(self):
-        try:
-            if isinstance(self._sysex, str):
-                self._sysex = [int(byte, 16) for byte in self._sysex.split()]
-            [hex(byte) for byte in self._sysex]
-            return self._sysex
-        except:
-            raise ValueError('String {} is not a valid SysEx string'.format(self._sysex))
+        return self._sysex
 
     @sysex.setter
     def sysex(self, sysex):
-        try:
-            if isinstance(sysex, str):
-                self._sysex = [int(byte, 16) for byte in sysex.split()]
-                return
-            [hex(byte) for byte in sysex]
-            self._sysex = sysex
-        except:
-            raise ValueError('String {} is not a valid SysEx string'.format(sysex))
+        self._sysex = _check_sysex(sysex)
+        self._event = self._binary = None
 
     def get_event(self):
         if not self._event:
@@ -466,7 +537,7 @@ class MidiEvent(object):
                 data = {'control.channel': self.channel, 'control.value': self.data2}
                 self._event.set_data(data)
             elif self._type == SYSEX:
-                data = {'ext': self.sysex}
+                data = {'ext': list(self._sysex)}
                 self._event.set_data(data)
             elif self._type == SYSTEM:
                 data = {'result.event': self.data1, 'result.result': self.data2}
@@ -481,12 +552,14 @@ class MidiEvent(object):
         return self._event
 
     def get_binary(self):
-        if self._type in [NOTEON, NOTEOFF, POLY_AFTERTOUCH, CTRL]:
-            return _event_to_bits[self._type] + self.channel, self.data1, self.data2
-        elif self._type == PROGRAM:
-            return _event_to_bits[self._type] + self.channel, self.data2
-        elif self._type == SYSEX:
-            return self.sysex
+        if self._binary is None:
+            if self._type in [NOTEON, NOTEOFF, POLY_AFTERTOUCH, CTRL]:
+                self._binary = _event_to_bits[self._type] + self.channel, self.data1, self.data2
+            elif self._type == PROGRAM:
+                self._binary = _event_to_bits[self._type] + self.channel, self.data2
+            elif self._type == SYSEX:
+                self._binary = list(self._sysex)
+        return self._binary
 
     @classmethod
     def from_jack(cls, port, event):
@@ -648,6 +721,45 @@ class SysExEvent(MidiEvent):
     def alsa_event(cls, port, sysex):
         return MidiEvent.alsa_event(SYSEX, port, None, None, None, sysex)
 
+class SoundParameterTemplates(object):
+    '''Ready SNDP messages for every parameter, with the device id already set:
+    a parameter change only needs a copy of the template with its location and
+    value bytes patched.'''
+    def __init__(self, device_id=BROADCAST):
+        self.device_id = None
+        self.templates = {}
+        self.build(device_id)
+
+    def build(self, device_id):
+        if device_id == self.device_id:
+            return
+        self.device_id = device_id
+        self.templates = {}
+        for index, param in enumerate(Params.param_list):
+            if param.attr is None:
+                continue
+            par_high, par_low = divmod(index, 128)
+            self.templates[param.attr] = bytearray((INIT, IDW, IDE, device_id, SNDP, 0, par_high, par_low, 0, END))
+
+    def event(self, port, attr, value, location=0):
+        #each event needs its own buffer: OutputQueue and the output thread keep
+        #references to queued events, patching a shared one would change them too
+        sysex = bytearray(self.templates[attr])
+        sysex[5] = location
+        sysex[8] = value
+        event = MidiEvent._sysex_event(port, sysex)
+        #the message is never changed, it can be used as the rtmidi encoding too
+        event._binary = sysex
+        return event
+
+class SoundRequestEvent(MidiEvent):
+    def __new__(self, port, device_id, bank, prog):
+        return MidiEvent._sysex_event(port, [INIT, IDW, IDE, device_id, SNDR, bank, prog, CHK, END])
+
+class SoundDumpEvent(MidiEvent):
+    def __new__(self, port, device_id, bank, prog, data):
+        return MidiEvent._sysex_event(port, list(encode_sound(bank, prog, data, device_id)))
+
 class SysRtResetEvent(MidiEvent):
     def __new__(self, port):
         return MidiEvent(SYSRT_RESET, port, None, None, None)
@@ -663,50 +775,227 @@ class SysRtResetEvent(MidiEvent):
 #TODO: finish event types
 
 
+#MIDI DIN speed: 31250 baud, 10 bits per byte
+MIDI_BYTE_RATE = 3125
+
+#output priorities: only system realtime messages (clock and transport) are sent
+#before the queued events, channel messages and sysex keep their order
+PRIORITY_REALTIME, PRIORITY_NORMAL = 0, 1
+_realtime_types = frozenset((SYSRT_CLOCK, SYSRT_START, SYSRT_CONTINUE, SYSRT_STOP, SYSRT_SENSING, SYSRT_RESET))
+OUTPUT_QUEUE_SIZE = 1024
+OUTPUT_BATCH_SIZE = 16
+
+class OutputThread(QtCore.QThread):
+    '''Sends events from a bounded priority queue, outside the GUI thread.
+
+    write is called for each event, drain (if any) once for every batch of
+    events found in the queue; system realtime events are sent first, any other
+    event is sent in the order it was queued. Errors are not raised in the
+    thread, but emitted with the event that failed (None for drain errors).'''
+    error = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, write, drain=None, maxsize=OUTPUT_QUEUE_SIZE, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.write = write
+        self.drain = drain
+        self.queue = PriorityQueue(maxsize)
+        self.count = 0
+        self.lock = Lock()
+
+    def put(self, event):
+        priority = PRIORITY_REALTIME if event.type in _realtime_types else PRIORITY_NORMAL
+        with self.lock:
+            self.count += 1
+            count = self.count
+        self.queue.put((priority, count, event))
+
+    def stop(self):
+        if not self.isRunning():
+            return
+        #lowest priority, so that the queued events are sent before quitting
+        with self.lock:
+            self.count += 1
+            count = self.count
+        self.queue.put((PRIORITY_NORMAL + 1, count, None))
+        self.wait()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()[2]]
+            #small batches, so that realtime events do not wait for a long sysex list
+            try:
+                while len(batch) < OUTPUT_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait()[2])
+            except Empty:
+                pass
+            for event in batch:
+                if event is None:
+                    break
+                try:
+                    self.write(event)
+                except Exception as e:
+                    self.error.emit(event, e)
+            if self.drain:
+                try:
+                    self.drain()
+                except Exception as e:
+                    self.error.emit(None, e)
+            if None in batch:
+                return
+
+
+class OutputQueue(QtCore.QObject):
+    '''Rate limiter for all outgoing events, sharing a single byte budget.
+
+    Events are sent in order within the given bandwidth (bytes per second), so
+    that parameter changes and bulk dumps do not overrun the MIDI link together;
+    a message larger than the burst allowance waits for a full budget. Pending
+    SNDP changes are coalesced by (location, parameter), so that only the latest
+    value is sent; a change queued after other events is moved after them. System realtime events are never delayed.'''
+    output = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent=None, bandwidth=MIDI_BYTE_RATE, interval=20):
+        QtCore.QObject.__init__(self, parent)
+        self.bandwidth = bandwidth
+        #allow bursts of about two flush intervals
+        self.burst = max(bandwidth * interval * 2 / 1000, 16)
+        self.budget = self.burst
+        self.last = time()
+        #SNDP changes are keyed by location and parameter, any other event by its count
+        self.pending = OrderedDict()
+        self.count = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def refill(self):
+        now = time()
+        self.budget = min(self.burst, self.budget + (now - self.last) * self.bandwidth)
+        self.last = now
+
+    def put(self, event):
+        if event.type in _realtime_types:
+            self.output.emit(event)
+            return
+        key = None
+        if event.type == SYSEX:
+            sysex = event.sysex
+            if len(sysex) >= 9 and sysex[4] == SNDP:
+                key = sysex[5], sysex[6], sysex[7]
+        if key is None:
+            self.count += 1
+            key = self.count
+        elif key in self.pending and next(reversed(self.pending)) != key:
+            #other events were queued after it, the new value must follow them
+            del self.pending[key]
+        self.pending[key] = event
+        if not self.timer.isActive():
+            self.flush()
+
+    def flush(self, force=False):
+        self.refill()
+        while self.pending:
+            key = next(iter(self.pending))
+            event = self.pending[key]
+            size = len(event.sysex) if event.type == SYSEX else 3
+            if self.budget < min(size, self.burst) and not force:
+                break
+            del self.pending[key]
+            self.budget -= size
+            self.output.emit(event)
+        if self.pending:
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def clear(self):
+        self.pending.clear()
+        self.timer.stop()
+
+
 class ConnList(object):
+    '''Connections of a port, indexed by (source address, destination address);
+    the count of visible (not hidden) connections is kept for both directions.'''
     def __init__(self, port, output=None, input=None):
         self.port = port
-        self.input = [] if input is None else input
-        self.output = [] if output is None else output
+        self.input_dict = OrderedDict()
+        self.output_dict = OrderedDict()
+        self.visible_input = self.visible_output = 0
+        for conn in input or []:
+            self._add(self.input_dict, conn)
+        for conn in output or []:
+            self._add(self.output_dict, conn)
+
+    @property
+    def input(self):
+        return self.input_dict.values()
+
+    @property
+    def output(self):
+        return self.output_dict.values()
+
+    @property
+    def visible(self):
+        return self.visible_input + self.visible_output
 
     def __iter__(self):
-        for conn in self.input+self.output:
+        for conn in self.input_dict.itervalues():
+            yield conn
+        for conn in self.output_dict.itervalues():
             yield conn
 
     def __len__(self):
-        return len(self.input+self.output)
+        return len(self.input_dict) + len(self.output_dict)
+
+    def __contains__(self, key):
+        if isinstance(key, Connection):
+            key = key.key
+        return key in self.input_dict or key in self.output_dict
 
     def __repr__(self):
         return 'Input: {}\nOutput: {}'.format(self.input, self.output)
 
+    def _add(self, conn_dict, conn):
+        if conn.key in conn_dict:
+            return
+        conn_dict[conn.key] = conn
+        if not conn.hidden:
+            if conn_dict is self.input_dict:
+                self.visible_input += 1
+            else:
+                self.visible_output += 1
+
     def append(self, conn):
         if self.port.is_duplex:
             if conn.src==conn.dest:
-                if not conn in self.input:
-                    self.input.append(conn)
+                if not conn.key in self.input_dict:
+                    self._add(self.input_dict, conn)
                 #check for errors
-                elif not conn in self.output:
-                    self.output.append(conn)
+                else:
+                    self._add(self.output_dict, conn)
             else:
-                if self.port == conn.src and not conn in self.output:
-                    self.output.append(conn)
-                elif not conn in self.input:
-                    self.input.append(conn)
-        elif self.port.is_input and not conn in self.input:
-            self.input.append(conn)
-        elif not conn in self.output:
-            self.output.append(conn)
+                if self.port == conn.src:
+                    self._add(self.output_dict, conn)
+                else:
+                    self._add(self.input_dict, conn)
+        elif self.port.is_input:
+            self._add(self.input_dict, conn)
+        else:
+            self._add(self.output_dict, conn)
 
     def remove(self, conn):
-        try:
-            self.input.remove(conn)
-            conn.lostEvent()
-        except:
-            try:
-                self.output.remove(conn)
+        for conn_dict in self.input_dict, self.output_dict:
+            if conn_dict.pop(conn.key, None) is not None:
+                if not conn.hidden:
+                    if conn_dict is self.input_dict:
+                        self.visible_input -= 1
+                    else:
+                        self.visible_output -= 1
                 conn.lostEvent()
-            except:
-                pass
+                return
 
 class Connection(QtCore.QObject):
     lost = QtCore.pyqtSignal()
@@ -716,6 +1005,7 @@ class Connection(QtCore.QObject):
         self.seq = graph.seq
         self.src = src
         self.dest = dest
+        self.key = src.addr, dest.addr
         self.hidden = not show
         self.info = self.seq.get_connect_info(src.addr, dest.addr)
         self.exclusive = self.info.get('exclusive', 0)
@@ -735,9 +1025,13 @@ class Connection(QtCore.QObject):
     def __eq__(self, other):
         if not isinstance(other, Connection):
             return False
-        if self.src == other.src and self.dest == other.dest:
-            return True
-        return False
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __repr__(self):
         try:
@@ -846,7 +1140,7 @@ class Port(QtCore.QObject):
 
     def disconnect_all(self, dir=None, skip_hidden=True):
         if not dir:
-            for conn in self.graph.get_port_connections(self):
+            for conn in list(self.connections):
                 if skip_hidden and conn.hidden:
                     continue
                 try:
@@ -962,13 +1256,15 @@ class Graph(QtCore.QObject):
     def __init__(self, seq):
         QtCore.QObject.__init__(self)
         self.seq = seq
-        if seq.__class__.__name__ == 'RtMidiSequencer':
+        if seq.__class__.__name__ in ('RtMidiSequencer', 'EmulatorSequencer'):
             self.backend = RTMIDI
         else:
             self.backend = ALSA
         self.client_id_dict = {}
         self.port_id_dict = {}
         self.connections = {}
+        #(source address, destination address): connection
+        self.conn_dict = {}
         graph_raw = seq.connection_list()
         conn_raw = []
         for client_name, client_id, ports in graph_raw:
@@ -988,9 +1284,9 @@ class Graph(QtCore.QObject):
         for conn_src, conn_dest in conn_set:
             src = self.get_port(*conn_src)
             dest = self.get_port(*conn_dest)
-            conn = Connection(self, src, dest, False if any([src.hidden, dest.hidden]) else True)
-            self.connections[src].append(conn)
-            self.connections[dest].append(conn)
+            self.add_connection(src, dest)
+        if self.backend == RTMIDI:
+            seq.graph_updated.connect(self.prune_connections)
 
 
     def get_port(self, client_id, port_id):
@@ -1000,33 +1296,51 @@ class Graph(QtCore.QObject):
             return None
 
     def get_port_connections(self, port):
-        try:
-            for conn in self.connections[port]:
-                try:
-                    self.seq.get_connect_info(conn.src.addr, conn.dest.addr)
-                except:
-                    #conn_register.emit was first for ALSA, now is last for rtmidi: be careful.
-                    self.connections[conn.src].remove(conn)
-                    self.connections[conn.dest].remove(conn)
+        return self.connections.get(port)
+
+    def prune_connections(self):
+        '''Remove the connections the sequencer does not know anymore. Only needed for
+        rtmidi and the emulator, which do not notify connections closed elsewhere.'''
+        if self.backend == ALSA:
+            return False
+        removed = False
+        for conn in self.conn_dict.values():
+            try:
+                self.seq.get_connect_info(conn.src.addr, conn.dest.addr)
+            except Exception:
+                if self.remove_connection(conn):
                     self.conn_register.emit(conn, False)
-                    del conn
-            return self.connections[port]
-        except KeyError:
-            return None
-        except Exception as err:
-            print 'Unknown exception ({}): {}'.format(type(err), err)
+                    removed = True
+        if removed:
+            self.graph_changed.emit()
+        return removed
+
+    def add_connection(self, src, dest):
+        key = src.addr, dest.addr
+        if key in self.conn_dict:
             return None
+        conn = Connection(self, src, dest, False if any([src.hidden, dest.hidden]) else True)
+        self.conn_dict[key] = conn
+        self.connections[src].append(conn)
+        self.connections[dest].append(conn)
+        return conn
 
+    def remove_connection(self, conn):
+        if self.conn_dict.pop(conn.key, None) is None:
+            return False
+        for port in conn.src, conn.dest:
+            if port in self.connections:
+                self.connections[port].remove(conn)
+        return True
+
+    def remove_port_connections(self, port):
+        #a destroyed port loses all its connections
+        for conn in list(self.connections.get(port, [])):
+            if self.remove_connection(conn):
+                self.conn_register.emit(conn, False)
 
     def conn_deleted(self, conn):
-        try:
-            self.connections[conn.src].remove(conn)
-        except:
-            pass
-        try:
-            self.connections[conn.dest].remove(conn)
-        except:
-            pass
+        self.remove_connection(conn)
         self.graph_changed.emit()
 
     def client_created(self, data):
@@ -1041,8 +1355,7 @@ class Graph(QtCore.QObject):
         client_id = data['addr.client']
         client = self.client_id_dict[client_id]
         for port in client.port_dict.values():
-            #since ALSA (should have) disconnected all client's port, get_port_connections will take care of their removal
-            self.get_port_connections(port)
+            self.remove_port_connections(port)
             client.remove_port(port)
         client = self.client_id_dict.pop(client_id)
         self.client_exit.emit(client)
@@ -1059,7 +1372,7 @@ class Graph(QtCore.QObject):
         client_id = data['addr.client']
         client = self.client_id_dict[client_id]
         port = self.port_id_dict[client_id].pop(data['addr.port'])
-        self.get_port_connections(port)
+        self.remove_port_connections(port)
         client.remove_port(port)
         self.connections.pop(port)
         self.port_exit.emit(port)
@@ -1070,17 +1383,17 @@ class Graph(QtCore.QObject):
 #        if dest.client.id == self.seq.client_id:
 #            return
         src = self.get_port(data['connect.sender.client'], data['connect.sender.port'])
-        conn = Connection(self, src, dest, False if any([src.hidden, dest.hidden]) else True)
-        self.connections[src].append(conn)
-        self.connections[dest].append(conn)
+        conn = self.add_connection(src, dest)
+        if conn is None:
+            return
         self.conn_register.emit(conn, True)
         self.graph_changed.emit()
 
     def conn_destroyed(self, data):
-        src = self.get_port(data['connect.sender.client'], data['connect.sender.port'])
-#        dest = self.get_port(data['connect.dest.client'], data['connect.dest.port'])
-        #this should be enough, since the cycle in get_port_connections takes care of removing all connections
-        self.get_port_connections(src)
+        key = (data['connect.sender.client'], data['connect.sender.port']), (data['connect.dest.client'], data['connect.dest.port'])
+        conn = self.conn_dict.get(key)
+        if conn is not None and self.remove_connection(conn):
+            self.conn_register.emit(conn, False)
         self.graph_changed.emit()
 
     def graph_full(self, full_port=False, full_conn=False):
@@ -17,6 +17,7 @@ class RtMidiSequencer(QtCore.QObject):
     port_created = QtCore.pyqtSignal(object)
     port_destroyed = QtCore.pyqtSignal(object)
     midi_event = QtCore.pyqtSignal(object, object)
+    graph_updated = QtCore.pyqtSignal()
 
     def __init__(self, clientname):
         QtCore.QObject.__init__(self)
@@ -31,63 +32,48 @@ class RtMidiSequencer(QtCore.QObject):
         self.default_out_caps = 33
         self.default_type = 1048578
         self.alsa_mode = True if 'linux' in sys.platform else False
+        #port name to client id (ports are reported as single port clients), and back
         self.in_graph_dict = {}
         self.out_graph_dict = {}
         self.client_dict = {}
+        self.in_clients = set()
+        self.in_ports = self.out_ports = None
+        self.next_id = 2
 
     def update_graph(self):
-        previous_out_clients = self.out_graph_dict.keys()
-        previous_in_clients = self.in_graph_dict.keys()
-        for previous_list in previous_out_clients, previous_in_clients:
-            for port_name in previous_list:
-                if port_name.startswith('Bigglesworth'):
-                    previous_list.pop(previous_list.index(port_name))
-        new_out_clients = []
-        for port_name in self.listener_in.get_ports():
-            if port_name.startswith('Bigglesworth'):
-                continue
-            if port_name in previous_out_clients:
-                previous_out_clients.pop(previous_out_clients.index(port_name))
-            else:
-                new_out_clients.append(port_name)
-        if previous_out_clients:
-            for port_name in previous_out_clients:
-                self.out_graph_dict.pop(port_name)
-                client_id = self.client_dict.keys()[self.client_dict.values().index(port_name)]
-                self.client_dict.pop(client_id)
-                self.port_destroyed.emit({'addr.client': client_id, 'addr.port': 0})
-                self.client_destroyed.emit({'addr.client': client_id})
-        new_index = max(self.client_dict.keys()) + 1
-        if new_out_clients:
-            for port_name in new_out_clients:
-                self.client_dict[new_index] = port_name
-                self.out_graph_dict[port_name] = new_index
-                self.client_created.emit({'addr.client': new_index})
-                self.port_created.emit({'addr.client': new_index, 'addr.port': 0})
-                new_index += 1
+        #port lists are compared first, the graph is diffed only if something changed
+        out_ports = self.listener_in.get_ports()
+        in_ports = self.listener_out.get_ports()
+        if out_ports == self.out_ports and in_ports == self.in_ports:
+            return False
+        self.out_ports = out_ports
+        self.in_ports = in_ports
+        self.update_clients(out_ports, self.out_graph_dict)
+        self.update_clients(in_ports, self.in_graph_dict)
+        #connections to ports that are gone are not notified
+        self.graph_updated.emit()
+        return True
 
-        new_in_clients = []
-        for port_name in self.listener_out.get_ports():
-            if port_name.startswith('Bigglesworth'):
+    def update_clients(self, port_list, graph_dict):
+        current = set(port_name for port_name in port_list if not port_name.startswith('Bigglesworth'))
+        previous = set(port_name for port_name in graph_dict if not port_name.startswith('Bigglesworth'))
+        for port_name in previous - current:
+            client_id = graph_dict.pop(port_name)
+            self.client_dict.pop(client_id)
+            self.in_clients.discard(client_id)
+            self.port_destroyed.emit({'addr.client': client_id, 'addr.port': 0})
+            self.client_destroyed.emit({'addr.client': client_id})
+        for port_name in port_list:
+            if port_name in graph_dict or port_name not in current:
                 continue
-            if port_name in previous_in_clients:
-                previous_in_clients.pop(previous_in_clients.index(port_name))
-            else:
-                new_in_clients.append(port_name)
-        if previous_in_clients:
-            for port_name in previous_in_clients:
-                self.in_graph_dict.pop(port_name)
-                client_id = self.client_dict.keys()[self.client_dict.values().index(port_name)]
-                self.client_dict.pop(client_id)
-                self.port_destroyed.emit({'addr.client': client_id, 'addr.port': 0})
-                self.client_destroyed.emit({'addr.client': client_id})
-        if new_in_clients:
-            for port_name in new_in_clients:
-                self.client_dict[new_index] = port_name
-                self.in_graph_dict[port_name] = new_index
-                self.client_created.emit({'addr.client': new_index})
-                self.port_created.emit({'addr.client': new_index, 'addr.port': 0})
-                new_index += 1
+            client_id = self.next_id
+            self.next_id += 1
+            self.client_dict[client_id] = port_name
+            graph_dict[port_name] = client_id
+            if graph_dict is self.in_graph_dict:
+                self.in_clients.add(client_id)
+            self.client_created.emit({'addr.client': client_id})
+            self.port_created.emit({'addr.client': client_id, 'addr.port': 0})
 
     def connection_list(self):
         res_list = []
@@ -100,13 +86,18 @@ class RtMidiSequencer(QtCore.QObject):
         output_name = self.clientname + ':output'
         self.client_dict[1] = output_name
         self.out_graph_dict[output_name] = 1
+        self.in_clients = set([0])
+        self.out_ports = self.listener_in.get_ports()
+        self.in_ports = self.listener_out.get_ports()
         in_id = 2
-        for in_id, port_name in enumerate(self.listener_in.get_ports(), in_id):
+        for in_id, port_name in enumerate(self.out_ports, in_id):
             self.out_graph_dict[port_name] = in_id
             self.client_dict[in_id] = port_name
-        for out_id, port_name in enumerate(self.listener_out.get_ports(), in_id + 1):
+        for out_id, port_name in enumerate(self.in_ports, in_id + 1):
             self.in_graph_dict[port_name] = out_id
             self.client_dict[out_id] = port_name
+            self.in_clients.add(out_id)
+        self.next_id = max(self.client_dict) + 1
         for client_id, name in self.client_dict.items():
             res_list.append((name, client_id, [(name, 0, ([], []))]))
         return res_list
@@ -126,7 +117,7 @@ class RtMidiSequencer(QtCore.QObject):
                 }
 
     def get_port_info(self, port_id, client_id):
-        if client_id in self.in_graph_dict.values():
+        if client_id in self.in_clients:
             caps = self.default_in_caps
         else:
             caps = self.default_out_caps
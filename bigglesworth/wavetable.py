@@ -15,6 +15,8 @@ except:
 
 from bigglesworth.utils import load_ui, setBoldItalic
 from bigglesworth.const import *
+from bigglesworth.codec import WAVE_MSG_SIZE, decode_wave, encode_wavetable, split_messages
+from bigglesworth.dump import DumpSender, WAVE_SEND_INTERVAL
 from bigglesworth.dialogs import WaveLoad
 from bigglesworth.widgets import MagnifyingCursor, LineCursor, CurveCursor, FreeDrawIcon, LineDrawIcon, CurveDrawIcon
 from bigglesworth.libs import midifile
@@ -2182,6 +2184,10 @@ class WaveTableEditor(QtGui.QMainWindow):
             self.full_sweep_chk.setEnabled(False)
 
         self.dump_dialog = DumpDialog(self)
+        self.dump_sender = DumpSender(self, interval=WAVE_SEND_INTERVAL)
+        self.dump_sender.send.connect(self.wavetable_send)
+        self.dump_sender.progress.connect(lambda done, total, eta: self.dump_dialog.setIndex(done - 1))
+        self.dump_sender.finished.connect(self.dump_dialog.hide)
 
         self.name_edit.setValidator(QtGui.QRegExpValidator(QtCore.QRegExp('[\x20-\x7f°]*')))
 #        self.name_edit.editingFinished.connect(lambda: (self.name_edit.setText(self.name_edit.text().leftJustified(14)), self.setFocus(QtCore.Qt.OtherFocusReason)))
@@ -2452,46 +2458,25 @@ class WaveTableEditor(QtGui.QMainWindow):
             self.splitter_pos = pos
 
     def dump(self):
-        def send(index):
-            self.dump_dialog.setIndex(index)
-            sysex_data = sysex_list.next()
-            self.wavetable_send.emit(sysex_data)
-            if index == 63:
-                self.dump_dialog.hide()
-                return
-            QtCore.QTimer.singleShot(200, lambda i=index: send(i + 1))
-        sysex_list = iter(self.createSysExData())
         self.dump_dialog.setData(self.slot_spin.value(), self.name_edit.text())
+        self.dump_dialog.setIndex(0)
         self.dump_dialog.show()
-        send(0)
+        self.dump_sender.start(self.createSysExData(), WAVE_MSG_SIZE)
 
     def export(self):
         name = QtCore.QDir.homePath() + '/' + self.name_edit.text() + '.syx'
         path = QtGui.QFileDialog.getSaveFileName(self, 'Export wavetable', name, 'SysEx files (*.syx)')
         if not path: return
-        data_list = self.createSysExData()
-        data = []
-        for w_data in data_list:
-            data.extend(w_data)
         with open(str(path.toUtf8()), 'wb') as sf:
-            sf.write(bytearray(data))
+            sf.write(self.createSysExDump())
 
-    def createSysExData(self):
-        sysex_list = []
+    def createSysExDump(self):
         slot = self.slot_spin.value()
         name = tuple(ord(l) if l != '°' else 127 for l in str(self.name_edit.text().toUtf8()).replace('\xc2\xb0', '\x7f').ljust(14, ' '))
-        for n, wave_obj in enumerate(self.waveobj_list):
-            sysex_data = [INIT, IDW, IDE, self.main.blofeld_id, WTBD, slot, n, 0]
-            for value in wave_obj.values:
-                if value < 0:
-                    value = pow21 + value
-                sysex_data.extend((value >> 14, (value >> 7) & 127,  value & 127))
-            sysex_data.extend(name)
-            sysex_data.extend((0, 0, CHK))
-            sysex_data.append(END)
-
-            sysex_list.append(sysex_data)
-        return sysex_list
+        return encode_wavetable([wave_obj.values for wave_obj in self.waveobj_list], slot, name, self.main.blofeld_id)
+
+    def createSysExData(self):
+        return split_messages(self.createSysExDump())
 
     def setWave(self, wave_obj=None):
         self.waveobj_list[self.currentWave].selected_state = False
@@ -2612,7 +2597,7 @@ class WaveTableEditor(QtGui.QMainWindow):
         except Exception:
             try:
                 with open(str(path.toUtf8()), 'rb') as sf:
-                    sysex_list = list(ord(i) for i in sf.read())
+                    sysex_list = list(bytearray(sf.read()))
                 if len(sysex_list) != 26240:
                     raise
                 wt_list = []
@@ -2632,14 +2617,7 @@ class WaveTableEditor(QtGui.QMainWindow):
         if not as_new:
             self.undo_push(WAVETABLE_IMPORT, True, self.waveobj_list, QtCore.QFileInfo(path).fileName())
         for w, wave_obj in enumerate(self.waveobj_list):
-            values_iter = iter(wt_list[w])
-            values = []
-            for s in xrange(128):
-                value = (values_iter.next() << 14) + (values_iter.next() << 7) + values_iter.next()
-                if value >= 1048576:
-                    value -= 2097152
-                values.append(value)
-            wave_obj.setValues(values)
+            wave_obj.setValues(decode_wave(wt_list[w]))
         if not as_new:
             self.undo_push(WAVETABLE_IMPORT, False, self.waveobj_list, '')
         self.setWave(self.waveobj_list[self.currentWave])
@@ -0,0 +1,95 @@
+# *-* coding: utf-8 *-*
+
+import unittest
+from collections import namedtuple, Counter
+
+from bigglesworth import dump, emulator
+from bigglesworth.const import BROADCAST
+from bigglesworth.codec import decode_sound
+from bigglesworth.midiutils import SoundRequestEvent
+
+DumpedSound = namedtuple('DumpedSound', 'bank prog data')
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class DumpSessionTest(unittest.TestCase):
+    '''A full dump requested from the emulator, which drops some requests; time
+    is simulated, and the receiver timers are run by hand.'''
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patched = dump.time, emulator.time
+        dump.time = emulator.time = self.clock
+        self.seq = emulator.EmulatorSequencer('Bigglesworth', latency=.005, drop=.05, seed=3)
+        self.seq.connect_ports((2, 0), (0, 0))
+        self.session = dump.DumpSession()
+        self.session.request.connect(self.request)
+        self.session.finished.connect(self.finished)
+        self.results = []
+        self.requests = Counter()
+
+    def tearDown(self):
+        dump.time, emulator.time = self.patched
+
+    def request(self, bank, prog):
+        self.requests[bank, prog] += 1
+        self.seq.receive(SoundRequestEvent(1, BROADCAST, bank, prog).get_binary())
+
+    def finished(self, sounds, failed):
+        self.results.append((sounds, failed))
+
+    def run_for(self, seconds, step=.005):
+        end = self.clock.now + seconds
+        next_check = self.clock.now
+        single = []
+        while self.clock.now < end and not self.results:
+            self.clock.now += step
+            for reply in self.seq.pending_replies():
+                sound = decode_sound(reply)
+                sound = DumpedSound(sound[0], sound[1], sound[2:])
+                if not self.session.receive(sound):
+                    single.append(sound)
+            if self.clock.now >= next_check:
+                self.session.receiver.check_timeouts()
+                next_check = self.clock.now + .05
+        return single
+
+    def test_dump_all_with_drops(self):
+        #the first requests time out before the replies come, which are then received twice
+        self.session = dump.DumpSession(receiver=dump.DumpReceiver(timeout=.1))
+        self.session.request.connect(self.request)
+        self.session.finished.connect(self.finished)
+        locations = [(bank, prog) for bank in range(8) for prog in range(128)]
+        self.session.start(locations)
+        single = self.run_for(600)
+        self.assertEqual(single, [])
+        self.assertEqual(len(self.results), 1)
+        sounds, failed = self.results[0]
+        self.assertEqual(failed, [])
+        self.assertEqual([(sound.bank, sound.prog) for sound in sounds], locations)
+        self.assertTrue(self.seq.dropped > 0)
+        #dropped requests have been sent again
+        self.assertTrue(sum(self.requests.values()) > len(locations))
+        self.assertEqual(self.session.state, dump.IDLE)
+
+    def test_unrequested_and_duplicate_sounds(self):
+        self.seq.drop = 0
+        self.session.start([(0, prog) for prog in range(4)])
+        extra = DumpedSound(1, 0, [0] * 383)
+        self.assertTrue(self.session.receive(extra))
+        self.assertTrue(self.session.receive(extra))
+        self.run_for(10)
+        sounds, failed = self.results[0]
+        self.assertEqual([(sound.bank, sound.prog) for sound in sounds], [(0, 0), (0, 1), (0, 2), (0, 3), (1, 0)])
+        #a late reply to a request sent again is not a new single sound
+        self.assertTrue(self.session.receive(DumpedSound(0, 2, [0] * 383)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# *-* coding: utf-8 *-*
+
+import unittest
+
+from bigglesworth import emulator
+from bigglesworth.const import INIT, IDW, IDE, END, BROADCAST, GLBR, GLBD, SNDD
+from bigglesworth.codec import SOUND_DATA_SIZE, SOUND_MSG_SIZE, decode_sound
+from bigglesworth.midiutils import SoundRequestEvent, SoundDumpEvent
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class EmulatorSequencerTest(unittest.TestCase):
+    '''Sysex round trips through the emulated ports, with simulated time.'''
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patched = emulator.time
+        emulator.time = self.clock
+        self.seq = self.sequencer()
+
+    def tearDown(self):
+        emulator.time = self.patched
+
+    def sequencer(self, **kwargs):
+        seq = emulator.EmulatorSequencer('Bigglesworth', latency=.005, **kwargs)
+        seq.connect_ports((2, 0), (0, 0))
+        return seq
+
+    def replies(self, seconds=1.):
+        self.clock.now += seconds
+        return self.seq.pending_replies()
+
+    def test_sound_round_trip(self):
+        data = [(index * 7) & 0x7f for index in range(SOUND_DATA_SIZE)]
+        self.seq.receive(SoundDumpEvent(1, BROADCAST, 3, 17, data).get_binary())
+        #SNDD is not answered
+        self.assertEqual(self.replies(), [])
+        self.seq.receive(SoundRequestEvent(1, BROADCAST, 3, 17).get_binary())
+        replies = self.replies()
+        self.assertEqual(len(replies), 1)
+        reply = replies[0]
+        self.assertEqual(len(reply), SOUND_MSG_SIZE)
+        self.assertEqual(list(reply[:5]), [INIT, IDW, IDE, BROADCAST, SNDD])
+        self.assertEqual(decode_sound(reply), [3, 17] + data)
+        self.assertEqual(reply[-2], sum(reply[5:-2]) & 0x7f)
+        #other slots are untouched
+        self.seq.receive(SoundRequestEvent(1, BROADCAST, 3, 18).get_binary())
+        self.assertNotEqual(decode_sound(self.replies()[0])[2:], data)
+
+    def test_reply_timing(self):
+        self.seq.receive(SoundRequestEvent(1, BROADCAST, 0, 0).get_binary())
+        self.seq.receive(SoundRequestEvent(1, BROADCAST, 0, 1).get_binary())
+        sound_time = SOUND_MSG_SIZE / float(emulator.MIDI_BYTE_RATE)
+        #the second reply waits for the first one to be transferred
+        self.assertEqual(len(self.replies(.006 + sound_time)), 1)
+        self.assertEqual(len(self.replies(sound_time)), 1)
+
+    def test_globals_round_trip(self):
+        self.seq.receive(bytearray([INIT, IDW, IDE, BROADCAST, GLBR, END]))
+        reply = self.replies()[0]
+        self.assertEqual(list(reply[:5]), [INIT, IDW, IDE, BROADCAST, GLBD])
+        self.assertEqual(len(reply), 5 + emulator.GLOBALS_SIZE + 2)
+        data = reply[5:-2]
+        self.assertEqual(data[37], BROADCAST)
+        #change the device id, requests for other ids are then ignored
+        data[37] = 0x10
+        self.seq.receive(bytearray([INIT, IDW, IDE, BROADCAST, GLBD]) + data + bytearray((0, END)))
+        self.assertEqual(self.replies(), [])
+        self.seq.receive(SoundRequestEvent(1, 0x11, 0, 0).get_binary())
+        self.assertEqual(self.replies(), [])
+        self.seq.receive(bytearray([INIT, IDW, IDE, 0x10, GLBR, END]))
+        reply = self.replies()[0]
+        self.assertEqual(reply[3], 0x10)
+        self.assertEqual(reply[5:-2], data)
+
+    def test_disconnected_input(self):
+        self.seq.disconnect_ports((2, 0), (0, 0))
+        self.seq.receive(SoundRequestEvent(1, BROADCAST, 0, 0).get_binary())
+        self.assertEqual(self.replies(), [])
+
+    def test_seeded_drops(self):
+        def run(seed):
+            self.seq = self.sequencer(drop=.3, seed=seed)
+            for prog in range(128):
+                self.seq.receive(SoundRequestEvent(1, BROADCAST, 0, prog).get_binary())
+            return [decode_sound(reply)[1] for reply in self.replies(60)]
+        answered = run(5)
+        self.assertTrue(0 < len(answered) < 128)
+        self.assertEqual(self.seq.received, 128)
+        self.assertEqual(self.seq.dropped, 128 - len(answered))
+        self.assertEqual(run(5), answered)
+        self.assertNotEqual(run(6), answered)
+
+
+if __name__ == '__main__':
+    unittest.main()
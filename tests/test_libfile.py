@@ -0,0 +1,67 @@
+# *-* coding: utf-8 *-*
+
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from PyQt4 import QtGui
+
+from bigglesworth.classes import Library, LibraryModel
+from bigglesworth.codec import SOUND_DATA_SIZE
+from bigglesworth.libfile import LibraryFile, LibraryRecord
+
+app = QtGui.QApplication.instance() or QtGui.QApplication([])
+
+
+def make_record(bank, prog, name):
+    data = bytearray(SOUND_DATA_SIZE)
+    data[363:379] = name.ljust(16)
+    return LibraryRecord(bank, prog, str(data))
+
+
+class LibraryFileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = path.join(self.temp_dir, 'library.bwl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def names(self, library_file):
+        return [(record.bank, record.prog, record.data[363:379].rstrip()) for record in library_file]
+
+    def test_deduplicate(self):
+        library_file = LibraryFile(self.file_path)
+        library_file.create([make_record(0, 0, 'first'), make_record(0, 1, 'dupe old'),
+            make_record(0, 2, 'third'), make_record(0, 1, 'dupe new'), make_record(0, 3, 'last')])
+        self.assertTrue(library_file.deduplicate())
+        self.assertEqual(self.names(library_file),
+            [(0, 0, 'first'), (0, 1, 'dupe new'), (0, 2, 'third'), (0, 3, 'last')])
+        self.assertFalse(library_file.deduplicate())
+        library_file.close()
+
+    def test_save_after_duplicate_load(self):
+        #a sound saved after loading a file with duplicate locations must not overwrite other records
+        library_file = LibraryFile(self.file_path)
+        library_file.create([make_record(0, 0, 'first'), make_record(0, 1, 'dupe old'),
+            make_record(0, 1, 'dupe new'), make_record(0, 2, 'third'), make_record(0, 3, 'last')])
+        library_file.deduplicate()
+        library = Library(LibraryModel())
+        library.addSoundBulk(list(library_file))
+        library.file = library_file
+        library.store.clean()
+
+        library[0, 3].name = 'edited'
+        library.save(self.file_path)
+        library.file.close()
+
+        library_file = LibraryFile(self.file_path)
+        library_file.open()
+        self.assertEqual(self.names(library_file),
+            [(0, 0, 'first'), (0, 1, 'dupe new'), (0, 2, 'third'), (0, 3, 'edited')])
+        library_file.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# *-* coding: utf-8 *-*
+
+import unittest
+
+from bigglesworth import midiutils
+from bigglesworth.const import BROADCAST, SNDD, SNDP
+from bigglesworth.midiutils import OutputQueue, SoundDumpEvent, SoundParameterTemplates, CtrlEvent, \
+    SysRtResetEvent, MIDI_BYTE_RATE
+from bigglesworth.codec import SOUND_DATA_SIZE, SOUND_MSG_SIZE
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class OutputQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patched = midiutils.time
+        midiutils.time = self.clock
+        self.queue = OutputQueue(bandwidth=MIDI_BYTE_RATE, interval=20)
+        self.sent = []
+        self.queue.output.connect(self.sent.append)
+        self.templates = SoundParameterTemplates(BROADCAST)
+        self.attr = sorted(self.templates.templates)[0]
+
+    def tearDown(self):
+        midiutils.time = self.patched
+
+    def parameter(self, value):
+        return self.templates.event(1, self.attr, value)
+
+    def sound(self):
+        return SoundDumpEvent(1, BROADCAST, 0x7f, 0, [0] * SOUND_DATA_SIZE)
+
+    def describe(self, events):
+        result = []
+        for event in events:
+            if event.type == midiutils.SYSEX and event.sysex[4] == SNDP:
+                result.append(('SNDP', event.sysex[8]))
+            elif event.type == midiutils.SYSEX and event.sysex[4] == SNDD:
+                result.append('SNDD')
+            else:
+                result.append(event.type)
+        return result
+
+    def fill(self):
+        #use the whole burst allowance, so that the next events are queued
+        self.queue.put(self.sound())
+        del self.sent[:]
+
+    def test_coalesce_latest_value(self):
+        self.fill()
+        self.queue.put(self.parameter(1))
+        self.queue.put(self.parameter(2))
+        self.queue.put(self.parameter(3))
+        self.queue.flush(force=True)
+        self.assertEqual(self.describe(self.sent), [('SNDP', 3)])
+
+    def test_coalesce_keeps_order(self):
+        self.fill()
+        self.queue.put(self.parameter(1))
+        self.queue.put(self.sound())
+        self.queue.put(self.parameter(2))
+        self.queue.flush(force=True)
+        #the dump must not overwrite the last value
+        self.assertEqual(self.describe(self.sent), ['SNDD', ('SNDP', 2)])
+
+    def test_budget(self):
+        self.queue.put(self.sound())
+        self.queue.put(CtrlEvent(1, 0, 7, 100))
+        self.queue.put(self.parameter(1))
+        self.assertEqual(self.describe(self.sent), ['SNDD'])
+        self.assertEqual(len(self.queue), 2)
+        #the dump is over the burst allowance, the next events wait for it to be transferred
+        self.clock.now += (SOUND_MSG_SIZE - self.queue.burst) / float(MIDI_BYTE_RATE)
+        self.queue.flush()
+        self.assertEqual(len(self.sent), 1)
+        self.clock.now += 20. / MIDI_BYTE_RATE
+        self.queue.flush()
+        self.assertEqual(self.describe(self.sent), ['SNDD', midiutils.CTRL, ('SNDP', 1)])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_realtime_not_delayed(self):
+        self.fill()
+        self.queue.put(CtrlEvent(1, 0, 7, 100))
+        self.queue.put(SysRtResetEvent(1))
+        self.assertEqual(self.describe(self.sent), [midiutils.SYSRT_RESET])
+        self.assertEqual(len(self.queue), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()